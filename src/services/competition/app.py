@@ -1,5 +1,4 @@
 import os
-import requests
 from flask import Flask
 from waitress import serve
 from flask_cors import CORS
@@ -19,14 +18,22 @@ from database import (
     get_leaderboard as get_leaderboard_db,
     get_competition_leaderboard as get_competition_leaderboard_db,
     get_challenge_leaderboard as get_challenge_leaderboard_db,
+    rebuild_leaderboard as rebuild_leaderboard_db,
+    get_leaderboard_totals,
     delete_submissions as delete_submissions_db,
     delete_submissions_where as delete_submissions_where_db,
-    put_submission,
     get_submissions,
     get_submissions_challenge_user,
-    update_competition
+    update_competition,
+    pool
 )
-from utils import get_challenges, authorize, validate_json_fields
+from pool import WAITRESS_THREADS
+from utils import get_challenges, get_flag_digests, evaluate_flags, teardown_competition, prepull_competition, authorize, validate_json_fields, ctf_client
+from batching import MicroBatcher
+from flag_cache import FlagCache
+from ranking import Leaderboards
+from streaming import LeaderboardStream, STREAM_PORT
+from write_behind import SubmissionWriter
 
 app = Flask(__name__)
 
@@ -38,6 +45,10 @@ def read_secret(secret_name):
 
 mode = os.getenv("KUBERNETES_MODE")
 
+# Flags missing from the flag cache are evaluated by the ctf service in groups
+EVALUATE_BATCH_SIZE = int(os.getenv("EVALUATE_BATCH_SIZE", "50"))
+EVALUATE_BATCH_WAIT = float(os.getenv("EVALUATE_BATCH_WAIT_MS", "5")) / 1000
+
 # config for jwt
 if mode == "in-cluster":
     app.config['SECRET_KEY'] = read_secret("JWT_SecretKey")
@@ -51,6 +62,32 @@ app.config['JWT_TOKEN_LOCATION'] = ['headers']
 # JWT Initialization
 jwt = JWTManager(app)
 
+# Ranked view of every competition, kept in step with the committed submissions
+leaderboards = Leaderboards(get_leaderboard_totals)
+max_leaderboard_page_size = 1000
+
+# Flags are checked locally, the ctf service is only asked on a miss
+flag_cache = FlagCache(get_flag_digests)
+flag_evaluator = MicroBatcher("evaluate", evaluate_flags, EVALUATE_BATCH_SIZE, EVALUATE_BATCH_WAIT)
+
+# Live leaderboard changes, served on STREAM_PORT at /leaderboards/competition/<competition_id>/stream
+stream = LeaderboardStream(rank=lambda competition_id, username: leaderboards.get(competition_id).rank(username))
+
+def submission_committed(submission):
+    """Moves the ranked leaderboard of the competition forward once a submission is committed"""
+    # Committed in order under the participant lock, but this runs after the commit and may be overtaken
+    if not leaderboards.update(submission["competition_id"], submission["username"], submission["competition_score"],
+                               submission["timestamp"], submission.get("committed_at")):
+        return
+    stream.publish(submission["competition_id"], submission["username"], submission["competition_score"], submission["challenge_id"], submission["score"], submission["valid"], submission["timestamp"])
+
+# Submissions are written one by one, or grouped per commit with SUBMISSION_WRITE_MODE=group
+submission_writer = SubmissionWriter(submission_committed)
+
+def log_submission(username, competition_id, challenge_id, submission_flag, score, admin, valid):
+    """Inserts the submission and moves the ranked leaderboard of the competition forward"""
+    return submission_writer.write(username, competition_id, challenge_id, submission_flag, score, admin, valid)
+
 @app.get("/")
 def hello_world():
     """Exist only to make the app seem healthy for the gateway"""
@@ -73,6 +110,12 @@ def update_competitions(competition_id):
     competition.active = data["active"]
 
     updated_competition = update_competition(competition)
+    # Nobody can play an inactive competition, so its instances are removed. Repeated on every update,
+    # which lets a failed teardown be retried
+    if not updated_competition.active:
+        teardown_competition(updated_competition.id)
+    else:
+        prepull_competition(updated_competition.id)
     return updated_competition.serialize(), 200
 
 @app.get('/competitions')
@@ -192,11 +235,43 @@ def get_competition_leaderboard(competition_id):
     scores = get_competition_leaderboard_db(competition_id)
     return [score for score in scores], 200
 
+@app.get("/leaderboards/competition/<competition_id>/top")
+def get_competition_leaderboard_top(competition_id):
+    """The n best ranked participants of the competition"""
+    n = min(request.args.get("n", 10, type=int), max_leaderboard_page_size)
+    return leaderboards.get(competition_id).top(n), 200
+
+@app.get("/leaderboards/competition/<competition_id>/ranks")
+def get_competition_leaderboard_ranks(competition_id):
+    """A page of the ranked participants of the competition"""
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(request.args.get("limit", 50, type=int), max_leaderboard_page_size)
+    board = leaderboards.get(competition_id)
+    return {"total": len(board), "ranks": board.page(offset, limit)}, 200
+
+@app.get("/leaderboards/competition/<competition_id>/around/<username>")
+def get_competition_leaderboard_around(competition_id, username):
+    """The participants ranked k above to k below the given user"""
+    k = min(request.args.get("k", 5, type=int), max_leaderboard_page_size)
+    ranks = leaderboards.get(competition_id).around(username, k)
+    if ranks is None:
+        raise exceptions.NotFound(f"User {username} has no score in competition {competition_id}")
+    return ranks, 200
+
 @app.get("/leaderboards/challenge/<challenge_id>")
 def get_challenge_leaderboard(challenge_id):
     scores = get_challenge_leaderboard_db(challenge_id)
     return scores, 200
 
+@app.post("/leaderboards/rebuild")
+@jwt_required()
+@authorize(["admin"])
+def rebuild_leaderboard():
+    """Recompute the maintained leaderboard from all submissions"""
+    message = rebuild_leaderboard_db()
+    leaderboards.reload()
+    return jsonify(message), 200
+
 @app.delete("/submissions")
 @jwt_required()
 @authorize(["admin"])
@@ -215,6 +290,7 @@ def delete_submissions():
         message = delete_submissions_where_db(data) if data is not None else delete_submissions_db()
     except Exception as e:
         raise exceptions.BadRequest(500, description=f"An error occurred while resetting the leaderboard: {str(e)}")
+    leaderboards.reload()
 
     return jsonify(message), 200
 
@@ -227,7 +303,7 @@ def update_score():
     data = request.get_json()
     try:
         """Inserting log submission - insertion set up to timestamp it now utc zone"""
-        message = put_submission(data["username"], data["competition_id"], data["challenge_id"], "Admin added this", data["score"], True, False) # Adjusted to avoid confusion
+        message = log_submission(data["username"], data["competition_id"], data["challenge_id"], "Admin added this", data["score"], True, False) # Adjusted to avoid confusion
     except Exception as e:
         raise exceptions.BadRequest(f"An error occurred while updating the score: {str(e)}")
     return jsonify(message), 200
@@ -240,12 +316,7 @@ def update_score():
 def add_ctf():
     data = request.get_json()
     
-    if mode == "in-cluster":
-        ctf_endpoint = "http://service-ctf/add-comp"
-    else:
-        ctf_endpoint = "http://localhost:8081/add-comp"
-    
-    response = requests.post(ctf_endpoint, json=data)
+    response = ctf_client.post("/add-comp", idempotent=True, json=data)
 
     if response.status_code != 201:
         raise exceptions.NotFound("Unknown error happened")
@@ -284,26 +355,20 @@ def submit_flag():
     challenge_id = data.get("challenge_id")
     flag = data.get("flag")
 
-    request_body = {
-        "challenge_id": challenge_id,
-        "flag": flag
-    }
-
-    if mode == "in-cluster":
-        ctf_endpoint = "http://service-ctf/evaluate"
-    else:
-        ctf_endpoint = "http://localhost:8081/evaluate"
-    
-    response = requests.post(ctf_endpoint, json=request_body)
-    response_body = response.json()
+    score = flag_cache.check(challenge_id, flag)
+    if score is None:
+        score = flag_evaluator.submit((challenge_id, flag))
+        if score is None:
+            raise exceptions.NotFound("Challenge not found")
 
-    if response.status_code == 404:
-        raise exceptions.NotFound("Challenge not found")
-    
-    score = response_body.get("score")
+        # Next submissions to this competition are checked locally
+        try:
+            flag_cache.fill([competition_id])
+        except Exception as e:
+            print(f"Could not fill the flag cache: {e}")
 
     """Inserting log submission - insertion set up to timestamp it now utc zone"""
-    put_submission(username, competition_id, challenge_id, flag, score, False, True if score > 0 else False)
+    log_submission(username, competition_id, challenge_id, flag, score, False, True if score > 0 else False)
 
     return jsonify(
         {
@@ -313,5 +378,22 @@ def submit_flag():
     ), 200
 
 
+@app.post("/flag-cache/invalidate")
+@jwt_required()
+@authorize(["service", "admin"])
+@validate_json_fields(["challenge_ids"])
+def invalidate_flag_cache():
+    """Called by the ctf service with its service token whenever challenges change, admins may call it by hand"""
+    data = request.get_json()
+    flag_cache.invalidate(data["challenge_ids"])
+    return jsonify({"message": "Flag cache invalidated"}), 200
+
+@app.get("/metrics")
+def metrics():
+    """Internal counters of the service"""
+    return {"db_pool": pool.stats(), "leaderboard_stream": stream.stats(), "flag_cache": flag_cache.stats(), "http": {"ctf": ctf_client.stats()}, "flag_evaluator": flag_evaluator.stats(), "submission_writer": submission_writer.stats()}, 200
+
+
 if __name__ == '__main__':
-    serve(app, host='0.0.0.0', port=8080)
\ No newline at end of file
+    stream.start(port=STREAM_PORT)
+    serve(app, host='0.0.0.0', port=8080, threads=WAITRESS_THREADS)
\ No newline at end of file
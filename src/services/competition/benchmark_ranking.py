@@ -0,0 +1,39 @@
+"""Read latency of the ranked leaderboard for growing competitions, run with: python benchmark_ranking.py"""
+import random
+import time
+from datetime import datetime, timedelta
+from ranking import RankedLeaderboard
+
+SIZES = [1_000, 10_000, 100_000]
+QUERIES = 2_000
+
+def build(size):
+    board = RankedLeaderboard()
+    start = datetime(2024, 1, 1)
+    for i in range(size):
+        board.update(f"user{i}", random.randint(0, 5_000), start + timedelta(seconds=i))
+    return board
+
+def measure(fn):
+    """Mean latency of fn in microseconds"""
+    start = time.perf_counter()
+    for _ in range(QUERIES):
+        fn()
+    return (time.perf_counter() - start) / QUERIES * 1e6
+
+def main():
+    print(f"{'participants':>12} {'top 10':>10} {'page':>10} {'around':>10} {'rank':>10} {'update':>10}  (us/op)")
+    for size in SIZES:
+        board = build(size)
+        users = [f"user{random.randrange(size)}" for _ in range(QUERIES)]
+        it = iter(users * 5)
+
+        top = measure(lambda: board.top(10))
+        page = measure(lambda: board.page(random.randrange(size), 50))
+        around = measure(lambda: board.around(next(it), 5))
+        rank = measure(lambda: board.rank(next(it)))
+        update = measure(lambda: board.update(next(it), random.randint(0, 5_000), datetime.now()))
+        print(f"{size:>12} {top:>10.1f} {page:>10.1f} {around:>10.1f} {rank:>10.1f} {update:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Submission write throughput, direct against group commit, run against the database with: python benchmark_submissions.py
+
+Uses a throwaway competition that is deleted again afterwards, together with its submissions.
+"""
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from models import Competition
+from database import put_competition, put_competition_user, pool
+from write_behind import SubmissionWriter
+
+THREADS = [1, 8, 32]
+SUBMISSIONS = 2_000
+PARTICIPANTS = 200
+CHALLENGES = [str(uuid.uuid4()) for _ in range(20)]
+
+def run(writer, competition_id, threads):
+    """Rows per second written by threads concurrent callers"""
+    def submit(i):
+        writer.write(f"benchmark{i % PARTICIPANTS}", competition_id, CHALLENGES[i % len(CHALLENGES)], "flag", i % 100, False, True)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(submit, range(SUBMISSIONS)))
+    return SUBMISSIONS / (time.perf_counter() - start)
+
+def main():
+    competition = put_competition(Competition(f"benchmark-{uuid.uuid4()}", False))
+    competition_id = str(competition.id)
+    try:
+        for i in range(PARTICIPANTS):
+            put_competition_user(f"benchmark{i}", competition_id)
+
+        direct = SubmissionWriter(lambda submission: None, mode="direct")
+        group = SubmissionWriter(lambda submission: None, mode="group", durability="commit")
+        print(f"{'threads':>8} {'direct':>10} {'group':>10}  (rows/s)")
+        for threads in THREADS:
+            print(f"{threads:>8} {run(direct, competition_id, threads):>10.0f} {run(group, competition_id, threads):>10.0f}")
+        print(f"group batches: {group.stats()}")
+    finally:
+        with pool.connection() as conn:
+            conn.cursor().execute("DELETE FROM competitions WHERE id = %s;", (competition_id,))
+            conn.commit()
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,11 @@ from models import Competition
 import uuid
 import psycopg2
 import psycopg2.extras
+import psycopg2.errors
 import psycopg2.sql as sql
 from werkzeug import exceptions
 import os
+from pool import ConnectionPool
 
 def read_secret(secret_name):
     with open(f"/var/secrets/{secret_name}.txt", "r") as f:
@@ -32,23 +34,23 @@ def connect():
         )
     return conn
 
+pool = ConnectionPool(connect)
+
 def get_competitions():
     '''Returns all competitions'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, active FROM competitions;')
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name, active FROM competitions;')
+        rows = cursor.fetchall()
     competitions = [Competition(id=row[0], name=row[1], active=row[2]) for row in rows] # Test af actions
     return competitions
 
 def get_competition_by_id(competition_id: str):
     '''Return specific competition by id'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, active FROM competitions WHERE id = %s;', (competition_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name, active FROM competitions WHERE id = %s;', (competition_id,))
+        row = cursor.fetchone()
     if row:
         return Competition(id=row[0], name=row[1], active=row[2])
     else:
@@ -56,224 +58,346 @@ def get_competition_by_id(competition_id: str):
 
 def get_competitions_active():
     '''Returns all competitions that are currently active'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, active FROM competitions WHERE active = True;')
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, name, active FROM competitions WHERE active = True;')
+        rows = cursor.fetchall()
     competitions = [Competition(id=row[0], name=row[1], active=row[2]) for row in rows] 
     return competitions
 
 def put_competition(competition: Competition):
     '''Inserts a new competition'''
-    conn = connect()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-        INSERT INTO competitions (name, active) 
-        VALUES (%s, %s) RETURNING id;''', (competition.name, competition.active))
-        competition.id = cursor.fetchone()[0] # get auto-generated ID
-        conn.commit()
-    except psycopg2.DatabaseError as e:
-        raise exceptions.BadRequest(description=f"Error inserting competition: {e}")
-    finally:
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+            INSERT INTO competitions (name, active) 
+            VALUES (%s, %s) RETURNING id;''', (competition.name, competition.active))
+            competition.id = cursor.fetchone()[0] # get auto-generated ID
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            raise exceptions.BadRequest(description=f"Error inserting competition: {e}")
     return competition
 
 def update_competition(competition: Competition):
     '''Updates a competition with set id'''
-    conn = connect()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-        UPDATE competitions
-        SET name = %s, active = %s
-        WHERE id = %s;''',
-        (competition.name, competition.active, competition.id))
-        conn.commit()
-    except psycopg2.DatabaseError as e:
-        raise exceptions.BadRequest(description=f"Database error occurred: {e}") 
-    finally:
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+            UPDATE competitions
+            SET name = %s, active = %s
+            WHERE id = %s;''',
+            (competition.name, competition.active, competition.id))
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            raise exceptions.BadRequest(description=f"Database error occurred: {e}") 
     return competition
 
 
 '''Competitions participants'''
 def put_competition_user(username: str, competition_id: str):
     '''Inserts a user into a competition'''
-    conn = connect()
-    cursor = conn.cursor()
-    try:
-        # Check if the participant already exists
-        cursor.execute('SELECT COUNT(*) FROM participants WHERE username = %s AND competition_id = %s;',
-                       (username, competition_id))
-        if cursor.fetchone()[0] > 0:
-            raise exceptions.BadRequest(description="Participant already exists in this competition.")
-
-        # Insert the participant
-        cursor.execute('''
-        INSERT INTO participants (username, competition_id) 
-        VALUES (%s, %s);''', (username, competition_id))
-        conn.commit()
-    except psycopg2.DatabaseError as e:
-        raise exceptions.BadRequest(description=f"Error inserting participant: {e}") 
-    finally:
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # Check if the participant already exists
+            cursor.execute('SELECT COUNT(*) FROM participants WHERE username = %s AND competition_id = %s;',
+                           (username, competition_id))
+            if cursor.fetchone()[0] > 0:
+                raise exceptions.BadRequest(description="Participant already exists in this competition.")
+
+            # Insert the participant
+            cursor.execute('''
+            INSERT INTO participants (username, competition_id) 
+            VALUES (%s, %s);''', (username, competition_id))
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            raise exceptions.BadRequest(description=f"Error inserting participant: {e}") 
     participants = {'username': username, 'competition_id': competition_id}
     return participants
 
 def get_competitions_users():
     '''Returns all competitions and their participants'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT competition_id, username FROM participants;')
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT competition_id, username FROM participants;')
+        rows = cursor.fetchall()
     participants = [{'competition_id': row[0], 'username': row[1]} for row in rows]
     return participants
 
 def get_competition_users(competition_id: str):
     '''Return all users in a competition'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM participants WHERE competition_id = %s;', (competition_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT username FROM participants WHERE competition_id = %s;', (competition_id,))
+        rows = cursor.fetchall()
     participants =  [{'competition_id': competition_id, 'username': row[0]} for row in rows]
     return participants
 
 def get_user_competitions(username:str):
     '''Returns all competition a specific user participates in'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM participants WHERE username = %s;', (username,))
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT username FROM participants WHERE username = %s;', (username,))
+        rows = cursor.fetchall()
     participants =  [{'competition_id': row[0], 'username': username} for row in rows]
     return participants
 
 '''Leaderboard'''
+# Concurrent writers to the same participant's leaderboard rows are serialized, the loser is retried
+max_leaderboard_write_retries = 3
+
+LEADERBOARD_KEYS = ['username', 'competition_id', 'challenge_id']
+
 def get_leaderboard():
     """Rank users based on their cumulative score across all competitions."""
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("""
-    with rankedscore AS
-  (SELECT username, score, competition_id, challenge_id, valid, ROW_NUMBER() OVER (PARTITION BY username, competition_id, challenge_id ORDER BY timestamp DESC) AS rn
-  FROM submissions)
-
-  select username, sum(score) from rankedscore
-  where rn=1
-  group by username
-    """)
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT username, SUM(score) FROM leaderboard_totals GROUP BY username;')
+        rows = cursor.fetchall()
     scores =  [{'username': row[0], 'score': row[1]} for row in rows]
     return scores
 
 def get_competition_leaderboard(competition_id):
     """Rank users based on their total score within a specific competition."""
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("""
-    with rankedscore AS
-  (SELECT username, score, competition_id, challenge_id, valid, ROW_NUMBER() OVER (PARTITION BY username, competition_id, challenge_id ORDER BY timestamp DESC) AS rn
-  FROM submissions)
-
-  select username, sum(score) from rankedscore
-  where rn=1 and competition_id = %s
-  group by username
-    """, (competition_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT username, score FROM leaderboard_totals WHERE competition_id = %s;', (competition_id,))
+        rows = cursor.fetchall()
     scores =  [{'username': row[0], 'score': row[1]} for row in rows]
     return scores
 
 def get_challenge_leaderboard(challenge_id):
     """Rank users based on their score within a specific challenge."""
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("""
-    with rankedscore AS
-  (SELECT username, score, competition_id, challenge_id, valid, ROW_NUMBER() OVER (PARTITION BY username, competition_id, challenge_id ORDER BY timestamp DESC) AS rn
-  FROM submissions)
-
-  select username, sum(score) from rankedscore
-  where rn=1 and challenge_id = %s
-  group by username
-    """, (challenge_id,))    
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT username, SUM(score) FROM leaderboard_scores WHERE challenge_id = %s GROUP BY username;', (challenge_id,))
+        rows = cursor.fetchall()
     scores =  [{'username': row[0], 'score': row[1]} for row in rows]
     return scores
 
+def get_leaderboard_totals():
+    """Returns the total score of every participant of every competition, used to seed the ranked leaderboards."""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT competition_id, username, score, updated_at FROM leaderboard_totals;')
+        rows = cursor.fetchall()
+    return rows
+
+def _lock_participant(cursor, username, competition_id):
+    """Serializes writers of one participant's leaderboard rows, so a recomputed total never misses a score"""
+    cursor.execute('SELECT 1 FROM participants WHERE username = %s AND competition_id = %s FOR UPDATE;', (username, competition_id))
+
+def _update_leaderboard(cursor, username, competition_id, challenge_id, score, timestamp):
+    """Moves the leaderboard forward with one submission, in the transaction of the caller"""
+    cursor.execute('''
+    INSERT INTO leaderboard_scores (username, competition_id, challenge_id, score, timestamp)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (username, competition_id, challenge_id) DO UPDATE
+    SET score = EXCLUDED.score, timestamp = EXCLUDED.timestamp
+    WHERE leaderboard_scores.timestamp <= EXCLUDED.timestamp;''', (username, competition_id, challenge_id, score, timestamp))
+
+    # The total only reads the participant's own rows, so it costs O(challenges) and not O(submissions)
+    cursor.execute('''
+    INSERT INTO leaderboard_totals (username, competition_id, score, updated_at)
+    SELECT username, competition_id, SUM(score), MAX(timestamp) FROM leaderboard_scores
+    WHERE username = %s AND competition_id = %s
+    GROUP BY username, competition_id
+    ON CONFLICT (username, competition_id) DO UPDATE
+    SET score = EXCLUDED.score, updated_at = EXCLUDED.updated_at
+    RETURNING score, updated_at, clock_timestamp();''', (username, competition_id))
+    # clock_timestamp() is read under the participant lock, so it orders the participant's commits
+    return cursor.fetchone()
+
+def _rebuild_leaderboard(cursor, filters):
+    """Recomputes the leaderboard rows matching the filters from submissions, in the transaction of the caller"""
+    filters = {k: v for k, v in filters.items() if k in LEADERBOARD_KEYS}
+    where = sql.SQL(' AND ').join(
+        sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder(k)]) for k in filters.keys()
+    ) if filters else sql.SQL('TRUE')
+
+    affected_query = sql.SQL('SELECT DISTINCT username, competition_id FROM leaderboard_scores WHERE {where};').format(where=where)
+    cursor.execute(affected_query, filters)
+    affected = set(cursor.fetchall())
+
+    cursor.execute(sql.SQL('DELETE FROM leaderboard_scores WHERE {where};').format(where=where), filters)
+    cursor.execute(sql.SQL('''
+    INSERT INTO leaderboard_scores (username, competition_id, challenge_id, score, timestamp)
+    SELECT username, competition_id, challenge_id, score, timestamp FROM (
+        SELECT username, competition_id, challenge_id, score, timestamp,
+            ROW_NUMBER() OVER (PARTITION BY username, competition_id, challenge_id ORDER BY timestamp DESC) AS rn
+        FROM submissions
+        WHERE {where}
+    ) latest
+    WHERE rn = 1;''').format(where=where), filters)
+
+    # Totals of participants that lost all their rows have to go as well
+    cursor.execute(affected_query, filters)
+    affected.update(cursor.fetchall())
+    usernames = [row[0] for row in affected]
+    competition_ids = [str(row[1]) for row in affected]
+
+    cursor.execute('''
+    DELETE FROM leaderboard_totals
+    WHERE (username, competition_id) IN (SELECT * FROM unnest(%s::varchar[], %s::uuid[]));''', (usernames, competition_ids))
+    cursor.execute('''
+    INSERT INTO leaderboard_totals (username, competition_id, score, updated_at)
+    SELECT s.username, s.competition_id, SUM(s.score), MAX(s.timestamp)
+    FROM leaderboard_scores s
+    JOIN unnest(%s::varchar[], %s::uuid[]) AS a(username, competition_id)
+        ON s.username = a.username AND s.competition_id = a.competition_id
+    GROUP BY s.username, s.competition_id;''', (usernames, competition_ids))
+
+def rebuild_leaderboard():
+    """Recomputes the whole leaderboard from submissions."""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            _rebuild_leaderboard(cursor, {})
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            raise exceptions.BadRequest(description=f"Database error occurred: {e}")
+    return "Leaderboard rebuilt from submissions."
+
 def delete_submissions():
-    conn = connect()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("DELETE FROM submissions;")
-        conn.commit()
-        message = "All submissions deleted successfully."
-    except psycopg2.DatabaseError as e:
-        raise exceptions.BadRequest(description=f"Database error occurred: {e}")
-    finally:
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM submissions;")
+            cursor.execute("DELETE FROM leaderboard_totals;")
+            cursor.execute("DELETE FROM leaderboard_scores;")
+            conn.commit()
+            message = "All submissions deleted successfully."
+        except psycopg2.DatabaseError as e:
+            raise exceptions.BadRequest(description=f"Database error occurred: {e}")
     return message
 
 def delete_submissions_where(data):
     """Reset the leaderboard by clearing submissions based on data filters."""
     query = sql.SQL("DELETE FROM submissions WHERE {data};").format(
-    data=sql.SQL(', ').join(
+    data=sql.SQL(' AND ').join(
         sql.Composed([sql.Identifier(k), sql.SQL(" = "), sql.Placeholder(k)]) for k in data.keys()
     ))
 
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    try:
-        cursor.execute(
-            query,
-            data,
-        )
-    except psycopg2.Error as e:
-        raise exceptions.BadRequest(description=f"Database error: {e}")
-    finally:
-        conn.commit()
-        conn.close()
+        try:
+            cursor.execute(
+                query,
+                data,
+            )
+            _rebuild_leaderboard(cursor, data)
+            conn.commit()
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
     return f"All submissions with given filters {data} deleted successfully."
 
 def put_submission(username: str, competition_id: str, challenge_id: str, submission_flag: str, score: int, admin: bool, valid: bool):
-    """Inserts a log of the user's submission of flag"""
-    conn = connect()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-        INSERT INTO submissions (username, competition_id, challenge_id, submission_flag, score, admin, valid) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s);''', (username, competition_id, challenge_id, submission_flag, score, admin, valid))
-        conn.commit()
-    except psycopg2.DatabaseError as e:
-        raise exceptions.BadRequest(description=f"Error inserting submissions: {e}") 
-    finally:
-        conn.close()
-    submission = {'username': username, 'competition_id': competition_id, 'challenge_id': challenge_id, 'submission_flag': submission_flag, 'score': score, 'admin': admin, 'valid': valid}
+    """Inserts a log of the user's submission of flag, and updates the leaderboard in the same transaction"""
+    for attempt in range(max_leaderboard_write_retries):
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                _lock_participant(cursor, username, competition_id)
+                cursor.execute('''
+                INSERT INTO submissions (username, competition_id, challenge_id, submission_flag, score, admin, valid, timestamp)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, clock_timestamp()) RETURNING timestamp;''', (username, competition_id, challenge_id, submission_flag, score, admin, valid))
+                timestamp = cursor.fetchone()[0]
+                competition_score, _, committed_at = _update_leaderboard(cursor, username, competition_id, challenge_id, score, timestamp)
+                conn.commit()
+                break
+            except psycopg2.errors.SerializationFailure as e:
+                if attempt == max_leaderboard_write_retries - 1:
+                    raise exceptions.Conflict(description=f"Error inserting submissions: {e}")
+            except psycopg2.DatabaseError as e:
+                raise exceptions.BadRequest(description=f"Error inserting submissions: {e}") 
+    submission = {'username': username, 'competition_id': competition_id, 'challenge_id': challenge_id, 'submission_flag': submission_flag, 'score': score, 'admin': admin, 'valid': valid, 'timestamp': timestamp, 'competition_score': competition_score, 'committed_at': committed_at}
     return submission
 
+def put_submissions(submissions):
+    """Inserts many submissions with one multi-row insert, and updates the leaderboard, in a single transaction"""
+    """Each submission is a (username, competition_id, challenge_id, submission_flag, score, admin, valid) tuple"""
+    try:
+        # Canonical ids, so the rows can be matched with what the database returns
+        rows = [
+            (str(uuid.uuid4()), username, str(uuid.UUID(str(competition_id))), str(uuid.UUID(str(challenge_id))), submission_flag, score, admin, valid)
+            for username, competition_id, challenge_id, submission_flag, score, admin, valid in submissions
+        ]
+    except ValueError as e:
+        raise exceptions.BadRequest(description=f"Error inserting submissions: {e}")
+    participants = sorted({(row[1], row[2]) for row in rows})
+    usernames = [participant[0] for participant in participants]
+    competition_ids = [participant[1] for participant in participants]
+
+    for attempt in range(max_leaderboard_write_retries):
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                # Locked in a fixed order, so two groups can not deadlock each other
+                cursor.execute('''
+                SELECT 1 FROM participants
+                WHERE (username, competition_id) IN (SELECT * FROM unnest(%s::varchar[], %s::uuid[]))
+                ORDER BY username, competition_id
+                FOR UPDATE;''', (usernames, competition_ids))
+
+                # clock_timestamp() keeps the rows of one group in arrival order, as put_submission stamps its row
+                inserted = psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO submissions (id, username, competition_id, challenge_id, submission_flag, score, admin, valid, timestamp)
+                VALUES %s RETURNING id, timestamp;''', rows,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, clock_timestamp())", page_size=len(rows), fetch=True)
+                timestamps = {str(row[0]): row[1] for row in inserted}
+
+                # Only the last submission per challenge of a group can be the latest score
+                latest = {}
+                for row in rows:
+                    latest[(row[1], row[2], row[3])] = (row[1], row[2], row[3], row[5], timestamps[row[0]])
+                psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO leaderboard_scores (username, competition_id, challenge_id, score, timestamp)
+                VALUES %s
+                ON CONFLICT (username, competition_id, challenge_id) DO UPDATE
+                SET score = EXCLUDED.score, timestamp = EXCLUDED.timestamp
+                WHERE leaderboard_scores.timestamp <= EXCLUDED.timestamp;''', list(latest.values()), page_size=len(latest))
+
+                cursor.execute('''
+                INSERT INTO leaderboard_totals (username, competition_id, score, updated_at)
+                SELECT s.username, s.competition_id, SUM(s.score), MAX(s.timestamp)
+                FROM leaderboard_scores s
+                JOIN unnest(%s::varchar[], %s::uuid[]) AS a(username, competition_id)
+                    ON s.username = a.username AND s.competition_id = a.competition_id
+                GROUP BY s.username, s.competition_id
+                ON CONFLICT (username, competition_id) DO UPDATE
+                SET score = EXCLUDED.score, updated_at = EXCLUDED.updated_at
+                RETURNING username, competition_id, score, clock_timestamp();''', (usernames, competition_ids))
+                totals = {(row[0], str(row[1])): (row[2], row[3]) for row in cursor.fetchall()}
+                conn.commit()
+                break
+            except psycopg2.errors.SerializationFailure as e:
+                if attempt == max_leaderboard_write_retries - 1:
+                    raise exceptions.Conflict(description=f"Error inserting submissions: {e}")
+            except psycopg2.DatabaseError as e:
+                raise exceptions.BadRequest(description=f"Error inserting submissions: {e}")
+
+    return [
+        {'username': row[1], 'competition_id': row[2], 'challenge_id': row[3], 'submission_flag': row[4], 'score': row[5], 'admin': row[6], 'valid': row[7], 'timestamp': timestamps[row[0]], 'competition_score': totals[(row[1], row[2])][0], 'committed_at': totals[(row[1], row[2])][1]}
+        for row in rows
+    ]
+
 def get_submissions():
     '''Return all submissions'''
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM submissions')
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM submissions')
+        rows = cursor.fetchall()
     #TODO fix this toxic shit xdd
     submissions =  [{'id': row[0],'username': row[1], 'competition_id': row[2], 'challenge_id': row[3], 'timestamp': row[4], 'submission_flag': row[5], 'score': row[6], 'admin': row[7], 'valid': row[8]} for row in rows]
     return submissions
 
 def get_submissions_challenge_user(challenge_id, username):
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM submissions WHERE username = %s AND challenge_id = %s;', (username, challenge_id, ))
-    rows = cursor.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM submissions WHERE username = %s AND challenge_id = %s;', (username, challenge_id, ))
+        rows = cursor.fetchall()
     submissions =  [{'id': row[0],'username': row[1], 'competition_id': row[2], 'challenge_id': row[3], 'timestamp': row[4], 'submission_flag': row[5], 'score': row[6], 'admin': row[7], 'valid': row[8]} for row in rows]
     return submissions
\ No newline at end of file
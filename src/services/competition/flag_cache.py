@@ -0,0 +1,87 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# Also how long a replica that missed an invalidation may accept an old flag
+FLAG_CACHE_TTL = float(os.getenv("FLAG_CACHE_TTL", "60"))
+
+
+class FlagCache:
+    """Salted flag digests and scores per challenge, so /submit can check flags without asking the ctf service.
+
+    Only digests keyed with a per-process salt are cached, never the flags themselves. Entries expire
+    after ttl seconds as a safety net for invalidations that only reached another replica.
+    """
+
+    def __init__(self, fetch, ttl=FLAG_CACHE_TTL) -> None:
+        self._fetch = fetch
+        self.ttl = ttl
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._filled = {}
+        # Bumped by every invalidation, a fill that started before one is stale and dropped
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._fills = 0
+        self._invalidations = 0
+        self._stale_fills = 0
+
+    def check(self, challenge_id, flag: str):
+        """Score of the flag, 0 if it is wrong, None if the challenge is not cached"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(str(challenge_id))
+            if entry is None or entry[2] < now:
+                self._misses += 1
+                return None
+            self._hits += 1
+        digest, score, _ = entry
+        submitted = hmac.new(self._salt, str(flag).encode(), hashlib.sha256).digest()
+        return score if hmac.compare_digest(submitted, digest) else 0
+
+    def fill(self, competition_ids):
+        """Loads the digests of every challenge in the competitions, at most once per ttl per competition"""
+        now = time.monotonic()
+        with self._lock:
+            competition_ids = [str(c) for c in competition_ids if self._filled.get(str(c), 0) < now]
+            generation = self._generation
+        if not competition_ids:
+            return
+
+        digests = self._fetch(self._salt.hex(), competition_ids)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if generation != self._generation:
+                # The digests may predate the invalidation, the next miss fills again
+                self._stale_fills += 1
+                return
+            for challenge_id, entry in digests.items():
+                self._entries[challenge_id] = (bytes.fromhex(entry["digest"]), entry["score"], expires)
+            for competition_id in competition_ids:
+                self._filled[competition_id] = expires
+            self._fills += 1
+
+    def invalidate(self, challenge_ids):
+        with self._lock:
+            for challenge_id in challenge_ids:
+                self._entries.pop(str(challenge_id), None)
+            # The competition of a challenge is unknown here, so every competition may be filled again
+            self._filled.clear()
+            self._generation += 1
+            self._invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "fills": self._fills,
+                "invalidations": self._invalidations,
+                "stale_fills": self._stale_fills,
+            }
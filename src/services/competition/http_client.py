@@ -0,0 +1,168 @@
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug import exceptions
+from pool import WAITRESS_THREADS
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(WAITRESS_THREADS)))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.1"))
+HTTP_BREAKER_FAILURES = int(os.getenv("HTTP_BREAKER_FAILURES", "5"))
+HTTP_BREAKER_RESET = float(os.getenv("HTTP_BREAKER_RESET", "10"))
+
+# Responses that mean the target is unhealthy, and that an idempotent call may be retried on
+RETRY_STATUSES = {502, 503, 504}
+
+
+class CircuitBreaker:
+    """Fails fast after max_failures consecutive failures, lets one trial call through every reset_after seconds"""
+
+    def __init__(self, max_failures=HTTP_BREAKER_FAILURES, reset_after=HTTP_BREAKER_RESET) -> None:
+        self.max_failures = max_failures
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.reset_after else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_after and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def retry_after(self) -> int:
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(int(self.reset_after - (time.monotonic() - self._opened_at)) + 1, 1)
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.max_failures:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class ServiceClient:
+    """Keep-alive HTTP client for one internal service, with deadlines, retries and a circuit breaker"""
+
+    def __init__(self, name, base_url, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF) -> None:
+        self.name = name
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._retries = 0
+        self._timeouts = 0
+        self._short_circuited = 0
+        self._latency_seconds = 0.0
+        self._max_latency_seconds = 0.0
+
+    def post(self, path, idempotent=False, **kwargs) -> requests.Response:
+        return self.request("POST", path, idempotent=idempotent, **kwargs)
+
+    def get(self, path, **kwargs) -> requests.Response:
+        return self.request("GET", path, idempotent=True, **kwargs)
+
+    def request(self, method, path, idempotent=False, **kwargs) -> requests.Response:
+        """Sends the request, retrying idempotent calls with jittered exponential backoff"""
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                with self._lock:
+                    self._short_circuited += 1
+                raise exceptions.ServiceUnavailable(
+                    f"The {self.name} service is unavailable, try again later",
+                    retry_after=self.breaker.retry_after(),
+                )
+
+            start = time.monotonic()
+            error = None
+            response = None
+            try:
+                response = self._session.request(method, self.base_url + path, **kwargs)
+            except requests.ConnectTimeout as e:
+                # Nothing was sent, so even non-idempotent calls can be retried
+                error, retryable = e, True
+            except requests.Timeout as e:
+                error, retryable = e, idempotent
+            except requests.ConnectionError as e:
+                error, retryable = e, idempotent
+            self._record(time.monotonic() - start, error, response)
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                self.breaker.success()
+                return response
+
+            self.breaker.failure()
+            if error is None:
+                retryable = idempotent
+            if not retryable or attempt >= self.retries:
+                if error is None:
+                    return response
+                if isinstance(error, requests.Timeout):
+                    raise exceptions.GatewayTimeout(f"The {self.name} service did not answer in time")
+                raise exceptions.BadGateway(f"Could not reach the {self.name} service")
+
+            attempt += 1
+            with self._lock:
+                self._retries += 1
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _record(self, latency, error, response):
+        with self._lock:
+            self._requests += 1
+            self._latency_seconds += latency
+            self._max_latency_seconds = max(self._max_latency_seconds, latency)
+            if isinstance(error, requests.Timeout):
+                self._timeouts += 1
+            if error is not None or response.status_code >= 500:
+                self._errors += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "errors": self._errors,
+                "timeouts": self._timeouts,
+                "retries": self._retries,
+                "short_circuited": self._short_circuited,
+                "latency_seconds_total": round(self._latency_seconds, 6),
+                "latency_seconds_max": round(self._max_latency_seconds, 6),
+                "breaker": self.breaker.state,
+            }
@@ -0,0 +1,201 @@
+import random
+import threading
+from datetime import datetime
+
+MAX_LEVELS = 24 # enough for 2^24 participants per competition
+
+
+class _Node:
+    def __init__(self, key, levels) -> None:
+        self.key = key
+        self.next = [None] * levels
+        # width[i] is the number of bottom level steps to next[i]
+        self.width = [1] * levels
+
+
+class IndexableSkipList:
+    """Sorted skip list which also finds the n'th key and the index of a key in O(log n)"""
+
+    def __init__(self, max_levels=MAX_LEVELS) -> None:
+        self._max_levels = max_levels
+        self._head = _Node(None, max_levels)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _search(self, key):
+        """Returns the last node before key on every level, and the steps taken on every level"""
+        chain = [None] * self._max_levels
+        steps = [0] * self._max_levels
+        node = self._head
+        for level in reversed(range(self._max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps
+
+    def insert(self, key):
+        chain, steps = self._search(key)
+        levels = 1
+        while levels < self._max_levels and random.random() < 0.5:
+            levels += 1
+
+        node = _Node(key, levels)
+        taken = 0
+        for level in range(levels):
+            prev = chain[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = prev.width[level] - taken
+            prev.width[level] = taken + 1
+            taken += steps[level]
+        for level in range(levels, self._max_levels):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, key):
+        chain, _ = self._search(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), self._max_levels):
+            chain[level].width[level] -= 1
+        self._size -= 1
+
+    def index(self, key) -> int:
+        """0-based position of key"""
+        chain, steps = self._search(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        return sum(steps)
+
+    def slice(self, start, stop):
+        """Keys from position start up to, but not including, stop"""
+        start = max(start, 0)
+        stop = min(stop, self._size)
+        if start >= stop:
+            return []
+
+        node = self._head
+        remaining = start + 1
+        for level in reversed(range(self._max_levels)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        keys = []
+        while node is not None and len(keys) < stop - start:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class RankedLeaderboard:
+    """Participants of one competition ordered by score, ties go to whoever reached the score first"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._keys = {}
+        # When the entry's total was committed, totals committed before it are stale
+        self._committed = {}
+        self._list = IndexableSkipList()
+
+    def __len__(self) -> int:
+        return len(self._list)
+
+    def update(self, username: str, score: int, timestamp: datetime, committed_at: datetime = None) -> bool:
+        """Sets the total score of username, timestamp is when the score was reached and committed_at when the total
+        was committed. Returns False for a total committed before the current one, which arrived out of order"""
+        with self._lock:
+            if committed_at is not None:
+                current = self._committed.get(username)
+                if current is not None and committed_at < current:
+                    return False
+                self._committed[username] = committed_at
+            old_key = self._keys.get(username)
+            if old_key is not None:
+                if -old_key[0] == score:
+                    # Same score, keep the earlier tie-break time
+                    return True
+                self._list.remove(old_key)
+            key = (-score, timestamp.timestamp() if timestamp is not None else 0.0, username)
+            self._keys[username] = key
+            self._list.insert(key)
+            return True
+
+    def remove(self, username: str):
+        with self._lock:
+            key = self._keys.pop(username, None)
+            self._committed.pop(username, None)
+            if key is not None:
+                self._list.remove(key)
+
+    def rank(self, username: str):
+        """1-based rank of username, None if the user has no score"""
+        with self._lock:
+            key = self._keys.get(username)
+            return self._list.index(key) + 1 if key is not None else None
+
+    def page(self, offset: int, limit: int) -> list:
+        """Ranked entries from rank offset + 1"""
+        with self._lock:
+            keys = self._list.slice(offset, offset + limit)
+        return [
+            {"rank": offset + i + 1, "username": key[2], "score": -key[0]}
+            for i, key in enumerate(keys)
+        ]
+
+    def top(self, n: int) -> list:
+        return self.page(0, n)
+
+    def around(self, username: str, k: int):
+        """The entries ranked k above to k below username, None if the user has no score"""
+        with self._lock:
+            key = self._keys.get(username)
+            if key is None:
+                return None
+            offset = max(self._list.index(key) - k, 0)
+            keys = self._list.slice(offset, offset + 2 * k + 1)
+        return [
+            {"rank": offset + i + 1, "username": key[2], "score": -key[0]}
+            for i, key in enumerate(keys)
+        ]
+
+
+class Leaderboards:
+    """One RankedLeaderboard per competition, seeded lazily from the leaderboard totals in the database"""
+
+    def __init__(self, load) -> None:
+        self._load = load
+        self._lock = threading.Lock()
+        self._boards = None
+
+    def _ensure_loaded(self) -> dict:
+        with self._lock:
+            if self._boards is None:
+                boards = {}
+                for competition_id, username, score, updated_at in self._load():
+                    boards.setdefault(str(competition_id), RankedLeaderboard()).update(username, score, updated_at)
+                self._boards = boards
+            return self._boards
+
+    def reload(self):
+        """Forgets all boards, they are seeded again on next use"""
+        with self._lock:
+            self._boards = None
+
+    def get(self, competition_id) -> RankedLeaderboard:
+        boards = self._ensure_loaded()
+        with self._lock:
+            return boards.setdefault(str(competition_id), RankedLeaderboard())
+
+    def update(self, competition_id, username: str, score: int, timestamp: datetime, committed_at: datetime = None) -> bool:
+        return self.get(competition_id).update(username, score, timestamp, committed_at)
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import re
+import threading
+
+STREAM_PORT = int(os.getenv("STREAM_PORT", "8083"))
+STREAM_INTERVAL = float(os.getenv("STREAM_INTERVAL", "1"))
+STREAM_MAX_BUFFER = int(os.getenv("STREAM_MAX_BUFFER", str(64 * 1024)))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", "5000"))
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", "15"))
+# Solves kept per frame, the scores are coalesced per user so they are bounded by the participants
+STREAM_MAX_SOLVES = 100
+
+STREAM_PATH = re.compile(r"^/leaderboards/competition/([^/?]+)/stream(\?.*)?$")
+
+
+class LeaderboardStream:
+    """Server-Sent Events of leaderboard changes.
+
+    All subscribers are served by one asyncio thread on a port of its own, so an open stream never
+    holds a waitress worker thread. Changes published between two ticks are coalesced into a single
+    frame per competition, and a subscriber whose unsent data exceeds max_buffer is disconnected.
+    """
+
+    def __init__(self, rank=None, interval=STREAM_INTERVAL, max_buffer=STREAM_MAX_BUFFER,
+                 max_subscribers=STREAM_MAX_SUBSCRIBERS, heartbeat=STREAM_HEARTBEAT) -> None:
+        self._rank = rank
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.max_subscribers = max_subscribers
+        self.heartbeat = heartbeat
+
+        self._loop = None
+        self._subscribers = {}
+        self._pending = {}
+
+        self._frames = 0
+        self._dropped = 0
+        self._rejected = 0
+
+    def start(self, host="0.0.0.0", port=STREAM_PORT):
+        """Starts serving the streams on a background thread"""
+        started = threading.Event()
+        thread = threading.Thread(target=asyncio.run, args=(self._serve(host, port, started),), daemon=True)
+        thread.start()
+        started.wait()
+
+    def publish(self, competition_id, username, competition_score, challenge_id, score, valid, timestamp):
+        """Queues a committed submission for the next frame, safe to call from any thread"""
+        if self._loop is None:
+            return
+        solve = None
+        if valid and score > 0:
+            solve = {
+                "username": username,
+                "challenge_id": str(challenge_id),
+                "score": score,
+                "timestamp": timestamp.isoformat() if timestamp is not None else None,
+            }
+        self._loop.call_soon_threadsafe(self._enqueue, str(competition_id), username, competition_score, solve)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(subscribers) for subscribers in list(self._subscribers.values())),
+            "competitions": len(self._subscribers),
+            "frames": self._frames,
+            "dropped_slow_subscribers": self._dropped,
+            "rejected_subscribers": self._rejected,
+        }
+
+    def _enqueue(self, competition_id, username, competition_score, solve):
+        if competition_id not in self._subscribers:
+            return
+        pending = self._pending.setdefault(competition_id, {"scores": {}, "solves": []})
+        pending["scores"][username] = competition_score
+        if solve is not None:
+            pending["solves"].append(solve)
+            del pending["solves"][:-STREAM_MAX_SOLVES]
+
+    async def _serve(self, host, port, started):
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle, host, port)
+        started.set()
+        async with server:
+            ticks = 0
+            heartbeat_every = max(int(self.heartbeat / self.interval), 1)
+            while True:
+                await asyncio.sleep(self.interval)
+                ticks += 1
+                self._flush()
+                if ticks % heartbeat_every == 0:
+                    # Keeps proxies from closing quiet streams
+                    self._broadcast_all(b": ping\n\n")
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        request_line = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+        match = STREAM_PATH.match(request_line[1]) if len(request_line) == 3 else None
+        if request_line[0] != "GET" or match is None:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+        if sum(len(subscribers) for subscribers in self._subscribers.values()) >= self.max_subscribers:
+            self._rejected += 1
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        competition_id = match.group(1)
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Access-Control-Allow-Origin: *\r\n"
+            b"\r\n"
+            b"retry: 3000\n\n"
+        )
+        subscribers = self._subscribers.setdefault(competition_id, set())
+        subscribers.add(writer)
+        try:
+            # Subscribers never send anything, EOF means they are gone
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self._unsubscribe(competition_id, writer)
+
+    def _unsubscribe(self, competition_id, writer):
+        subscribers = self._subscribers.get(competition_id)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self._subscribers[competition_id]
+                self._pending.pop(competition_id, None)
+        writer.close()
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        for competition_id, changes in pending.items():
+            scores = [
+                {
+                    "username": username,
+                    "score": score,
+                    "rank": self._rank(competition_id, username) if self._rank is not None else None,
+                }
+                for username, score in changes["scores"].items()
+            ]
+            data = json.dumps({"competition_id": competition_id, "scores": scores, "solves": changes["solves"]})
+            self._broadcast(competition_id, f"event: leaderboard\ndata: {data}\n\n".encode())
+            self._frames += 1
+
+    def _broadcast_all(self, frame):
+        for competition_id in list(self._subscribers.keys()):
+            self._broadcast(competition_id, frame)
+
+    def _broadcast(self, competition_id, frame):
+        for writer in list(self._subscribers.get(competition_id, ())):
+            if writer.transport.is_closing():
+                self._unsubscribe(competition_id, writer)
+            elif writer.transport.get_write_buffer_size() > self.max_buffer:
+                # Slow client, its backlog would grow without bound
+                self._dropped += 1
+                self._unsubscribe(competition_id, writer)
+            else:
+                writer.write(frame)
@@ -0,0 +1,75 @@
+import threading
+import time
+import pytest
+from batching import MicroBatcher
+
+
+class Recorder:
+    """flush that remembers the groups it was given and answers each item with its double"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        return [item * 2 for item in items]
+
+
+def test_full_groups_are_flushed_without_waiting():
+    flush = Recorder()
+    batcher = MicroBatcher("test", flush, max_items=3, max_wait=0.3)
+    start = time.monotonic()
+    futures = [batcher.enqueue(item) for item in range(7)]
+    assert [future.result(2) for future in futures] == [item * 2 for item in range(7)]
+    assert [len(batch) for batch in flush.batches] == [3, 3, 1]
+    # Only the last, partial group waited for max_wait
+    assert time.monotonic() - start >= 0.3
+    assert batcher.stats()["max_batch"] == 3
+
+
+def test_partial_group_is_flushed_after_max_wait():
+    batcher = MicroBatcher("test", Recorder(), max_items=100, max_wait=0.1)
+    start = time.monotonic()
+    assert batcher.submit(21, timeout=2) == 42
+    assert 0.1 <= time.monotonic() - start < 1
+
+
+def test_concurrent_callers_share_a_group():
+    flush = Recorder()
+    batcher = MicroBatcher("test", flush, max_items=100, max_wait=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda item=item: results.append(batcher.submit(item, timeout=2))) for item in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [0, 2, 4, 6, 8]
+    assert len(flush.batches) == 1
+
+
+def test_failed_item_is_raised_to_its_caller_only():
+    batcher = MicroBatcher("test", lambda items: [ValueError(item) if item == 1 else item for item in items], 3, 1)
+    futures = [batcher.enqueue(item) for item in range(3)]
+    assert futures[0].result(2) == 0
+    with pytest.raises(ValueError):
+        futures[1].result(2)
+    assert futures[2].result(2) == 2
+
+
+def test_failed_flush_fails_the_whole_group():
+    def flush(items):
+        raise RuntimeError("database is down")
+
+    batcher = MicroBatcher("test", flush, max_items=2, max_wait=1)
+    futures = [batcher.enqueue(item) for item in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(2)
+    assert batcher.stats()["failed_batches"] == 1
+
+
+def test_missing_results_fail_the_group():
+    batcher = MicroBatcher("test", lambda items: items[:1], max_items=2, max_wait=1)
+    futures = [batcher.enqueue(item) for item in range(2)]
+    with pytest.raises(RuntimeError):
+        futures[0].result(2)
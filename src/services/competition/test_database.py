@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+import psycopg2
+import pytest
+from werkzeug import exceptions
+import database
+from pool import ConnectionPool
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class ScriptedCursor:
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, query, args=None):
+        self.db.queries.append(" ".join(query.split()))
+        if self.db.failures:
+            raise self.db.failures.pop(0)
+
+    def fetchone(self):
+        return self.db.rows.pop(0)
+
+
+class ScriptedDatabase:
+    """Connection that fails the first queries with the given errors and answers fetchone with rows in turn"""
+
+    def __init__(self, failures=(), rows=()):
+        self.failures = list(failures)
+        self.rows = list(rows)
+        self.queries = []
+        self.commits = 0
+        self.closed = 0
+
+    def __call__(self):
+        return self
+
+    def cursor(self):
+        return ScriptedCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def scripted(monkeypatch):
+    def script(**kwargs):
+        db = ScriptedDatabase(**kwargs)
+        monkeypatch.setattr(database, "pool", ConnectionPool(db))
+        return db
+    return script
+
+
+def submit():
+    return database.put_submission("alice", "competition", "challenge", "flag", 10, False, True)
+
+
+def test_submission_updates_the_leaderboard_in_its_transaction(scripted):
+    db = scripted(rows=[(NOW,), (30, NOW, NOW)])
+    submission = submit()
+    assert submission["competition_score"] == 30
+    assert submission["committed_at"] == NOW
+    assert db.commits == 1
+    lock, insert, scores, totals = db.queries
+    assert "FOR UPDATE" in lock
+    assert insert.startswith("INSERT INTO submissions")
+    assert scores.startswith("INSERT INTO leaderboard_scores")
+    assert totals.startswith("INSERT INTO leaderboard_totals")
+
+
+def test_serialization_failures_are_retried(scripted):
+    db = scripted(failures=[psycopg2.errors.SerializationFailure("retry")], rows=[(NOW,), (10, NOW, NOW)])
+    assert submit()["competition_score"] == 10
+    assert db.commits == 1
+
+
+def test_repeated_serialization_failures_are_a_conflict(scripted):
+    scripted(failures=[psycopg2.errors.SerializationFailure("retry")] * database.max_leaderboard_write_retries)
+    with pytest.raises(exceptions.Conflict):
+        submit()
+
+
+def test_other_errors_are_a_bad_request(scripted):
+    db = scripted(failures=[psycopg2.errors.ForeignKeyViolation("no such challenge")])
+    with pytest.raises(exceptions.BadRequest):
+        submit()
+    assert db.commits == 0
+
+
+def test_direct_submissions_are_stamped_like_grouped_ones(scripted):
+    db = scripted(rows=[(NOW,), (10, NOW, NOW)])
+    submit()
+    # Grouped rows get clock_timestamp() as well, now() would be the start of the transaction
+    assert "clock_timestamp()" in db.queries[1]
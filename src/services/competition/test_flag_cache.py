@@ -0,0 +1,85 @@
+import hashlib
+import hmac
+import threading
+from flag_cache import FlagCache
+
+CHALLENGES = {"challenge": ("flag{right}", 100)}
+
+
+class FakeCtf:
+    """Answers digest requests like the ctf service, optionally running before() while the request is in flight"""
+
+    def __init__(self):
+        self.requests = 0
+        self.before = None
+
+    def __call__(self, salt, competition_ids):
+        self.requests += 1
+        if self.before is not None:
+            before, self.before = self.before, None
+            before()
+        return {
+            challenge_id: {"digest": hmac.new(bytes.fromhex(salt), flag.encode(), hashlib.sha256).hexdigest(), "score": score}
+            for challenge_id, (flag, score) in CHALLENGES.items()
+        }
+
+
+def test_flags_are_checked_against_the_digests():
+    cache = FlagCache(FakeCtf())
+    assert cache.check("challenge", "flag{right}") is None
+    cache.fill(["competition"])
+    assert cache.check("challenge", "flag{right}") == 100
+    assert cache.check("challenge", "flag{wrong}") == 0
+
+
+def test_competition_is_filled_once_per_ttl():
+    ctf = FakeCtf()
+    cache = FlagCache(ctf)
+    cache.fill(["competition"])
+    cache.fill(["competition"])
+    assert ctf.requests == 1
+
+
+def test_invalidation_empties_the_challenge():
+    ctf = FakeCtf()
+    cache = FlagCache(ctf)
+    cache.fill(["competition"])
+    cache.invalidate(["challenge"])
+    assert cache.check("challenge", "flag{right}") is None
+    cache.fill(["competition"])
+    assert ctf.requests == 2
+
+
+def test_fill_that_raced_an_invalidation_is_dropped():
+    ctf = FakeCtf()
+    cache = FlagCache(ctf)
+    ctf.before = lambda: cache.invalidate(["challenge"])
+    cache.fill(["competition"])
+    assert cache.check("challenge", "flag{right}") is None
+    assert cache.stats()["stale_fills"] == 1
+
+    cache.fill(["competition"])
+    assert cache.check("challenge", "flag{right}") == 100
+
+
+def test_expired_entries_are_misses():
+    cache = FlagCache(FakeCtf(), ttl=0)
+    cache.fill(["competition"])
+    assert cache.check("challenge", "flag{right}") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_concurrent_checks_and_fills():
+    cache = FlagCache(FakeCtf())
+    results = []
+
+    def check():
+        cache.fill(["competition"])
+        results.append(cache.check("challenge", "flag{right}"))
+
+    threads = [threading.Thread(target=check) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [100] * 8
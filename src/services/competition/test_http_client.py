@@ -0,0 +1,101 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from werkzeug import exceptions
+from http_client import CircuitBreaker, ServiceClient
+
+
+class Unavailable(BaseHTTPRequestHandler):
+    """Stands in for an unhealthy service, answers every request with 503"""
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def unavailable():
+    Unavailable.requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Unavailable)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(max_failures=3, reset_after=60)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() > 0
+
+
+def test_half_open_breaker_lets_one_trial_through():
+    breaker = CircuitBreaker(max_failures=1, reset_after=0.05)
+    breaker.failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = CircuitBreaker(max_failures=5, reset_after=0.05)
+    for _ in range(5):
+        breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_the_breaker():
+    breaker = CircuitBreaker(max_failures=1, reset_after=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_idempotent_calls_are_retried(unavailable):
+    client = ServiceClient("test", unavailable, retries=2, backoff=0.001)
+    assert client.get("/").status_code == 503
+    assert Unavailable.requests == 3
+    assert client.stats()["retries"] == 2
+
+
+def test_other_calls_are_not_retried(unavailable):
+    client = ServiceClient("test", unavailable, retries=2, backoff=0.001)
+    assert client.post("/").status_code == 503
+    assert Unavailable.requests == 1
+
+
+def test_open_breaker_fails_fast(unavailable):
+    client = ServiceClient("test", unavailable, retries=0)
+    client.breaker = CircuitBreaker(max_failures=2, reset_after=60)
+    client.post("/")
+    client.post("/")
+    with pytest.raises(exceptions.ServiceUnavailable):
+        client.post("/")
+    assert Unavailable.requests == 2
+    assert client.stats()["short_circuited"] == 1
@@ -0,0 +1,156 @@
+import threading
+import time
+import psycopg2
+import pytest
+from werkzeug import exceptions
+from pool import ConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, args=None):
+        if self.conn.dead:
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.conn.queries.append(query)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection, a dead one fails its next query and is then marked closed like libpq does"""
+
+    def __init__(self):
+        self.closed = 0
+        self.dead = False
+        self.queries = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class Connector:
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self):
+        self.opened.append(FakeConnection())
+        return self.opened[-1]
+
+
+def test_connections_are_reused():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert len(connect.opened) == 1
+    # Returned without an open transaction
+    assert first.rollbacks == 2
+    assert pool.stats()["borrows"] == 2
+
+
+def test_borrowers_wait_for_a_free_connection():
+    pool = ConnectionPool(Connector(), max_size=1, borrow_timeout=2)
+    borrowed = threading.Event()
+
+    def hold():
+        with pool.connection():
+            borrowed.set()
+            time.sleep(0.1)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    borrowed.wait()
+    with pool.connection():
+        pass
+    thread.join()
+    stats = pool.stats()
+    assert stats["waits"] == 1
+    assert stats["size"] == 1
+    assert stats["wait_seconds_max"] >= 0.05
+
+
+def test_borrow_times_out_when_the_pool_is_exhausted():
+    pool = ConnectionPool(Connector(), max_size=1, borrow_timeout=0.05)
+    with pool.connection():
+        with pytest.raises(exceptions.ServiceUnavailable):
+            with pool.connection():
+                pass
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_old_connections_are_recycled():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_lifetime=0)
+    with pool.connection():
+        pass
+    with pool.connection():
+        pass
+    assert len(connect.opened) == 2
+    assert connect.opened[0].closed
+    assert pool.stats()["recycled"] >= 1
+
+
+def test_idle_connections_are_checked_before_they_are_handed_out():
+    connect = Connector()
+    pool = ConnectionPool(connect, health_check_after=0)
+    with pool.connection() as conn:
+        pass
+    conn.dead = True
+    with pool.connection() as replacement:
+        pass
+    assert replacement is not conn
+    assert pool.stats()["failed_health_checks"] == 1
+
+
+def test_failed_connect_frees_its_slot():
+    def connect():
+        raise psycopg2.OperationalError("could not connect to server")
+
+    pool = ConnectionPool(connect, max_size=1)
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            pass
+    assert pool.stats()["size"] == 0
+
+
+def test_dead_connection_is_thrown_away_not_returned():
+    connect = Connector()
+    pool = ConnectionPool(connect)
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            conn.dead = True
+            conn.cursor().execute("SELECT 1;")
+    assert pool.stats()["idle"] == 0
+    assert pool.stats()["size"] == 0
+    with pool.connection() as replacement:
+        pass
+    assert replacement is not conn
+
+
+def test_connection_survives_a_serialization_failure():
+    connect = Connector()
+    pool = ConnectionPool(connect)
+    with pytest.raises(psycopg2.errors.SerializationFailure):
+        with pool.connection() as conn:
+            raise psycopg2.errors.SerializationFailure("could not serialize access")
+    with pool.connection() as again:
+        pass
+    # Retried writes get the same connection back, rolled back
+    assert again is conn
+    assert len(connect.opened) == 1
@@ -0,0 +1,111 @@
+import random
+from datetime import datetime, timedelta, timezone
+import pytest
+from ranking import IndexableSkipList, RankedLeaderboard, Leaderboards
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+
+def test_skip_list_matches_a_sorted_list():
+    rng = random.Random(7)
+    skip_list, expected = IndexableSkipList(), []
+    for _ in range(2000):
+        key = rng.randrange(500)
+        if key in expected and rng.random() < 0.5:
+            skip_list.remove(key)
+            expected.remove(key)
+        elif key not in expected:
+            skip_list.insert(key)
+            expected.append(key)
+        expected.sort()
+        assert len(skip_list) == len(expected)
+
+    for position, key in enumerate(expected):
+        assert skip_list.index(key) == position
+    for start, stop in [(0, 10), (5, 17), (len(expected) - 3, len(expected) + 5), (-2, 3), (10, 5)]:
+        assert skip_list.slice(start, stop) == expected[max(start, 0):stop]
+
+
+def test_skip_list_missing_keys():
+    skip_list = IndexableSkipList()
+    skip_list.insert(1)
+    with pytest.raises(KeyError):
+        skip_list.index(2)
+    with pytest.raises(KeyError):
+        skip_list.remove(2)
+
+
+def board(*entries):
+    leaderboard = RankedLeaderboard()
+    for username, score, seconds in entries:
+        leaderboard.update(username, score, at(seconds))
+    return leaderboard
+
+
+def test_ties_go_to_whoever_reached_the_score_first():
+    leaderboard = board(("alice", 100, 2), ("bob", 100, 1), ("carol", 300, 3))
+    assert [entry["username"] for entry in leaderboard.top(3)] == ["carol", "bob", "alice"]
+    # The same score again keeps the earlier time
+    leaderboard.update("bob", 100, at(10))
+    assert leaderboard.rank("bob") == 2
+
+
+def test_page():
+    leaderboard = board(*[(f"user{i}", i * 10, i) for i in range(10)])
+    assert leaderboard.page(2, 3) == [
+        {"rank": 3, "username": "user7", "score": 70},
+        {"rank": 4, "username": "user6", "score": 60},
+        {"rank": 5, "username": "user5", "score": 50},
+    ]
+    assert leaderboard.page(9, 5) == [{"rank": 10, "username": "user0", "score": 0}]
+    assert leaderboard.page(10, 5) == []
+
+
+def test_around():
+    leaderboard = board(*[(f"user{i}", i * 10, i) for i in range(10)])
+    assert [entry["rank"] for entry in leaderboard.around("user5", 2)] == [3, 4, 5, 6, 7]
+    # Near the top the window starts at rank 1 and keeps its size
+    assert [entry["username"] for entry in leaderboard.around("user9", 1)] == ["user9", "user8", "user7"]
+    assert [entry["rank"] for entry in leaderboard.around("user0", 2)] == [8, 9, 10]
+    assert leaderboard.around("nobody", 2) is None
+
+
+def test_rank_follows_updates_and_removals():
+    leaderboard = board(("alice", 100, 1), ("bob", 200, 2))
+    leaderboard.update("alice", 300, at(3))
+    assert leaderboard.rank("alice") == 1
+    leaderboard.remove("alice")
+    assert leaderboard.rank("alice") is None
+    assert leaderboard.rank("bob") == 1
+    assert len(leaderboard) == 1
+
+
+def test_totals_committed_earlier_are_ignored():
+    leaderboard = RankedLeaderboard()
+    assert leaderboard.update("alice", 300, at(2), committed_at=at(20))
+    # An older, lower total whose callback ran late
+    assert not leaderboard.update("alice", 100, at(1), committed_at=at(10))
+    assert leaderboard.top(1) == [{"rank": 1, "username": "alice", "score": 300}]
+    assert leaderboard.update("alice", 400, at(3), committed_at=at(30))
+    assert leaderboard.top(1)[0]["score"] == 400
+
+
+def test_leaderboards_are_seeded_once_per_load():
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [("comp1", "alice", 100, at(1)), ("comp2", "bob", 50, at(2))]
+
+    leaderboards = Leaderboards(load)
+    assert leaderboards.get("comp1").rank("alice") == 1
+    leaderboards.update("comp1", "bob", 200, at(3))
+    assert leaderboards.get("comp1").rank("bob") == 1
+    assert len(loads) == 1
+    leaderboards.reload()
+    assert leaderboards.get("comp1").rank("bob") is None
+    assert len(loads) == 2
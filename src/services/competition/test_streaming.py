@@ -0,0 +1,88 @@
+import json
+from streaming import LeaderboardStream, STREAM_MAX_SOLVES
+
+
+class FakeTransport:
+    def __init__(self, buffered=0):
+        self.buffered = buffered
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+
+class FakeWriter:
+    """Stands in for a subscriber's connection, buffered is how much it has not read yet"""
+
+    def __init__(self, buffered=0):
+        self.transport = FakeTransport(buffered)
+        self.frames = []
+        self.closed = False
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def close(self):
+        self.closed = True
+
+
+def subscribed(*writers, **kwargs):
+    stream = LeaderboardStream(**kwargs)
+    stream._subscribers["competition"] = set(writers)
+    return stream
+
+
+def events(writer):
+    return [json.loads(frame.decode().split("data: ", 1)[1]) for frame in writer.frames]
+
+
+def test_changes_between_ticks_are_coalesced():
+    writer = FakeWriter()
+    stream = subscribed(writer, rank=lambda competition_id, username: 1)
+    stream._enqueue("competition", "alice", 10, {"username": "alice", "score": 10})
+    stream._enqueue("competition", "alice", 30, {"username": "alice", "score": 20})
+    stream._flush()
+    event, = events(writer)
+    assert event["scores"] == [{"username": "alice", "score": 30, "rank": 1}]
+    assert len(event["solves"]) == 2
+    assert stream.stats()["frames"] == 1
+
+
+def test_solves_per_frame_are_bounded():
+    writer = FakeWriter()
+    stream = subscribed(writer)
+    for score in range(STREAM_MAX_SOLVES + 10):
+        stream._enqueue("competition", "alice", score, {"username": "alice", "score": score})
+    stream._flush()
+    event, = events(writer)
+    assert len(event["solves"]) == STREAM_MAX_SOLVES
+    assert event["solves"][-1]["score"] == STREAM_MAX_SOLVES + 9
+
+
+def test_changes_without_subscribers_are_not_kept():
+    stream = LeaderboardStream()
+    stream._enqueue("competition", "alice", 10, None)
+    assert stream._pending == {}
+
+
+def test_slow_subscribers_are_dropped():
+    fast, slow = FakeWriter(), FakeWriter(buffered=1024)
+    stream = subscribed(fast, slow, max_buffer=512)
+    stream._broadcast("competition", b": ping\n\n")
+    assert fast.frames == [b": ping\n\n"]
+    assert slow.frames == [] and slow.closed
+    assert stream._subscribers["competition"] == {fast}
+    assert stream.stats()["dropped_slow_subscribers"] == 1
+
+
+def test_last_subscriber_gone_forgets_the_competition():
+    writer = FakeWriter()
+    writer.transport.closing = True
+    stream = subscribed(writer)
+    stream._enqueue("competition", "alice", 10, None)
+    stream._broadcast_all(b": ping\n\n")
+    assert stream._subscribers == {}
+    assert stream._pending == {}
@@ -0,0 +1,91 @@
+import threading
+import pytest
+from werkzeug import exceptions
+import write_behind
+from write_behind import SubmissionWriter
+
+BAD_FLAG = "bad"
+
+
+def item(flag="flag", username="alice"):
+    return (username, "competition", "challenge", flag, 10, False, True)
+
+
+def stored(username, competition_id, challenge_id, submission_flag, score, admin, valid):
+    if submission_flag == BAD_FLAG:
+        raise exceptions.BadRequest("Invalid submission")
+    return {"username": username, "submission_flag": submission_flag, "score": score}
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Stands in for the submission writes, a group with a bad row fails like the multi-row insert does"""
+    calls = {"groups": [], "rows": []}
+
+    def put_submissions(items):
+        calls["groups"].append(list(items))
+        return [stored(*item) for item in items]
+
+    def put_submission(*item):
+        calls["rows"].append(item)
+        return stored(*item)
+
+    monkeypatch.setattr(write_behind, "put_submissions", put_submissions)
+    monkeypatch.setattr(write_behind, "put_submission", put_submission)
+    return calls
+
+
+def test_group_is_written_with_one_call(database):
+    committed = []
+    writer = SubmissionWriter(committed.append, mode="group")
+    submissions = writer._flush([item(username="alice"), item(username="bob")])
+    assert [submission["username"] for submission in submissions] == ["alice", "bob"]
+    assert len(database["groups"]) == 1
+    assert database["rows"] == []
+    assert committed == submissions
+
+
+def test_bad_row_fails_only_itself(database):
+    committed = []
+    writer = SubmissionWriter(committed.append, mode="group")
+    submissions = writer._flush([item(username="alice"), item(BAD_FLAG, "bob"), item(username="carol")])
+    assert isinstance(submissions[1], exceptions.BadRequest)
+    assert [submission["username"] for submission in committed] == ["alice", "carol"]
+    assert len(database["rows"]) == 3
+
+
+def test_committed_durability_raises_the_rows_error(database):
+    writer = SubmissionWriter(lambda submission: None, mode="group", batch_wait=0.01)
+    with pytest.raises(exceptions.BadRequest):
+        writer.write(*item(BAD_FLAG))
+    assert writer.write(*item())["score"] == 10
+
+
+def test_queued_durability_acknowledges_before_the_commit(database, monkeypatch):
+    release = threading.Event()
+    committed = []
+    put_submissions = write_behind.put_submissions
+
+    def slow_put_submissions(items):
+        release.wait(2)
+        return put_submissions(items)
+
+    monkeypatch.setattr(write_behind, "put_submissions", slow_put_submissions)
+    writer = SubmissionWriter(committed.append, mode="group", durability="queued", batch_wait=0.01)
+    assert writer.write(*item())["queued"]
+    assert committed == []
+    release.set()
+    writer._batcher.submit(item(username="bob"), timeout=2)
+    assert [submission["username"] for submission in committed] == ["alice", "bob"]
+
+
+def test_queued_durability_waits_for_the_commit_when_the_queue_is_full(database):
+    writer = SubmissionWriter(lambda submission: None, mode="group", durability="queued", batch_wait=0.01, max_pending=0)
+    assert "queued" not in writer.write(*item())
+
+
+def test_unknown_modes_are_rejected():
+    with pytest.raises(ValueError):
+        SubmissionWriter(lambda submission: None, mode="batch")
+    with pytest.raises(ValueError):
+        SubmissionWriter(lambda submission: None, durability="never")
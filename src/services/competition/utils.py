@@ -1,23 +1,22 @@
-import requests
 from werkzeug import exceptions
 from flask import request
 from functools import wraps
-from flask_jwt_extended import get_jwt
+from flask_jwt_extended import get_jwt, create_access_token
+from datetime import timedelta
+from http_client import ServiceClient
 import os
 
 mode = os.getenv("KUBERNETES_MODE")
 
+# Shared, keep-alive client for every call to the ctf service
+ctf_client = ServiceClient("ctf", "http://service-ctf" if mode == "in-cluster" else "http://localhost:8081")
+
 def get_challenges(competition_ids):
     request_body = {
         "competition_ids": competition_ids
     }
 
-    if mode == "in-cluster":
-        ctf_endpoint = "http://service-ctf/challenges/competitions"
-    else:
-        ctf_endpoint = "http://localhost:8081/challenges/competitions"
-    
-    response = requests.post(ctf_endpoint, json=request_body)
+    response = ctf_client.post("/challenges/competitions", idempotent=True, json=request_body)
     print(response)
     print("response should be printed before this")
     response_body = response.json()
@@ -27,6 +26,63 @@ def get_challenges(competition_ids):
 
     return response_body
 
+def service_authorization():
+    """Short-lived token of the competition service itself, for ctf endpoints no user may call"""
+    token = create_access_token(identity="service-competition", expires_delta=timedelta(minutes=1),
+                                additional_claims={"role": "service"})
+    return {"Authorization": f"Bearer {token}"}
+
+def get_flag_digests(salt, competition_ids):
+    """Salted digests and scores of the flags of every challenge in the competitions"""
+    request_body = {
+        "salt": salt,
+        "competition_ids": competition_ids
+    }
+
+    response = ctf_client.post("/flag-digests", idempotent=True, json=request_body, headers=service_authorization())
+    if response.status_code != 200:
+        raise exceptions.BadGateway("Could not load the flag digests")
+
+    return response.json()
+
+def evaluate_flags(submissions):
+    """Scores of many (challenge_id, flag) pairs in input order, None for challenges that do not exist"""
+    request_body = {
+        "submissions": [{"challenge_id": challenge_id, "flag": flag} for challenge_id, flag in submissions]
+    }
+
+    response = ctf_client.post("/evaluate/batch", idempotent=True, json=request_body)
+    if response.status_code != 200:
+        raise exceptions.BadGateway("Could not evaluate the flags")
+
+    return response.json()["scores"]
+
+def forwarded_authorization():
+    """Authorization header of the current request, for ctf endpoints that act on behalf of the admin calling us"""
+    return {"Authorization": request.headers.get("Authorization", "")}
+
+def teardown_competition(competition_id):
+    """Asks the ctf service to remove every instance of the competition's challenges, returns its job"""
+    response = ctf_client.post("/teardown", idempotent=True, json={"competition_id": str(competition_id)},
+                               headers=forwarded_authorization())
+    if response.status_code in [401, 403]:
+        raise exceptions.Forbidden("The ctf service refused to remove the competition's instances")
+    if response.status_code not in [200, 202]:
+        raise exceptions.BadGateway("The competition was updated, but its instances could not be removed, try again")
+
+    return response.json()
+
+def prepull_competition(competition_id):
+    """Asks the ctf service to pull the images of the competition's challenges onto every node. Best effort,
+    the competition works without it, only the first instance per node starts slower"""
+    try:
+        response = ctf_client.post("/prepull", idempotent=True, json={"competition_id": str(competition_id)},
+                                   headers=forwarded_authorization())
+        if response.status_code != 202:
+            print(f"Pre-pull of competition {competition_id} failed with status {response.status_code}")
+    except Exception as e:
+        print(f"Pre-pull of competition {competition_id} failed: {e}")
+
 def validate_json_fields(fields):
     """Wrapper method to help validate json inputs"""
     def decorator(view_function):
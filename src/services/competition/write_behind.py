@@ -0,0 +1,73 @@
+import os
+from werkzeug import exceptions
+from batching import MicroBatcher
+from database import put_submission, put_submissions
+
+# direct: one insert and commit per submission, group: concurrent submissions share one insert and commit
+SUBMISSION_WRITE_MODE = os.getenv("SUBMISSION_WRITE_MODE", "direct")
+SUBMISSION_BATCH_SIZE = int(os.getenv("SUBMISSION_BATCH_SIZE", "100"))
+SUBMISSION_BATCH_WAIT = float(os.getenv("SUBMISSION_BATCH_WAIT_MS", "10")) / 1000
+# commit: acknowledge once the group is committed, queued: acknowledge once the submission is queued
+SUBMISSION_DURABILITY = os.getenv("SUBMISSION_DURABILITY", "commit")
+# With queued durability, callers wait for the commit instead once this many submissions are pending
+SUBMISSION_MAX_PENDING = int(os.getenv("SUBMISSION_MAX_PENDING", "10000"))
+
+
+class SubmissionWriter:
+    """Write path of submissions, either direct or grouped into one multi-row insert and a single commit.
+
+    on_committed is called with every submission once it is committed, from the thread that committed it.
+    With queued durability a submission is acknowledged before it is committed, and is lost if the process
+    dies first.
+    """
+
+    def __init__(self, on_committed, mode=SUBMISSION_WRITE_MODE, durability=SUBMISSION_DURABILITY,
+                 batch_size=SUBMISSION_BATCH_SIZE, batch_wait=SUBMISSION_BATCH_WAIT, max_pending=SUBMISSION_MAX_PENDING) -> None:
+        if mode not in ["direct", "group"]:
+            raise ValueError(f"Unknown submission write mode {mode}")
+        if durability not in ["commit", "queued"]:
+            raise ValueError(f"Unknown submission durability {durability}")
+        self.mode = mode
+        self.durability = durability
+        self.max_pending = max_pending
+        self._on_committed = on_committed
+        self._batcher = MicroBatcher("submissions", self._flush, batch_size, batch_wait)
+
+    def write(self, username, competition_id, challenge_id, submission_flag, score, admin, valid) -> dict:
+        """Stores the submission, returns it with its timestamp and the new competition score once committed"""
+        item = (username, competition_id, challenge_id, submission_flag, score, admin, valid)
+        if self.mode == "direct":
+            submission = put_submission(*item)
+            self._on_committed(submission)
+            return submission
+
+        future = self._batcher.enqueue(item)
+        if self.durability == "queued" and self._batcher.queued() < self.max_pending:
+            future.add_done_callback(self._log_failure)
+            return {'username': username, 'competition_id': competition_id, 'challenge_id': challenge_id, 'submission_flag': submission_flag, 'score': score, 'admin': admin, 'valid': valid, 'queued': True}
+        return future.result()
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "durability": self.durability, **self._batcher.stats()}
+
+    def _flush(self, items):
+        try:
+            submissions = put_submissions(items)
+        except exceptions.BadRequest:
+            # One bad row fails the whole group, so retry them one by one to fail only that row
+            submissions = []
+            for item in items:
+                try:
+                    submissions.append(put_submission(*item))
+                except Exception as e:
+                    submissions.append(e)
+
+        for submission in submissions:
+            if not isinstance(submission, Exception):
+                self._on_committed(submission)
+        return submissions
+
+    @staticmethod
+    def _log_failure(future):
+        if future.exception() is not None:
+            print(f"Queued submission was not stored: {future.exception()}")
@@ -0,0 +1,303 @@
+import http.client
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ACTIVATOR_PORT = int(os.getenv("ACTIVATOR_PORT", "8082"))
+# Instances without requests for this many seconds are scaled to zero
+ACTIVATOR_IDLE_TIMEOUT = float(os.getenv("ACTIVATOR_IDLE_TIMEOUT", "900"))
+# How long the first request waits for the pod to become ready
+ACTIVATOR_WAKE_TIMEOUT = float(os.getenv("ACTIVATOR_WAKE_TIMEOUT", "60"))
+ACTIVATOR_SWEEP_INTERVAL = float(os.getenv("ACTIVATOR_SWEEP_INTERVAL", "30"))
+ACTIVATOR_PROXY_TIMEOUT = 60
+# Waiting requests are woken by pod events, and check their backend at least this often
+ACTIVATOR_POLL_INTERVAL = 1.0
+# Set by the instance's HTTPRoute, names the instance a request is for as <namespace>/<pod name>
+ACTIVATOR_HEADER = "X-Ctf-Instance"
+
+INSTANCE_KEY = re.compile(r"^[a-z0-9-]+/ctf-[0-9a-f-]{36}-[^/\s]+$")
+# Headers that only apply to one connection, never forwarded
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers", "transfer-encoding", "upgrade"}
+
+
+class Activator:
+    """Proxies requests to scale-to-zero instances, starting their pod on the first request and stopping it when idle.
+
+    The instance's HTTPRoute points at the activator, which stays in the data path. A request for an
+    instance without a ready pod calls scale_up(key) once and is held until backend(key) returns the
+    "host:port" of the ready pod, or wake_timeout passed. An instance without requests for
+    idle_timeout is scaled down with scale_down(key). list_active() returns the keys of the
+    instances that have a pod, so pods started before a restart are scaled down as well. Keys are
+    <namespace>/<pod name>, pods are only unique per namespace. An instance is marked scaling down under the lock requests take, and requests arriving
+    meanwhile wait until present(key) says its pod is gone before starting it again. Without
+    present, the scale down counts as finished once scale_down returns.
+    """
+
+    def __init__(self, scale_up, scale_down, backend, list_active=None, present=None, idle_timeout=ACTIVATOR_IDLE_TIMEOUT,
+                 wake_timeout=ACTIVATOR_WAKE_TIMEOUT, sweep_interval=ACTIVATOR_SWEEP_INTERVAL,
+                 poll_interval=ACTIVATOR_POLL_INTERVAL) -> None:
+        self._scale_up = scale_up
+        self._scale_down = scale_down
+        self._backend = backend
+        self._list_active = list_active
+        self._present = present
+        self.idle_timeout = idle_timeout
+        self.wake_timeout = wake_timeout
+        self.sweep_interval = sweep_interval
+        self.poll_interval = poll_interval
+
+        self._cond = threading.Condition()
+        self._instances = {}
+        self._server = None
+
+        self._proxied = 0
+        self._wakes = 0
+        self._wake_seconds_total = 0.0
+        self._wake_timeouts = 0
+        self._scale_downs = 0
+        self._errors = 0
+
+    def start(self, host="0.0.0.0", port=ACTIVATOR_PORT):
+        """Starts the proxy and the idle sweeper on background threads, returns the bound port"""
+        self._server = ThreadingHTTPServer((host, port), activator_handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="activator", daemon=True).start()
+        threading.Thread(target=self._sweep_forever, name="activator-sweeper", daemon=True).start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def on_pod_event(self, event_type, pod):
+        """Pod informer listener, wakes the requests waiting for a pod"""
+        with self._cond:
+            key = activator_key(pod.metadata.namespace, pod.metadata.name)
+            instance = self._instances.get(key)
+            if event_type == "DELETED" and instance is not None and instance["scaling_down"] == "deleting":
+                self._scaled_down(key, instance)
+            if self._instances:
+                self._cond.notify_all()
+
+    def acquire(self, key) -> str:
+        """Marks a request for the instance in flight and returns its backend, starting the pod if needed"""
+        with self._cond:
+            instance = self._instances.setdefault(key, self._new_instance(time.monotonic()))
+            instance["in_flight"] += 1
+        try:
+            self._wait_for_scale_down(key, instance)
+            return self._wait_for_backend(key, instance)
+        except Exception:
+            self.release(key)
+            raise
+
+    def release(self, key):
+        with self._cond:
+            instance = self._instances.get(key)
+            if instance is not None:
+                instance["in_flight"] -= 1
+                instance["last"] = time.monotonic()
+
+    def sweep(self):
+        """Scales down the instances that have been idle for idle_timeout"""
+        now = time.monotonic()
+        active = set(self._list_active()) if self._list_active is not None else set()
+        idle = []
+        with self._cond:
+            for key in active - set(self._instances):
+                # Seen for the first time, e.g. after a restart, its idle time starts now
+                self._instances[key] = self._new_instance(now)
+            for key, instance in list(self._instances.items()):
+                if instance["in_flight"] == 0 and not instance["waking"] and not instance["scaling_down"] \
+                        and now - instance["last"] >= self.idle_timeout:
+                    # Checked and marked under the lock acquire takes, so no request slips in before the delete
+                    instance["scaling_down"] = "requested"
+                    idle.append((key, instance))
+        for key, instance in idle:
+            try:
+                self._scale_down(key)
+                with self._cond:
+                    self._scale_downs += 1
+                    instance["scaling_down"] = "deleting"
+                    if self._present is None or not self._present(key):
+                        self._scaled_down(key, instance)
+            except Exception as e:
+                print(f"Could not scale down instance {key}: {e}")
+                with self._cond:
+                    self._errors += 1
+                    instance["scaling_down"] = False
+                    instance["last"] = time.monotonic()
+            finally:
+                with self._cond:
+                    self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "tracked": len(self._instances),
+                "in_flight": sum(instance["in_flight"] for instance in self._instances.values()),
+                "proxied": self._proxied,
+                "wakes": self._wakes,
+                "wake_seconds_avg": round(self._wake_seconds_total / self._wakes, 3) if self._wakes else None,
+                "wake_timeouts": self._wake_timeouts,
+                "scale_downs": self._scale_downs,
+                "errors": self._errors,
+            }
+
+    @staticmethod
+    def _new_instance(now) -> dict:
+        return {"in_flight": 0, "last": now, "waking": False, "scaling_down": False}
+
+    def _scaled_down(self, key, instance):
+        """The instance's pod is gone, called with the lock held"""
+        instance["scaling_down"] = False
+        if instance["in_flight"] == 0 and self._instances.get(key) is instance:
+            del self._instances[key]
+
+    def _wait_for_scale_down(self, key, instance):
+        """Holds a request that arrived while its instance was being scaled down until the pod is gone"""
+        deadline = time.monotonic() + self.wake_timeout
+        with self._cond:
+            while instance["scaling_down"]:
+                if instance["scaling_down"] == "deleting" and self._present is not None and not self._present(key):
+                    self._scaled_down(key, instance)
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._wake_timeouts += 1
+                    raise TimeoutError(f"Instance {key} is still being scaled down")
+                self._cond.wait(min(remaining, self.poll_interval))
+
+    def _wait_for_backend(self, key, instance):
+        backend = self._backend(key)
+        if backend is not None:
+            return backend
+
+        with self._cond:
+            # Only the first of the concurrent requests starts the pod
+            first = not instance["waking"]
+            instance["waking"] = True
+        start = time.monotonic()
+        try:
+            if first:
+                self._scale_up(key)
+            deadline = start + self.wake_timeout
+            while True:
+                backend = self._backend(key)
+                if backend is not None:
+                    if first:
+                        with self._cond:
+                            self._wakes += 1
+                            self._wake_seconds_total += time.monotonic() - start
+                    return backend
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._cond:
+                        self._wake_timeouts += 1
+                    raise TimeoutError(f"Instance {key} did not become ready within {self.wake_timeout}s")
+                with self._cond:
+                    self._cond.wait(min(remaining, self.poll_interval))
+        finally:
+            if first:
+                with self._cond:
+                    instance["waking"] = False
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Activator sweeper error: {e}")
+
+    def _counted(self, name):
+        with self._cond:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def activator_key(namespace, name) -> str:
+    """Key of the instance whose pod has the name in the namespace"""
+    return namespace + "/" + name
+
+
+def parse_activator_key(key):
+    """(namespace, pod name) of an activator key"""
+    return tuple(key.split("/", 1))
+
+
+def activator_handler(activator):
+    """Request handler class proxying to the activator's backends"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_request(self):
+            key = self.headers.get(ACTIVATOR_HEADER, "")
+            if not INSTANCE_KEY.match(key):
+                self._reply(404, b"Unknown instance")
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else None
+
+            try:
+                backend = activator.acquire(key)
+            except TimeoutError:
+                self._reply(504, b"The instance is still starting, try again", {"Retry-After": "5"})
+                return
+            except Exception as e:
+                print(f"Could not start instance {key}: {e}")
+                activator._counted("_errors")
+                self._reply(502, b"The instance could not be started")
+                return
+
+            started = False
+            try:
+                host, port = backend.rsplit(":", 1)
+                connection = http.client.HTTPConnection(host, int(port), timeout=ACTIVATOR_PROXY_TIMEOUT)
+                headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP}
+                connection.request(self.command, self.path, body=body, headers=headers)
+                response = connection.getresponse()
+
+                # The body is streamed as it arrives, the end of it is marked by closing the connection
+                self.send_response(response.status, response.reason)
+                for name, value in response.getheaders():
+                    if name.lower() not in HOP_BY_HOP and name.lower() != "content-length":
+                        self.send_header(name, value)
+                self.send_header("Connection", "close")
+                self.end_headers()
+                started = True
+                while chunk := response.read(64 * 1024):
+                    self.wfile.write(chunk)
+                connection.close()
+                activator._counted("_proxied")
+            except (OSError, http.client.HTTPException) as e:
+                print(f"Could not proxy to instance {key}: {e}")
+                activator._counted("_errors")
+                if not started:
+                    self._reply(502, b"The instance did not answer")
+            finally:
+                self.close_connection = True
+                activator.release(key)
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = do_OPTIONS = do_request
+
+        def _reply(self, status, body, headers=None):
+            try:
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(body)
+            except OSError:
+                pass
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
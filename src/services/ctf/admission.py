@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+from kubernetes.utils.quantity import parse_quantity
+from werkzeug import exceptions
+
+# 0 disables a quota
+MAX_INSTANCES_PER_USER = int(os.getenv("MAX_INSTANCES_PER_USER", "3"))
+MAX_INSTANCES_PER_COMPETITION = int(os.getenv("MAX_INSTANCES_PER_COMPETITION", "0"))
+# Share of every node's allocatable kept free for everything that is not a challenge pod
+ADMISSION_HEADROOM = float(os.getenv("ADMISSION_HEADROOM", "0.1"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "15"))
+ADMISSION_NODE_REFRESH = float(os.getenv("ADMISSION_NODE_REFRESH", "30"))
+# An admitted instance is counted until its pod shows up in the informer, or this many seconds passed
+ADMISSION_RESERVATION_TTL = 60
+
+
+def resource_requests(resources) -> tuple:
+    """(cpu cores, memory bytes) a container with these resources requests, limits stand in for missing requests"""
+    resources = resources or {}
+    requests = resources.get("requests") or {}
+    limits = resources.get("limits") or {}
+    cpu = requests.get("cpu", limits.get("cpu", 0))
+    memory = requests.get("memory", limits.get("memory", 0))
+    return float(parse_quantity(cpu)), float(parse_quantity(memory))
+
+
+def pod_requests(pod) -> tuple:
+    """(cpu cores, memory bytes) requested by all containers of the pod"""
+    cpu, memory = 0.0, 0.0
+    for container in pod.spec.containers:
+        resources = container.resources
+        container_cpu, container_memory = resource_requests({
+            "requests": resources.requests if resources is not None else None,
+            "limits": resources.limits if resources is not None else None,
+        })
+        cpu += container_cpu
+        memory += container_memory
+    return cpu, memory
+
+
+def tolerates(toleration, taint) -> bool:
+    """Whether a toleration, as in a pod manifest, tolerates the node's taint"""
+    if toleration.get("effect") and toleration["effect"] != taint.effect:
+        return False
+    if toleration.get("operator") == "Exists":
+        return not toleration.get("key") or toleration["key"] == taint.key
+    return toleration.get("key") == taint.key and (toleration.get("value") or None) == (taint.value or None)
+
+
+def schedulable(node, node_selector=None, tolerations=()) -> bool:
+    """Whether pods with the nodeSelector and tolerations can be scheduled on the node"""
+    if node.spec.unschedulable:
+        return False
+    labels = node.metadata.labels or {}
+    if any(labels.get(key) != value for key, value in (node_selector or {}).items()):
+        return False
+    for taint in node.spec.taints or []:
+        if taint.effect in ["NoSchedule", "NoExecute"] and not any(tolerates(toleration, taint) for toleration in tolerations):
+            return False
+    return any(condition.type == "Ready" and condition.status == "True" for condition in node.status.conditions or [])
+
+
+def pool_key(node_selector) -> tuple:
+    """Pods with the same nodeSelector compete for the same nodes"""
+    return tuple(sorted((node_selector or {}).items()))
+
+
+class Admission:
+    """Admits new instances only within the per-user and per-competition quotas and the free cluster capacity.
+
+    Usage is accounted from the pods the informer sees, per node and per user, plus reservations of
+    admitted instances whose pod does not exist yet. list_pods and list_nodes return Kubernetes pod
+    and node objects, which keeps the accounting testable against fake clusters. Capacity is counted
+    on the nodes an instance's nodeSelector and tolerations let it run on, and unscheduled pods only
+    count against the nodes of their own nodeSelector. Quota violations raise 429 and missing
+    capacity 503, both with Retry-After.
+    """
+
+    def __init__(self, list_pods, list_nodes, max_per_user=MAX_INSTANCES_PER_USER,
+                 max_per_competition=MAX_INSTANCES_PER_COMPETITION, headroom=ADMISSION_HEADROOM,
+                 retry_after=ADMISSION_RETRY_AFTER, node_refresh=ADMISSION_NODE_REFRESH) -> None:
+        self._list_pods = list_pods
+        self._list_nodes = list_nodes
+        self.max_per_user = max_per_user
+        self.max_per_competition = max_per_competition
+        self.headroom = headroom
+        self.retry_after = retry_after
+        self.node_refresh = node_refresh
+
+        self._lock = threading.Lock()
+        self._nodes = []
+        self._nodes_at = None
+        self._reservations = {}
+
+        self._admitted = 0
+        self._rejected_quota = 0
+        self._rejected_capacity = 0
+
+    def admit(self, username, challenge_id, competition_id, resources, needs_capacity=True, node_selector=None, tolerations=()):
+        """Reserves room for the instance on the nodes it may run on, or raises when it does not fit"""
+        nodes = self._current_nodes()
+        requested = resource_requests(resources)
+        with self._lock:
+            usage = self.usage(nodes, node_selector, tolerations)
+            key = "ctf-" + str(challenge_id) + "-" + username
+
+            if self.max_per_user and usage["users"].get(username, 0) >= self.max_per_user:
+                self._rejected_quota += 1
+                raise exceptions.TooManyRequests(
+                    f"You already have {self.max_per_user} instances open, close one first",
+                    retry_after=self.retry_after,
+                )
+            if competition_id is not None and self.max_per_competition \
+                    and usage["competitions"].get(str(competition_id), 0) >= self.max_per_competition:
+                self._rejected_quota += 1
+                raise exceptions.TooManyRequests(
+                    "The competition has reached its number of open instances, try again later",
+                    retry_after=self.retry_after,
+                )
+            if needs_capacity and not self._fits(usage, requested):
+                self._rejected_capacity += 1
+                raise exceptions.ServiceUnavailable(
+                    "The cluster is out of capacity for this challenge, try again later",
+                    retry_after=self.retry_after,
+                )
+
+            self._reservations[key] = {
+                "username": username,
+                "competition_id": str(competition_id) if competition_id is not None else None,
+                "requests": requested if needs_capacity else (0.0, 0.0),
+                "pool": pool_key(node_selector),
+                "expires": time.monotonic() + ADMISSION_RESERVATION_TTL,
+            }
+            self._admitted += 1
+
+    def release(self, username, challenge_id):
+        """Drops the reservation of an instance that will not be created after all"""
+        with self._lock:
+            self._reservations.pop("ctf-" + str(challenge_id) + "-" + username, None)
+
+    def usage(self, nodes, node_selector=None, tolerations=()) -> dict:
+        """Requested resources per node the pods may run on, instances per user and competition, and what is still unscheduled"""
+        pool = pool_key(node_selector)
+        free = {}
+        for node in nodes:
+            if schedulable(node, node_selector, tolerations):
+                allocatable = node.status.allocatable or {}
+                free[node.metadata.name] = [
+                    float(parse_quantity(allocatable.get("cpu", 0))) * (1 - self.headroom),
+                    float(parse_quantity(allocatable.get("memory", 0))) * (1 - self.headroom),
+                ]
+        users, competitions = {}, {}
+        pending = [0.0, 0.0]
+        seen = set()
+
+        for pod in self._list_pods():
+            if pod.status is not None and pod.status.phase in ["Failed", "Succeeded"]:
+                continue
+            labels = pod.metadata.labels or {}
+            cpu, memory = pod_requests(pod)
+            if pod.spec.node_name in free:
+                free[pod.spec.node_name][0] -= cpu
+                free[pod.spec.node_name][1] -= memory
+            elif not pod.spec.node_name and pool_key(pod.spec.node_selector) == pool:
+                pending[0] += cpu
+                pending[1] += memory
+            # Pods on their way out no longer count against quotas, unclaimed warm pods never do
+            if pod.metadata.deletion_timestamp is not None or "username" not in labels:
+                continue
+            users[labels["username"]] = users.get(labels["username"], 0) + 1
+            if "competition_id" in labels:
+                competitions[labels["competition_id"]] = competitions.get(labels["competition_id"], 0) + 1
+            seen.add(labels.get("ctf-id-username"))
+
+        now = time.monotonic()
+        for key, reservation in list(self._reservations.items()):
+            if key in seen or reservation["expires"] < now:
+                del self._reservations[key]
+                continue
+            users[reservation["username"]] = users.get(reservation["username"], 0) + 1
+            if reservation["competition_id"] is not None:
+                competitions[reservation["competition_id"]] = competitions.get(reservation["competition_id"], 0) + 1
+            if reservation["pool"] == pool:
+                pending[0] += reservation["requests"][0]
+                pending[1] += reservation["requests"][1]
+
+        return {"free": free, "pending": pending, "users": users, "competitions": competitions}
+
+    def stats(self) -> dict:
+        with self._lock:
+            usage = self.usage(self._nodes)
+            return {
+                "nodes": len(usage["free"]),
+                "free_cpu": round(sum(cpu for cpu, _ in usage["free"].values()) - usage["pending"][0], 3),
+                "free_memory": int(sum(memory for _, memory in usage["free"].values()) - usage["pending"][1]),
+                "reservations": len(self._reservations),
+                "admitted": self._admitted,
+                "rejected_quota": self._rejected_quota,
+                "rejected_capacity": self._rejected_capacity,
+            }
+
+    @staticmethod
+    def _fits(usage, requested) -> bool:
+        """Some node has room for the pod, and the whole cluster still has room once pending pods are placed"""
+        cpu, memory = requested
+        if not any(free_cpu >= cpu and free_memory >= memory for free_cpu, free_memory in usage["free"].values()):
+            return False
+        total_cpu = sum(free_cpu for free_cpu, _ in usage["free"].values()) - usage["pending"][0]
+        total_memory = sum(free_memory for _, free_memory in usage["free"].values()) - usage["pending"][1]
+        return total_cpu >= cpu and total_memory >= memory
+
+    def _current_nodes(self):
+        """Nodes change rarely, so they are listed at most once per node_refresh"""
+        with self._lock:
+            if self._nodes_at is not None and time.monotonic() - self._nodes_at < self.node_refresh:
+                return self._nodes
+        nodes = self._list_nodes()
+        with self._lock:
+            self._nodes = nodes
+            self._nodes_at = time.monotonic()
+        return nodes
@@ -1,15 +1,24 @@
 import os
-from datetime import datetime, timezone
 from flask import Flask, request, jsonify
-from flask_apscheduler import APScheduler
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, get_jwt
 from werkzeug import exceptions
 from waitress import serve
 from models import Challenge
 from database import *
+from pool import WAITRESS_THREADS
 from kubernetes import client, utils
 import kubernetes
 from utils import *
+from provisioning import Provisioner
+from warm_pool import WarmPool, is_ready
+from reaper import Reaper
+from admission import Admission
+from reconciler import Reconciler
+from readiness import ReadinessTracker, READY_POLL_TIMEOUT
+from teardown import Teardown, teardown_selectors
+from activator import Activator, activator_key, parse_activator_key
+from prepull import PrePuller
+from namespaces import Namespaces, namespace_for
 import json
 import ast
 from flask_cors import CORS
@@ -21,7 +30,6 @@ app = Flask(__name__)
 
 CORS(app)
 
-scheduler = APScheduler()
 def read_secret(secret_name):
     with open(f"/var/secrets/{secret_name}.txt", "r") as f:
         return f.readline()
@@ -39,72 +47,269 @@ app.config['JWT_TOKEN_LOCATION'] = ['headers']
 # JWT Initialization
 jwt = JWTManager(app)
 
-@scheduler.task('interval', id='stop_test_instances', seconds=10)
-def stop_test_instances():
-    """Stops test instances which have been running for more than 10 minutes"""
-    # TODO add the checking of the time ran of the kubernetes challenge-test instances.
-    print("Running scheduled job")
-    load_kubernetes_config()
-    v1 = client.CoreV1Api()
-    custom_client = client.CustomObjectsApi()
-    result = v1.list_namespaced_pod( "project", label_selector="mode=test",watch=False)
-    for pod in result.items:
-        status = pod.status.phase    
-        container_status = pod.status.container_statuses[0]
-        difference = datetime.now(timezone.utc) - container_status.state.running.started_at
-        if container_status.started is False or container_status.ready is False:
-            waiting_state = container_status.state.waiting
-            if waiting_state.message is not None and 'Error' in waiting_state.message:
-                status = waiting_state.reason
-                difference = datetime.now(timezone.utc) - datetime.now(timezone.utc)
-                #Calculate actual age
-        if difference.total_seconds() > 600:
-            print("terminating" + pod.metadata.name + "and service and route")
-            #Generating the correct names
-            namespace = "project"
-            pod_name = pod.metadata.name
-            service_name = "svc-" + pod_name[4:]
-            route_name = "rt-" + pod_name[4:]
-            print(pod_name)
-            print(service_name)
-            print(route_name)
-            
-            # Delete the Pod
-            try:
-                v1.delete_namespaced_pod(pod_name, namespace)
-            except kubernetes.client.exceptions.ApiException as e:
-                if e.status == 404:
-                    print(f"Pod {pod_name} not found.")
-                else:
-                    raise e
-
-            # Delete the Service
-            try:
-                v1.delete_namespaced_service(service_name, namespace)
-            except kubernetes.client.exceptions.ApiException as e:
-                if e.status == 404:
-                    print(f"Service {service_name} not found.")
-                else:
-                    raise e
-
-            # Delete the HTTPRoute
+# Instances are created off the request threads, by a bounded pool of workers
+provisioner = Provisioner()
+
+# Namespaces of the competitions' instances, created on demand with limits derived from their challenges
+namespaces = Namespaces(applier.apply, delete_namespace, list_namespaces, lambda competition_id: read_challenges_from_competitions((competition_id,)))
+
+def ensure_namespace(competition_id, mode):
+    """Creates the namespace of the competition's instances in the mode when needed, returns its name.
+    The test namespace is shared by every competition, so it is not sized from one"""
+    return namespaces.ensure(namespace_for(competition_id, mode), competition_id if mode != "test" else None)
+
+def generate_warm_pod(challenge, resources):
+    """Warm pod manifest in the namespace its challenge's instances are opened in"""
+    namespace = ensure_namespace(challenge.competition_id, "production")
+    return generate_warm_pod_dict(challenge.id, challenge.image_url, resources, challenge.name, namespace, challenge.placement)
+
+def refresh_namespace(competition_id):
+    """The limits of a competition's namespace are derived from its challenges, they are applied again on next use"""
+    if competition_id is not None:
+        namespaces.refresh(namespace_for(competition_id, "production"))
+
+def instance_namespace(challenge_id, username):
+    """Namespace of the user's instance of the challenge, from its pod or else from its record"""
+    if NAMESPACE_MODE != "per-competition":
+        return DEFAULT_NAMESPACE
+    for pod in pod_informer.by_username(username):
+        if (pod.metadata.labels or {}).get("challenge_id") == str(challenge_id):
+            return pod.metadata.namespace
+    instance = next((instance for instance in read_instances(username) if str(instance["challenge_id"]) == str(challenge_id)), None)
+    return namespace_for(instance["competition_id"], instance["mode"]) if instance is not None else DEFAULT_NAMESPACE
+
+# Pre-started instances of the challenges with warm_pool_min/warm_pool_max set
+warm_pool = WarmPool(pod_informer, kube.core, read_warm_pool_challenges, generate_warm_pod)
+
+# Instance quotas and cluster capacity, accounted from the pod informer
+admission = Admission(pod_informer.list, lambda: kube.core().list_node().items)
+
+def expire_instance(challenge_id, username, namespace, mode):
+    """Deletes the objects of the expired instance in its namespace, and its record if it is of the same mode"""
+    delete_instance(challenge_id, username, namespace)
+    remove_instances_matching([challenge_id], username, mode)
+
+# Deletes instances whose mode's TTL has passed, fed by the pod informer
+reaper = Reaper(expire_instance)
+pod_informer.add_listener(reaper.on_pod_event)
+
+# Wakes /instances/<challenge_id>/ready long-polls and marks instances ready as their pods become Ready.
+# Long-polls hold a request thread, so half of them are left for everything else
+readiness = ReadinessTracker(pod_informer, set_instances_state, max(WAITRESS_THREADS // 2, 1))
+pod_informer.add_listener(readiness.on_pod_event)
+
+def instance_manifests(username, challenge, mode):
+    """Pod, Service and HTTPRoute manifests of the user's instance of the challenge"""
+    resources = ast.literal_eval(challenge.resource_limits)
+    namespace = namespace_for(challenge.competition_id, mode)
+    pod_dict = generate_pod_dict(challenge.id, username, challenge.image_url, resources["resources"], mode, challenge.name, challenge.competition_id, namespace, challenge.placement)
+    service_dict = generate_service_dict(challenge.id, username, mode, challenge.name, namespace)
+    if challenge.instance_mode == "scale-to-zero":
+        pod_dict["metadata"]["labels"]["instance_mode"] = "scale-to-zero"
+        route_dict = generate_activated_route_dict(challenge.id, username, mode, challenge.name, namespace)
+    else:
+        route_dict = generate_route_dict(challenge.id, username, mode, challenge.name, namespace)
+    return pod_dict, service_dict, route_dict
+
+def in_namespace(challenge, mode, create):
+    """Step create that makes sure the instance's namespace exists first, in the interactive lane since a user waits for it"""
+    def run():
+        with kube_limiter.lane("interactive"):
+            ensure_namespace(challenge.competition_id, mode)
+            return create()
+    return run
+
+def provision_instance(username, challenge, mode):
+    """Records and admits the instance and queues the creation of its pod, Service and HTTPRoute, progress is at /jobs/<job_id>.
+    Returns None when the user has an instance of the challenge already"""
+    # The record is inserted atomically and counts the quotas, so concurrent opens cannot open it twice or exceed them
+    if not put_instance(username, challenge.id, challenge.competition_id, mode, reaper.ttls.get(mode),
+                        admission.max_per_user, admission.max_per_competition):
+        return None
+
+    def failed():
+        admission.release(username, challenge.id)
+        remove_instances([(username, challenge.id)])
+
+    claimed_pod = None
+    try:
+        # Check that the cluster can fit it. A pre-started pod from the warm pool skips scheduling, image pull and
+        # container start, and needs no new capacity. Scale-to-zero instances start without a pod, so they need no capacity yet either
+        resources = ast.literal_eval(challenge.resource_limits)
+        warm = mode == "production" and (challenge.warm_pool_min > 0 or challenge.warm_pool_max > 0) and challenge.instance_mode == "per-user"
+        namespace = namespace_for(challenge.competition_id, mode)
+        admission.admit(username, challenge.id, challenge.competition_id, resources["resources"],
+                        needs_capacity=not (warm and warm_pool.available(challenge.id, namespace)) and challenge.instance_mode != "scale-to-zero",
+                        **node_placement(challenge.placement))
+        claimed_pod = warm_pool.claim(challenge.id, username, challenge.competition_id, namespace) if warm else None
+
+        steps = [
+            (name, in_namespace(challenge, mode, create), delete)
+            for name, create, delete in instance_steps(*instance_manifests(username, challenge, mode), claimed_pod,
+                                                       scaled_to_zero=challenge.instance_mode == "scale-to-zero")
+        ]
+        job = provisioner.submit(username, challenge.id, mode, steps, on_failed=failed,
+                                 on_succeeded=lambda: set_instances_state([(username, challenge.id)], "running"))
+    except Exception:
+        # No job was queued, so nothing else rolls back the record or the reservation, and the
+        # reconciler would otherwise create an instance the user was told could not be opened
+        failed()
+        if claimed_pod is not None:
+            # Already relabelled for the user, the warm pool replaces it
             try:
-                custom_client.delete_namespaced_custom_object(
-                    group="gateway.networking.k8s.io",
-                    version="v1",
-                    namespace=namespace,
-                    plural="httproutes",
-                    name=route_name,
-                )
-            except kubernetes.client.exceptions.ApiException as e:
-                if e.status == 404:
-                    print(f"HTTPRoute {route_name} not found.")
-                else:
-                    raise e
-        
-        print(pod.metadata.name + " " + status + " " + str(container_status.state.running.started_at) + " age:" + str(difference.total_seconds()))
-
-    return ""
+                delete_object("pod", claimed_pod, namespace)
+            except Exception as e:
+                print(f"Could not delete the claimed pod {claimed_pod}: {e}")
+        raise
+    readiness.opened(challenge.id, username)
+    return job
+
+def already_open(username, challenge_id):
+    """Response to a repeated open, the instance that is open already and the state of its job"""
+    instance = read_instance(username, challenge_id)
+    if instance is None:
+        # Closed in the meantime, the client may simply open it again
+        raise exceptions.Conflict(f"Challenge {challenge_id} was closed while being opened, try again")
+    job = provisioner.latest(username, challenge_id)
+    return {
+        "message": "Challenge is already open",
+        "instance": instance,
+        "job_id": job["id"] if job is not None else None,
+        "status": job["status"] if job is not None else instance["state"],
+    }, 200
+
+def repair_instance(instance, kinds):
+    """Creates the missing objects of a recorded instance again"""
+    challenge = read_challenge(instance["challenge_id"])
+    manifests = dict(zip(["pod", "service", "route"], instance_manifests(instance["username"], challenge, instance["mode"])))
+    ensure_namespace(challenge.competition_id, instance["mode"])
+    # The pods of scale-to-zero instances are started by the activator, not repaired
+    for name, create, _ in instance_steps(*manifests.values(), scaled_to_zero=challenge.instance_mode == "scale-to-zero"):
+        if name in kinds:
+            manifest = manifests[name]
+            # The object is gone, so its cached hash is stale
+            applier.forget(manifest["kind"], manifest["metadata"]["namespace"], manifest["metadata"]["name"])
+            create()
+
+def ensure_shared_instance(challenge):
+    """Applies the Deployment, Service and HTTPRoute of a shared challenge, unchanged ones cost no call"""
+    resources = ast.literal_eval(challenge.resource_limits)
+    for manifest in generate_shared_manifests(challenge.id, challenge.image_url, resources["resources"], challenge.name, challenge.shared_replicas, challenge.placement):
+        applier.apply(manifest)
+
+def sync_shared_challenge(challenge):
+    """Starts the shared instance of a shared challenge, or removes it from a challenge that is per-user now. Best effort, /open applies it again"""
+    try:
+        if challenge.instance_mode == "shared":
+            ensure_shared_instance(challenge)
+            return
+        if not any((pod.metadata.labels or {}).get("instance_mode") == "shared" for pod in pod_informer.by_challenge(challenge.id)):
+            return
+        for manifest in generate_shared_manifests(challenge.id, challenge.image_url, {}, challenge.name, 0):
+            applier.forget(manifest["kind"], manifest["metadata"]["namespace"], manifest["metadata"]["name"])
+        for kind in ["route", "service", "deployment"]:
+            delete_collection(kind, f"challenge_id={challenge.id},instance_mode=shared")
+    except Exception as e:
+        print(f"Could not sync the shared instance of challenge {challenge.id}: {e}")
+
+# Pulls challenge images onto every node before the first player opens them
+prepuller = PrePuller(applier.apply, delete_prepull, observe_prepull, list_prepulls)
+
+def prepull_images(challenges):
+    """Starts pre-pulling the images of the challenges. Best effort, without it the first /open per node pulls the image"""
+    for image in {challenge.image_url for challenge in challenges}:
+        try:
+            prepuller.submit(image)
+        except Exception as e:
+            print(f"Could not pre-pull {image}: {e}")
+
+def prepull_report(challenges):
+    """Pre-pull state of the challenges' images per node, warm once every image is on every node"""
+    images = {}
+    for challenge in challenges:
+        images.setdefault(challenge.image_url, []).append(str(challenge.id))
+    statuses = [{**prepuller.status(image), "challenge_ids": challenge_ids} for image, challenge_ids in images.items()]
+    return {"warm": all(status["status"] == "pulled" for status in statuses), "images": statuses}
+
+def wake_instance(key):
+    """Starts the pod of a recorded scale-to-zero instance"""
+    namespace, name = parse_activator_key(key)
+    challenge_id, username = parse_instance_key(name)
+    instance = next((instance for instance in read_instances(username) if str(instance["challenge_id"]) == challenge_id), None)
+    # A route left behind in another namespace must not start the instance that replaced it
+    if instance is None or namespace_for(instance["competition_id"], instance["mode"]) != namespace:
+        raise exceptions.NotFound(f"Instance {key} is not open")
+    challenge = read_challenge(challenge_id)
+    pod_dict = instance_manifests(username, challenge, instance["mode"])[0]
+    pod = pod_informer.get(name, namespace)
+    if pod is not None and pod.metadata.deletion_timestamp is None:
+        return
+    ensure_namespace(challenge.competition_id, instance["mode"])
+    applier.forget(pod_dict["kind"], pod_dict["metadata"]["namespace"], pod_dict["metadata"]["name"])
+    applier.apply(pod_dict)
+
+def activated_pod(key):
+    """Pod of the scale-to-zero instance with the activator key, only in the key's namespace"""
+    namespace, name = parse_activator_key(key)
+    return pod_informer.get(name, namespace)
+
+def instance_backend(key):
+    """Address of the instance's pod once it is ready, straight to the pod since the Service's endpoints lag behind readiness"""
+    pod = activated_pod(key)
+    if pod is None or pod.metadata.deletion_timestamp is not None or not is_ready(pod) or not pod.status.pod_ip:
+        return None
+    return pod.status.pod_ip + ":8080"
+
+def scale_down_instance(key):
+    pod = activated_pod(key)
+    if pod is not None:
+        delete_object("pod", pod.metadata.name, pod.metadata.namespace)
+
+# Starts the pods of scale-to-zero instances on their first request and deletes them when idle
+activator = Activator(
+    scale_up=kube_limiter.in_lane("interactive", wake_instance),
+    scale_down=scale_down_instance,
+    backend=instance_backend,
+    list_active=lambda: [activator_key(pod.metadata.namespace, pod.metadata.name) for pod in pod_informer.list()
+                         if (pod.metadata.labels or {}).get("instance_mode") == "scale-to-zero" and pod.metadata.deletion_timestamp is None],
+    present=lambda key: activated_pod(key) is not None,
+)
+pod_informer.add_listener(activator.on_pod_event)
+
+def delete_collection_everywhere(kind, label_selector):
+    """deletecollection in every namespace that may hold instances, the call cannot span namespaces"""
+    for namespace in namespaces.names():
+        delete_collection(kind, label_selector, namespace)
+
+# Removes the instances of whole challenges, competitions or users with a few deletecollection calls
+teardown = Teardown(delete_collection_everywhere, lambda scope: remove_instances_matching(**scope), namespaces.delete)
+
+def start_teardown(requested_by, challenge_ids=None, username=None, mode=None, competition_id=None):
+    """Queues the removal of the matching instances, progress is at /jobs/<job_id>.
+    The production instances of a whole competition go with its namespace, when it has one"""
+    challenge_ids = [str(challenge_id) for challenge_id in challenge_ids] if challenge_ids else None
+    scope = {"challenge_ids": challenge_ids, "username": username, "mode": mode}
+    whole = [] if competition_id is None or username is not None or mode == "test" else [namespace_for(competition_id, "production")]
+    # Bulk deletions bypass forget(), so every cached hash and route shard assignment is dropped afterwards
+    return teardown.submit(requested_by, scope, teardown_selectors(challenge_ids, username, mode), on_done=after_teardown,
+                           namespaces=[namespace for namespace in whole if namespace != DEFAULT_NAMESPACE])
+
+def after_teardown():
+    applier.clear()
+    route_shards.reset()
+
+# Keeps the cluster in line with the instances table
+reconciler = Reconciler(
+    pod_informer,
+    read=read_instances_for_reconcile,
+    list_objects=list_instance_objects,
+    repair=repair_instance,
+    delete_object=delete_object,
+    expire=lambda instance: expire_instance(
+        instance["challenge_id"], instance["username"], namespace_for(instance["competition_id"], instance["mode"]), instance["mode"]),
+    mark=set_instances_state,
+    adopt=adopt_instances,
+)
 
 
 @app.get("/")
@@ -143,12 +348,19 @@ def create_challenge(file):
         False,
         False,
         data["image_url"],
-        None
+        None,
+        int(file.get("warm_pool_min", 0)),
+        int(file.get("warm_pool_max", 0)),
+        validate_instance_mode(file.get("instance_mode", "per-user")),
+        int(file.get("shared_replicas", 2)),
+        validate_placement(file.get("placement", "default"))
     )
     #except:
     #    raise exceptions.BadRequest("Error reading .yaml config")
 
     insert_challenge(challenge)
+    sync_shared_challenge(challenge)
+    prepull_images([challenge])
 
     return (
         f"Challenge with id '{challenge.id}' and name '{challenge.name}' created successfully",
@@ -217,12 +429,21 @@ def put_challenge(challenge_id, file):
         False,
         False,
         data["image_url"],
-        None
+        None,
+        int(conf.get("warm_pool_min", 0)),
+        int(conf.get("warm_pool_max", 0)),
+        validate_instance_mode(conf.get("instance_mode", "per-user")),
+        int(conf.get("shared_replicas", 2)),
+        validate_placement(conf.get("placement", "default"))
     )
     # except:
     #    raise exceptions.BadRequest("Error reading yaml configuration")
 
     update_challenge(challenge)
+    notify_challenges_changed([challenge_id])
+    sync_shared_challenge(challenge)
+    prepull_images([challenge])
+    refresh_namespace(read_challenge(challenge_id).competition_id)
 
     return f"Challenge with id '{challenge_id}' updated successfully", 200
 
@@ -231,14 +452,25 @@ def put_challenge(challenge_id, file):
 def patch_challenge(challenge_id):
     """Used to update only some of the fields in Challenges"""
     data = request.get_json(silent=True) or {}
-    valid_fields = ['name', 'description', 'category', 'difficulty', 'flag_format', 'author', 'flag', 'resource_limits', 'score', 'image_url']
+    valid_fields = ['name', 'description', 'category', 'difficulty', 'flag_format', 'author', 'flag', 'resource_limits', 'score', 'image_url', 'warm_pool_min', 'warm_pool_max', 'instance_mode', 'shared_replicas', 'placement']
     
     for f in data.keys():
         if f not in valid_fields:
             raise exceptions.BadRequest(f"{f} not a valid field")
+    if "instance_mode" in data:
+        validate_instance_mode(data["instance_mode"])
+    if "placement" in data:
+        validate_placement(data["placement"])
     
     try:
         patch_update_challenge(challenge_id, data)
+        notify_challenges_changed([challenge_id])
+        if "instance_mode" in data or "shared_replicas" in data or "image_url" in data or "resource_limits" in data or "placement" in data:
+            sync_shared_challenge(read_challenge(challenge_id))
+        if "image_url" in data:
+            prepull_images([read_challenge(challenge_id)])
+        if "resource_limits" in data or "warm_pool_min" in data or "warm_pool_max" in data:
+            refresh_namespace(read_challenge(challenge_id).competition_id)
         return f"Challenge with id {challenge_id} patched successfully", 200
     except exceptions.NotFound:
         raise exceptions.NotFound(f"Challenge with id {challenge_id} not found")
@@ -251,7 +483,9 @@ def delete_challenge(challenge_id):
     """Deletes Challenge with given id, incl. all active instances!"""
     try:
         remove_challenge(challenge_id)
-        return f"Challenge with id {challenge_id} deleted successfully", 200
+        notify_challenges_changed([challenge_id])
+        job = start_teardown(get_jwt_identity(), [challenge_id])
+        return f"Challenge with id {challenge_id} deleted successfully, its instances are removed by job {job['id']}", 200
     except exceptions.NotFound:
         raise exceptions.NotFound(f"Challenge with id {challenge_id} not found")
 
@@ -265,30 +499,56 @@ def open_challenge(challenge_id):
     username = get_jwt_identity()
     challenge = read_challenge(challenge_id)
 
-    # Check the namespace of that idenfier
-    load_kubernetes_config()
+    # Everyone plays a shared challenge on the same instance, there is nothing to open per user
+    if challenge.instance_mode == "shared":
+        ensure_shared_instance(challenge)
+        return {"message": "Challenge is shared", "url": shared_url(challenge_id), "job_id": None, "status": "succeeded"}, 200
 
-    # Check that the user does not have to many instances running.
-    k8s_client = client.ApiClient()
-    DYNAMIC_CLIENT = kubernetes.dynamic.DynamicClient(
-        kubernetes.client.api_client.ApiClient()
-    )
+    job = provision_instance(username, challenge, "production")
+    if job is None:
+        return already_open(username, challenge_id)
 
-    resources = ast.literal_eval(challenge.resource_limits)
+    return {"message": "Challenge is being opened", "job_id": job["id"], "status": job["status"]}, 202
 
-    # Create the pod
-    pod_dict = generate_pod_dict(challenge_id, username, challenge.image_url, resources["resources"], "production", challenge.name)
-    utils.create_from_dict(k8s_client, pod_dict)
 
-    # Create the Service for the Pod
-    service_dict = generate_service_dict(challenge_id, username, "production", challenge.name)
-    utils.create_from_dict(k8s_client, service_dict)
+@app.get("/instances")
+@jwt_required()
+def get_instances():
+    """The recorded instances of the given user, if admin of all users"""
+    claims = get_jwt()
+    return read_instances(None if claims["role"] == "admin" else get_jwt_identity()), 200
 
-    # Create the HTTPRoute
-    route_dict = generate_route_dict(challenge_id, username, "production", challenge.name)
-    apply_simple_item(DYNAMIC_CLIENT, route_dict)
 
-    return "Challenge is opened", 200
+@app.get("/instances/<challenge_id>/ready")
+@jwt_required()
+def wait_instance_ready(challenge_id):
+    """Returns as soon as the user's instance of the challenge is ready, or after ?timeout= seconds (30 by default, at most 60)"""
+    try:
+        timeout = float(request.args.get("timeout", READY_POLL_TIMEOUT))
+    except ValueError:
+        raise exceptions.BadRequest("timeout must be a number of seconds")
+    pod = readiness.wait(challenge_id, get_jwt_identity(), timeout)
+    if pod is None:
+        # A shared challenge is ready as soon as one of its replicas is
+        shared = [pod for pod in pod_informer.by_challenge(challenge_id) if (pod.metadata.labels or {}).get("instance_mode") == "shared"]
+        if shared:
+            return {"ready": any(is_ready(pod) for pod in shared), "phase": None}, 200
+        # A scale-to-zero instance has no pod until it is used, the activator serves it once it is provisioned
+        for instance in read_instances(get_jwt_identity()):
+            if str(instance["challenge_id"]) == str(challenge_id) and instance["state"] != "provisioning":
+                return {"ready": True, "phase": "ScaledToZero"}, 200
+        raise exceptions.NotFound(f"No instance of challenge {challenge_id} is open")
+    return {"ready": is_ready(pod), "phase": pod.status.phase if pod.status is not None else None}, 200
+
+
+@app.get("/jobs/<job_id>")
+@jwt_required()
+def get_job(job_id):
+    """Progress of an instance provisioning or teardown job, only visible to the user that started it and admins"""
+    job = provisioner.job(job_id) or teardown.job(job_id)
+    if job is None or (job["username"] != get_jwt_identity() and get_jwt()["role"] != "admin"):
+        raise exceptions.NotFound(f"Job with id {job_id} not found")
+    return job, 200
 
 
 @app.get("/close/<challenge_id>")
@@ -296,91 +556,32 @@ def open_challenge(challenge_id):
 def close_challenge(challenge_id):
     """Removes the pod, service and httproute associated with the given challenge_id and username"""
     username = get_jwt_identity()
-    namespace = "project"
-
-    # Set up kubernetes
-    load_kubernetes_config()
-    v1 = client.CoreV1Api()
-    custom_client = client.CustomObjectsApi()
-
-    pod_name = "ctf-" + str(challenge_id) + "-" + username
-    service_name = "svc-" + str(challenge_id) + "-" + username
-
-    # Delete the Pod
-    try:
-        v1.delete_namespaced_pod(pod_name, namespace)
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            print(f"Pod {pod_name} not found.")
-        else:
-            raise e
-
-    # Delete the Service
-    try:
-        v1.delete_namespaced_service(service_name, namespace)
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            print(f"Service {service_name} not found.")
-        else:
-            raise e
-
-    # Delete the HTTPRoute
-    try:
-        custom_client.delete_namespaced_custom_object(
-            group="gateway.networking.k8s.io",
-            version="v1",
-            namespace=namespace,
-            plural="httproutes",
-            name="rt-" + str(challenge_id) + "-" + username,
-        )
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:
-            print(f"HTTPRoute rt-{challenge_id}-{username} not found.")
-        else:
-            raise e
+    namespace = instance_namespace(challenge_id, username)
+    remove_instances([(username, challenge_id)])
+    delete_instance(challenge_id, username, namespace)
 
     return "Challenge is closed", 200
 
 
-# TODO: Pretty hard to find a good way to remove the networking stuff after 10 min.
 @app.get("/test/<challenge_id>")
 @jwt_required()
 @authorize(["admin", "developer"])
 def test_challenge(challenge_id):
-    """Spawns an instance of the given challenge in test mode, meaning it will only be active for 10 min."""
+    """Spawns an instance of the given challenge in test mode, meaning it will only be active for TEST_INSTANCE_TTL (10 min)."""
 
     # TODO add a lot of checks, eg check if teh challenge is marked for testing.
 
     username = get_jwt_identity()
     challenge = read_challenge(challenge_id)
 
-    # Check the namespace of that idenfier test
-    load_kubernetes_config()
+    job = provision_instance(username, challenge, "test")
+    if job is None:
+        return already_open(username, challenge_id)
 
-    # Check that the user does not have to many instances running.
-    k8s_client = client.ApiClient()
-    DYNAMIC_CLIENT = kubernetes.dynamic.DynamicClient(
-        kubernetes.client.api_client.ApiClient()
-    )
+    return {"message": "Challenge is being opened in testing mode", "job_id": job["id"], "status": job["status"]}, 202
 
-    resources = ast.literal_eval(challenge.resource_limits)
-
-    # Create the pod
-    pod_dict = generate_pod_dict(challenge_id, username, challenge.image_url, resources["resources"], "test", challenge.name)
-    utils.create_from_dict(k8s_client, pod_dict)
-
-    # Create the Service for the Pod
-    service_dict = generate_service_dict(challenge_id, username, "test", challenge.name)
-    utils.create_from_dict(k8s_client, service_dict)
-
-    # Create the HTTPRoute
-    route_dict = generate_route_dict(challenge_id, username, "test", challenge.name)
-    apply_simple_item(DYNAMIC_CLIENT, route_dict)
 
-    return "Challenge is opened in testing mode", 200
-
-
-"""The following 3 endpoints has been agreed to be internal only"""
+"""The following 5 endpoints has been agreed to be internal only"""
 
 @app.post('/evaluate')
 @validate_json_fields(["challenge_id", "flag"])
@@ -402,6 +603,53 @@ def evaluate_flag():
     }), 200
 
 
+@app.post('/evaluate/batch')
+@validate_json_fields(["submissions"])
+def evaluate_flags():
+    """Evaluates many (challenge_id, flag) pairs with one query, the scores are returned in input order"""
+    """Score is null for challenges that do not exist"""
+    submissions = request.get_json()["submissions"]
+    for submission in submissions:
+        if "challenge_id" not in submission or "flag" not in submission:
+            raise exceptions.BadRequest("Error: every submission needs a challenge_id and a flag")
+
+    # Ids that are not UUIDs can not exist, and would fail the query for the whole batch
+    challenge_ids = [parse_uuid(submission["challenge_id"]) for submission in submissions]
+    known_ids = {challenge_id for challenge_id in challenge_ids if challenge_id is not None}
+    challenges = {challenge.id: challenge for challenge in read_challenges_by_ids(known_ids)} if known_ids else {}
+
+    scores = []
+    for challenge_id, submission in zip(challenge_ids, submissions):
+        challenge = challenges.get(challenge_id)
+        if challenge is None:
+            scores.append(None)
+        else:
+            scores.append(challenge.score if challenge.flag == submission["flag"] else 0)
+
+    return jsonify({
+        "scores": scores
+    }), 200
+
+
+@app.post("/flag-digests")
+@jwt_required()
+@authorize(["service"])
+@validate_json_fields(["salt", "competition_ids"])
+def get_flag_digests():
+    """Returns the salted flag digest and score of every challenge in the given competitions.
+    Only the competition service may call it, the digests would let anyone guess flags offline"""
+    data = request.get_json()
+    salt = data["salt"]
+    if len(data["competition_ids"]) == 0:
+        return jsonify({}), 200
+
+    challenges = read_challenges_from_competitions(tuple(data["competition_ids"]))
+    return jsonify({
+        challenge.id: {"digest": flag_digest(salt, challenge.flag), "score": challenge.score}
+        for challenge in challenges
+    }), 200
+
+
 @app.post("/add-comp")
 @jwt_required()
 @authorize(["admin"])
@@ -412,12 +660,75 @@ def add_comp():
     challenge_ids = data["challenge_ids"]
 
     updated_challenges = add_challenges_to_competition(tuple(challenge_ids), data["competition_id"])
+    notify_challenges_changed(challenge_ids)
+    prepull_images(updated_challenges)
+    refresh_namespace(data["competition_id"])
 
     return {
         "message": f"succesfully added challenges {challenge_ids} to competition {data["competition_id"]}",
         "updated_challenges": [challenge.serialize() for challenge in updated_challenges]
     },201
 
+@app.post("/teardown")
+@jwt_required()
+@authorize(["admin"])
+def teardown_instances():
+    """Removes the instances of a competition, challenge and/or user, optionally of one mode. Called by the competition service
+    with the admin's token when a competition is set inactive"""
+    data = request.get_json(silent=True) or {}
+    mode_filter = data.get("mode")
+    if mode_filter not in [None, "test", "production"]:
+        raise exceptions.BadRequest("mode must be test or production")
+
+    challenge_ids = None
+    if data.get("competition_id") is not None:
+        if parse_uuid(data["competition_id"]) is None:
+            raise exceptions.BadRequest("competition_id is not a valid id")
+        challenge_ids = [challenge.id for challenge in read_challenges_from_competitions((data["competition_id"],))]
+        if not challenge_ids:
+            return {"message": "The competition has no challenges", "job_id": None, "status": "succeeded"}, 200
+    if data.get("challenge_id") is not None:
+        if parse_uuid(data["challenge_id"]) is None:
+            raise exceptions.BadRequest("challenge_id is not a valid id")
+        if challenge_ids is not None and str(data["challenge_id"]) not in [str(challenge_id) for challenge_id in challenge_ids]:
+            return {"message": "The challenge is not part of the competition", "job_id": None, "status": "succeeded"}, 200
+        challenge_ids = [data["challenge_id"]]
+    if challenge_ids is None and data.get("username") is None:
+        raise exceptions.BadRequest("One of competition_id, challenge_id or username is required")
+
+    whole_competition = data.get("competition_id") if data.get("challenge_id") is None else None
+    job = start_teardown(get_jwt_identity(), challenge_ids, data.get("username"), mode_filter, whole_competition)
+    return {"message": "Instances are being removed", "job_id": job["id"], "status": job["status"]}, 202
+
+@app.post("/prepull")
+@jwt_required()
+@authorize(["admin"])
+@validate_json_fields(["competition_id"])
+def prepull_competition():
+    """Pre-pulls the images of the competition's challenges on every node. Called by the competition service
+    with the admin's token when a competition is set active"""
+    competition_id = request.get_json()["competition_id"]
+    if parse_uuid(competition_id) is None:
+        raise exceptions.BadRequest("competition_id is not a valid id")
+    challenges = read_challenges_from_competitions((competition_id,))
+    prepull_images(challenges)
+    return prepull_report(challenges), 202
+
+@app.get("/prepull")
+@jwt_required()
+@authorize(["admin", "developer"])
+def get_prepull():
+    """Pre-pull state per node of the images of a competition, a challenge, or of every challenge"""
+    competition_id = request.args.get("competition_id")
+    challenge_id = request.args.get("challenge_id")
+    if competition_id is not None:
+        if parse_uuid(competition_id) is None:
+            raise exceptions.BadRequest("competition_id is not a valid id")
+        return prepull_report(read_challenges_from_competitions((competition_id,))), 200
+    if challenge_id is not None:
+        return prepull_report([read_challenge(challenge_id)]), 200
+    return prepull_report(read_challenges()), 200
+
 @app.post("/challenges/competitions")
 @validate_json_fields(["competition_ids"])
 def get_challenges_competitions():
@@ -442,13 +753,22 @@ def get_challenge_competition(competition_id):
 
     return challenges, 200
 
+@app.get("/metrics")
+def metrics():
+    """Internal counters of the service"""
+    return {"db_pool": pool.stats(), "pod_informer": pod_informer.stats(), "kubernetes": kube.stats(), "apply": applier.stats(), "provisioning": provisioner.stats(), "teardown": teardown.stats(), "warm_pool": warm_pool.stats(), "reaper": reaper.stats(), "admission": admission.stats(), "reconciler": reconciler.stats(), "readiness": readiness.stats(), "activator": activator.stats(), "routes": route_shards.stats(), "prepull": prepuller.stats(), "namespaces": namespaces.stats(), "kube_rate_limit": kube_limiter.stats()}, 200
+
 #TBD admins should displays all active instances of all Challenge's
 
 
 if __name__ == "__main__":
     if mode == "in-cluster":
-        scheduler.init_app(app)
-        scheduler.start()
-    serve(app, host='0.0.0.0', port=8081)
+        reaper.start()
+        reconciler.start()
+    pod_informer.start()
+    activator.start()
+    warm_pool.start()
+    prepuller.start()
+    serve(app, host='0.0.0.0', port=8081, threads=WAITRESS_THREADS)
 
 
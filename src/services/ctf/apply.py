@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+FIELD_MANAGER = os.getenv("FIELD_MANAGER", "ctf-service")
+CONTENT_HASH_ANNOTATION = "ctf/content-hash"
+# Applied hashes are trusted this many seconds, afterwards the object is applied again
+APPLY_CACHE_TTL = float(os.getenv("APPLY_CACHE_TTL", "300"))
+APPLY_CACHE_SIZE = int(os.getenv("APPLY_CACHE_SIZE", "10000"))
+
+
+def content_hash(manifest) -> str:
+    """Hash of the manifest, without its own content-hash annotation"""
+    manifest = json.loads(json.dumps(manifest, default=str))
+    metadata = manifest.get("metadata", {})
+    (metadata.get("annotations") or {}).pop(CONTENT_HASH_ANNOTATION, None)
+    if metadata.get("annotations") == {}:
+        # So an applied manifest hashes like the one it was made from
+        del metadata["annotations"]
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:32]
+
+
+class Applier:
+    """Applies manifests with server-side apply under one field manager, skipping unchanged objects.
+
+    Every applied manifest carries a content-hash annotation, and the hashes applied lately are
+    kept per object. An object whose hash matches the live one passed as current, or the cached
+    one, is not written at all. Otherwise a single apply PATCH creates or updates it, so a repeated
+    apply costs at most one call and never fails because the object exists. Deleted objects must
+    be forgotten, the cache cannot see deletions.
+    """
+
+    def __init__(self, dynamic, field_manager=FIELD_MANAGER, cache_ttl=APPLY_CACHE_TTL, cache_size=APPLY_CACHE_SIZE) -> None:
+        self._dynamic = dynamic
+        self.field_manager = field_manager
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._applied = {}
+
+        self._created = 0
+        self._updated = 0
+        self._unchanged = 0
+
+    def apply(self, manifest, current=None) -> str:
+        """Applies the manifest, returns created, updated or unchanged.
+        current is the live object if the caller already has it, e.g. from an informer"""
+        digest = content_hash(manifest)
+        key = object_key(manifest["kind"], manifest["metadata"]["namespace"], manifest["metadata"]["name"])
+
+        if current is not None:
+            annotations = current.metadata.annotations or {}
+            unchanged = annotations.get(CONTENT_HASH_ANNOTATION) == digest
+        else:
+            with self._lock:
+                cached = self._applied.get(key)
+                unchanged = cached is not None and cached[0] == digest and time.monotonic() - cached[1] < self.cache_ttl
+        if unchanged:
+            with self._lock:
+                self._unchanged += 1
+            return "unchanged"
+
+        body = json.loads(json.dumps(manifest, default=str))
+        body["metadata"].setdefault("annotations", {})[CONTENT_HASH_ANNOTATION] = digest
+        resources = self._dynamic().resources.get(api_version=body["apiVersion"], kind=body["kind"])
+        response = self._dynamic().server_side_apply(
+            resources, body=body, namespace=body["metadata"]["namespace"],
+            field_manager=self.field_manager, force_conflicts=True, serialize=False,
+        )
+        state = "created" if response.status == 201 else "updated"
+
+        with self._lock:
+            if len(self._applied) >= self.cache_size:
+                self._applied.clear()
+            self._applied[key] = (digest, time.monotonic())
+            if state == "created":
+                self._created += 1
+            else:
+                self._updated += 1
+        return state
+
+    def forget(self, kind, namespace, name):
+        """Drops the cached hash of a deleted object"""
+        with self._lock:
+            self._applied.pop(object_key(kind, namespace, name), None)
+
+    def clear(self):
+        """Drops every cached hash, after objects were deleted in bulk"""
+        with self._lock:
+            self._applied.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "field_manager": self.field_manager,
+                "cached": len(self._applied),
+                "created": self._created,
+                "updated": self._updated,
+                "unchanged": self._unchanged,
+            }
+
+
+def object_key(kind, namespace, name) -> str:
+    return kind + "/" + namespace + "/" + name
@@ -0,0 +1,93 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Collects items from concurrent request threads and hands them to flush in groups.
+
+    A group is flushed when it reaches max_items or when its oldest item has waited max_wait seconds.
+    flush gets the list of items and returns one result per item, in order, a result that is an
+    exception is raised to the caller of that item only. Callers block in submit until their group
+    has been flushed, so an acknowledgement always means the flush finished.
+    """
+
+    def __init__(self, name, flush, max_items, max_wait) -> None:
+        self.name = name
+        self._flush = flush
+        self.max_items = max_items
+        self.max_wait = max_wait
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._thread = None
+
+        self._batches = 0
+        self._items = 0
+        self._max_batch = 0
+        self._failed_batches = 0
+
+    def submit(self, item, timeout=None):
+        """Queues the item and returns its result once the group it ended up in is flushed"""
+        return self.enqueue(item).result(timeout)
+
+    def enqueue(self, item) -> Future:
+        """Queues the item without waiting for the flush"""
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"batcher-{self.name}", daemon=True)
+                self._thread.start()
+            self._queue.append((item, future, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "batches": self._batches,
+                "items": self._items,
+                "max_batch": self._max_batch,
+                "failed_batches": self._failed_batches,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # Give concurrent callers until the oldest item's deadline to join the group
+                deadline = self._queue[0][2] + self.max_wait
+                while len(self._queue) < self.max_items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._queue = self._queue[:self.max_items], self._queue[self.max_items:]
+
+            items = [item for item, _, _ in batch]
+            try:
+                results = self._flush(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name} returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                with self._cond:
+                    self._failed_batches += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._cond:
+                self._batches += 1
+                self._items += len(batch)
+                self._max_batch = max(self._max_batch, len(batch))
+            for (_, future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,66 @@
+"""Gateway route writes, an HTTPRoute per instance against sharded routes, run with: python benchmark_routes.py
+
+Runs against a fake API server that counts writes and takes WRITE_LATENCY per call, no cluster needed.
+Every HTTPRoute write is a config push for the gateway, so the write count is what matters.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from route_shards import RouteShards
+from utils import generate_route_dict
+
+THREADS = 32
+CHALLENGES = [str(uuid.uuid4()) for _ in range(5)]
+USERS = 400
+WRITE_LATENCY = 0.005
+
+class FakeApiServer:
+    """Keeps HTTPRoutes by name and counts the calls made"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.writes = 0
+        self.deletes = 0
+
+    def write(self, route):
+        time.sleep(WRITE_LATENCY)
+        with self.lock:
+            self.writes += 1
+            self.routes[route["metadata"]["name"]] = route
+        return "updated"
+
+    def delete(self, name, namespace="project"):
+        time.sleep(WRITE_LATENCY)
+        with self.lock:
+            self.deletes += 1
+            self.routes.pop(name, None)
+
+    def list_routes(self):
+        with self.lock:
+            return list(self.routes.values())
+
+def run(open_route, close_route):
+    """Opens and then closes an instance of every challenge for every user, returns the seconds taken"""
+    instances = [(challenge_id, f"benchmark{i}") for i in range(USERS) for challenge_id in CHALLENGES]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as executor:
+        list(executor.map(lambda instance: open_route(generate_route_dict(instance[0], instance[1], "test", "benchmark")), instances))
+        list(executor.map(lambda instance: close_route(instance), instances))
+    return time.perf_counter() - start
+
+def main():
+    instances = USERS * len(CHALLENGES)
+    per_instance = FakeApiServer()
+    seconds = run(per_instance.write, lambda instance: per_instance.delete(f"rt-{instance[0]}-{instance[1]}"))
+    print(f"per-instance: {per_instance.writes} writes, {per_instance.deletes} deletes, {seconds:.2f}s for {instances} instances")
+
+    api = FakeApiServer()
+    shards = RouteShards(api.write, api.delete, api.list_routes)
+    seconds = run(shards.add, lambda instance: shards.remove(f"ctf-{instance[0]}-{instance[1]}"))
+    print(f"sharded:      {api.writes} writes, {api.deletes} deletes, {seconds:.2f}s for {instances} instances")
+    print(f"shard batches: {shards.stats()['batches']}")
+
+if __name__ == "__main__":
+    main()
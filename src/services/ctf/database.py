@@ -5,6 +5,7 @@ import os
 import json
 from werkzeug import exceptions
 from models import Challenge
+from pool import ConnectionPool
 
 max_db_connect_retries = 10
 
@@ -33,109 +34,120 @@ def connect():
         )
     return conn
 
+pool = ConnectionPool(connect)
+
 def insert_challenge(challenge: Challenge):
     """Inserts Challenge into db"""
-    conn = connect()
-    cursor = conn.cursor()
-
-    try:
-        # Check if challenge with given id already exists
-        cursor.execute("SELECT id FROM challenges WHERE id = %s;", (challenge.id,))
-        if cursor.fetchone() is not None:
-            raise exceptions.Conflict(description=f"Challenge already exists.")
-
-        # Check if Challenge with given name already exists
-        cursor.execute("SELECT name FROM challenges WHERE name = %s;", (challenge.name,))
-        if cursor.fetchone() is not None:
-            print(challenge.name)
-            raise exceptions.Conflict(
-                description=f"Challenge with name {challenge.name} already exists."
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            # Check if challenge with given id already exists
+            cursor.execute("SELECT id FROM challenges WHERE id = %s;", (challenge.id,))
+            if cursor.fetchone() is not None:
+                raise exceptions.Conflict(description=f"Challenge already exists.")
+
+            # Check if Challenge with given name already exists
+            cursor.execute("SELECT name FROM challenges WHERE name = %s;", (challenge.name,))
+            if cursor.fetchone() is not None:
+                print(challenge.name)
+                raise exceptions.Conflict(
+                    description=f"Challenge with name {challenge.name} already exists."
+                )
+
+            # If neither id nor name exists, proceed with insertion
+            cursor.execute(
+                "INSERT INTO challenges (id, name, description, category, difficulty, flag_format, author, flag, resource_limits, score, testing, ready, image_url, warm_pool_min, warm_pool_max, instance_mode, shared_replicas, placement) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                (
+                    challenge.id,
+                    challenge.name,
+                    challenge.description,
+                    challenge.category,
+                    challenge.difficulty,
+                    challenge.flag_format,
+                    challenge.author,
+                    challenge.flag,
+                    json.dumps(challenge.resource_limits),
+                    challenge.score,
+                    challenge.testing,
+                    challenge.ready,
+                    challenge.image_url,
+                    challenge.warm_pool_min,
+                    challenge.warm_pool_max,
+                    challenge.instance_mode,
+                    challenge.shared_replicas,
+                    challenge.placement,
+                ),
             )
-
-        # If neither id nor name exists, proceed with insertion
-        cursor.execute(
-            "INSERT INTO challenges (id, name, description, category, difficulty, flag_format, author, flag, resource_limits, score, testing, ready, image_url) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
-            (
-                challenge.id,
-                challenge.name,
-                challenge.description,
-                challenge.category,
-                challenge.difficulty,
-                challenge.flag_format,
-                challenge.author,
-                challenge.flag,
-                json.dumps(challenge.resource_limits),
-                challenge.score,
-                challenge.testing,
-                challenge.ready,
-                challenge.image_url,
-            ),
-        )
-    except psycopg2.Error as e:
-        raise exceptions.BadRequest(description=f"Database error: {e}")
-    finally:
-        conn.commit()
-        conn.close()
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+        finally:
+            conn.commit()
 
 def delete_all_challenges():
     """Deletes all challenges from the table"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("DELETE FROM challenges;")
-    conn.commit()
-    conn.close()
+        cursor.execute("DELETE FROM challenges;")
+        conn.commit()
 
 def update_challenge(challenge: Challenge):
     """Updates challenge in db with given id"""
-    conn = connect()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute(
-            """UPDATE challenges SET
-                name = %s,
-                description = %s,
-                category = %s,
-                difficulty = %s,
-                flag_format = %s,
-                author = %s,
-                flag = %s,
-                resource_limits = %s,
-                score = %s,
-                testing = %s,
-                ready = %s,
-                image_url = %s,
-                competition_id = %s
-                WHERE id = %s;""",
-            (
-                challenge.name,
-                challenge.description,
-                challenge.category,
-                challenge.difficulty,
-                challenge.flag_format,
-                challenge.author,
-                challenge.flag,
-                json.dumps(challenge.resource_limits),
-                challenge.score,
-                challenge.testing,
-                challenge.ready,
-                challenge.image_url,
-                challenge.competition_id,
-                challenge.id,
-            ),
-        )
-    except psycopg2.Error as e:
-        raise exceptions.BadRequest(description=f"Database error: {e}")
-    finally:
-        conn.commit()
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(
+                """UPDATE challenges SET
+                    name = %s,
+                    description = %s,
+                    category = %s,
+                    difficulty = %s,
+                    flag_format = %s,
+                    author = %s,
+                    flag = %s,
+                    resource_limits = %s,
+                    score = %s,
+                    testing = %s,
+                    ready = %s,
+                    image_url = %s,
+                    competition_id = %s,
+                    warm_pool_min = %s,
+                    warm_pool_max = %s,
+                    instance_mode = %s,
+                    shared_replicas = %s,
+                    placement = %s
+                    WHERE id = %s;""",
+                (
+                    challenge.name,
+                    challenge.description,
+                    challenge.category,
+                    challenge.difficulty,
+                    challenge.flag_format,
+                    challenge.author,
+                    challenge.flag,
+                    json.dumps(challenge.resource_limits),
+                    challenge.score,
+                    challenge.testing,
+                    challenge.ready,
+                    challenge.image_url,
+                    challenge.competition_id,
+                    challenge.warm_pool_min,
+                    challenge.warm_pool_max,
+                    challenge.instance_mode,
+                    challenge.shared_replicas,
+                    challenge.placement,
+                    challenge.id,
+                ),
+            )
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+        finally:
+            conn.commit()
 
 def patch_update_challenge(challenge_id, data):
     """Updates Challenge in db with given id"""
-    conn = connect()
-    cursor = conn.cursor()
-
     #Generate dynamic sql stmt
     query = sql.SQL("UPDATE challenges SET {data} WHERE id = {id};").format(
     data=sql.SQL(', ').join(
@@ -146,94 +158,114 @@ def patch_update_challenge(challenge_id, data):
     #adding the id to the dict for easily parsing.
     data["id"] = challenge_id
 
-    try:
-        cursor.execute(
-            query,
-            data,
-        )
-    except psycopg2.Error as e:
-        raise exceptions.BadRequest(description=f"Database error: {e}")
-    finally:
-        conn.commit()
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(
+                query,
+                data,
+            )
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+        finally:
+            conn.commit()
 
 def add_challenges_to_competition(challenges, competition_id) -> [Challenge]:
     """Add the challenges to the competition"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("UPDATE challenges set competition_id=%s WHERE id IN %s;", (competition_id, challenges,))
+        cursor.execute("UPDATE challenges set competition_id=%s WHERE id IN %s;", (competition_id, challenges,))
 
-    #Retrieve competitions
-    cursor.execute("select * from challenges where id in %s;", (challenges,))
-    rows = cursor.fetchall()
+        #Retrieve competitions
+        cursor.execute("select * from challenges where id in %s;", (challenges,))
+        rows = cursor.fetchall()
 
-    # Parse challenges
-    updated_challenges = [Challenge(*row) for row in rows]
+        # Parse challenges
+        updated_challenges = [Challenge(*row) for row in rows]
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
     return updated_challenges
 
 def read_challenges() -> [Challenge]:
     """Reads all challenges from the table"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM challenges;")
+        cursor.execute("SELECT * FROM challenges;")
 
-    rows = cursor.fetchall()
+        rows = cursor.fetchall()
 
     # Parse challenges
     challenges = [Challenge(*row) for row in rows]
 
-    conn.close()
-
     return challenges
 
 def read_challenges_from_author(username) -> [Challenge]:
     """Reads all challenges from the table"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM challenges where author=%s;",(username,))
+        cursor.execute("SELECT * FROM challenges where author=%s;",(username,))
 
-    rows = cursor.fetchall()
+        rows = cursor.fetchall()
 
     # Parse challenges
     challenges = [Challenge(*row) for row in rows]
 
-    conn.close()
-
     return challenges
 
 def read_challenges_from_competitions(competition_ids) -> [Challenge]:
     """Returns all challenges with relationship to the given competition_id"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM challenges WHERE competition_id IN %s;", (competition_ids,))
-    rows = cursor.fetchall()
+        cursor.execute("SELECT * FROM challenges WHERE competition_id IN %s;", (competition_ids,))
+        rows = cursor.fetchall()
 
     challenges = [Challenge(*row) for row in rows]
 
-    conn.close()
+    return challenges
+
+def read_challenges_by_ids(challenge_ids) -> [Challenge]:
+    """Returns the Challenges with the given ids from db in one query, unknown ids are left out"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("SELECT * FROM challenges WHERE id = ANY(%s::uuid[]);", (list(challenge_ids),))
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+        rows = cursor.fetchall()
+
+    challenges = [Challenge(*row) for row in rows]
+
+    return challenges
+
+def read_warm_pool_challenges() -> [Challenge]:
+    """Returns the per-user Challenges that keep a warm pool of instances"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT * FROM challenges WHERE (warm_pool_max > 0 OR warm_pool_min > 0) AND instance_mode = 'per-user';")
+        rows = cursor.fetchall()
+
+    challenges = [Challenge(*row) for row in rows]
 
     return challenges
 
 def read_challenge(challenge_id) -> Challenge:
     """Returns Challenges with given id from db"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM challenges WHERE id = %s;", (challenge_id,))
-    row = cursor.fetchone()
+        cursor.execute("SELECT * FROM challenges WHERE id = %s;", (challenge_id,))
+        row = cursor.fetchone()
 
     challenge = Challenge(*row) if row is not None else None
 
-    conn.close()
-
     if challenge is None:
         raise exceptions.NotFound()
 
@@ -241,16 +273,158 @@ def read_challenge(challenge_id) -> Challenge:
 
 def remove_challenge(challenge_id):
     """Removes Challenge with given id from db if it exists."""
-    conn = connect()
-    cursor = conn.cursor()
-
-    # Check if Challenge exists
-    cursor.execute("SELECT id FROM challenges WHERE id = %s;", (challenge_id,))
-    if cursor.fetchone() is None:
-        conn.close()
-        raise exceptions.NotFound(description="Challenge does not exist.")
-
-    # Delete Challenge
-    cursor.execute("DELETE FROM challenges WHERE id = %s;", (challenge_id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Check if Challenge exists
+        cursor.execute("SELECT id FROM challenges WHERE id = %s;", (challenge_id,))
+        if cursor.fetchone() is None:
+            raise exceptions.NotFound(description="Challenge does not exist.")
+
+        # Delete Challenge
+        cursor.execute("DELETE FROM challenges WHERE id = %s;", (challenge_id,))
+        conn.commit()
+def serialize_instance(row) -> dict:
+    return {
+        "username": row[0],
+        "challenge_id": str(row[1]),
+        "competition_id": str(row[2]) if row[2] is not None else None,
+        "mode": row[3],
+        "state": row[4],
+        "created_at": row[5].isoformat() if row[5] is not None else None,
+        "ready_at": row[6].isoformat() if row[6] is not None else None,
+        "expires_at": row[7].isoformat() if row[7] is not None else None,
+    }
+
+instance_columns = "username, challenge_id, competition_id, mode, state, created_at, ready_at, expires_at"
+
+def put_instance(username, challenge_id, competition_id, mode, ttl=None, max_per_user=0, max_per_competition=0) -> bool:
+    """Records the instance the user asked for, returns False when the user has an instance of the challenge already.
+    The quotas count the records, which also cover instances without a pod, scaled to zero or still provisioning.
+    Opens of one user, and of one competition when it has a quota, are serialized by locking its row"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            if max_per_user:
+                cursor.execute("SELECT 1 FROM users WHERE username = %s FOR UPDATE;", (username,))
+                cursor.execute("SELECT count(*) FROM instances WHERE username = %s AND challenge_id <> %s;", (username, challenge_id))
+                if cursor.fetchone()[0] >= max_per_user:
+                    raise exceptions.TooManyRequests(f"You already have {max_per_user} instances open, close one first")
+            if max_per_competition and competition_id is not None:
+                cursor.execute("SELECT 1 FROM competitions WHERE id = %s FOR UPDATE;", (competition_id,))
+                cursor.execute("SELECT count(*) FROM instances WHERE competition_id = %s AND NOT (username = %s AND challenge_id = %s);",
+                               (competition_id, username, challenge_id))
+                if cursor.fetchone()[0] >= max_per_competition:
+                    raise exceptions.TooManyRequests("The competition has reached its number of open instances, try again later")
+
+            # The primary key makes concurrent opens of the same instance insert it once
+            cursor.execute(f"""
+            INSERT INTO instances ({instance_columns})
+            VALUES (%s, %s, %s, %s, 'provisioning', now(), NULL, now() + %s * interval '1 second')
+            ON CONFLICT (username, challenge_id) DO NOTHING
+            RETURNING username;""",
+            (username, challenge_id, competition_id, mode, ttl or None))
+            created = cursor.fetchone() is not None
+            conn.commit()
+        except psycopg2.errors.SerializationFailure as e:
+            raise exceptions.Conflict(description=f"The instance is being opened by another request: {e}")
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+    return created
+
+def read_instance(username, challenge_id):
+    """Returns the record of the user's instance of the challenge, None if there is none"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(f"SELECT {instance_columns} FROM instances WHERE username = %s AND challenge_id = %s;", (username, challenge_id))
+        row = cursor.fetchone()
+
+    return serialize_instance(row) if row is not None else None
+
+def set_instances_state(keys, state):
+    """Sets the state of the (username, challenge_id) instances, ready also stamps ready_at once.
+    Running never replaces ready, a claimed warm pod can be ready before its job finishes"""
+    if not keys:
+        return
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+        UPDATE instances SET state = %s,
+            ready_at = CASE WHEN %s = 'ready' THEN COALESCE(ready_at, now()) ELSE ready_at END
+        WHERE (username, challenge_id) IN (SELECT * FROM unnest(%s::varchar[], %s::uuid[]))
+            AND NOT (state = 'ready' AND %s = 'running');""",
+        (state, state, [key[0] for key in keys], [str(key[1]) for key in keys], state))
+        conn.commit()
+
+def remove_instances(keys):
+    """Removes the records of the (username, challenge_id) instances"""
+    if not keys:
+        return
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+        DELETE FROM instances
+        WHERE (username, challenge_id) IN (SELECT * FROM unnest(%s::varchar[], %s::uuid[]));""",
+        ([key[0] for key in keys], [str(key[1]) for key in keys]))
+        conn.commit()
+
+def remove_instances_matching(challenge_ids=None, username=None, mode=None):
+    """Removes the records of the instances of the challenges and/or the user, optionally of one mode"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+        DELETE FROM instances
+        WHERE (%s::uuid[] IS NULL OR challenge_id = ANY(%s::uuid[]))
+            AND (%s::varchar IS NULL OR username = %s)
+            AND (%s::varchar IS NULL OR mode = %s);""",
+        (challenge_ids, challenge_ids, username, username, mode, mode))
+        conn.commit()
+
+def read_instances(username=None) -> [dict]:
+    """Returns the recorded instances, of one user if given"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        if username is None:
+            cursor.execute(f"SELECT {instance_columns} FROM instances ORDER BY created_at;")
+        else:
+            cursor.execute(f"SELECT {instance_columns} FROM instances WHERE username = %s ORDER BY created_at;", (username,))
+        rows = cursor.fetchall()
+
+    return [serialize_instance(row) for row in rows]
+
+def read_instances_for_reconcile() -> [dict]:
+    """Returns every recorded instance with its age and whether it has expired, computed by the database clock"""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(f"""
+        SELECT {instance_columns},
+            EXTRACT(EPOCH FROM now() - created_at),
+            expires_at IS NOT NULL AND expires_at < now()
+        FROM instances;""")
+        rows = cursor.fetchall()
+
+    return [{**serialize_instance(row), "age_seconds": float(row[8]), "expired": row[9]} for row in rows]
+
+def adopt_instances(instances):
+    """Records instances found in the cluster without a record, as (username, challenge_id, competition_id, mode)"""
+    if not instances:
+        return
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Challenges that no longer exist are left out, their objects are orphans
+        cursor.execute("""
+        INSERT INTO instances (username, challenge_id, competition_id, mode, state)
+        SELECT a.username, a.challenge_id, a.competition_id, a.mode, 'running'
+        FROM unnest(%s::varchar[], %s::uuid[], %s::uuid[], %s::varchar[]) AS a(username, challenge_id, competition_id, mode)
+        WHERE EXISTS (SELECT 1 FROM challenges c WHERE c.id = a.challenge_id)
+        ON CONFLICT (username, challenge_id) DO NOTHING;""",
+        tuple(list(column) for column in zip(*instances)))
+        conn.commit()
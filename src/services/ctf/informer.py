@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+import kubernetes
+from kubernetes import watch
+from werkzeug import exceptions
+
+INFORMER_NAMESPACE = os.getenv("INFORMER_NAMESPACE", "project")
+INFORMER_WATCH_TIMEOUT = int(os.getenv("INFORMER_WATCH_TIMEOUT", "300"))
+INFORMER_RESYNC = float(os.getenv("INFORMER_RESYNC", "600"))
+INFORMER_SYNC_TIMEOUT = float(os.getenv("INFORMER_SYNC_TIMEOUT", "5"))
+# Pause before listing again after the API server failed, so an outage is not hammered
+INFORMER_RETRY_BACKOFF = 2
+
+
+class PodInformer:
+    """In-memory copy of the pods matching label_selector, kept up to date through the watch API.
+
+    One list seeds the cache, after which a watch resumes from the last seen resourceVersion. The
+    cache is listed again when the resourceVersion has expired (410 Gone), after API errors, and
+    every resync seconds as a safety net. Pods are keyed by (namespace, name), since a namespace of
+    None watches every namespace and names only are unique per namespace, and indexed by their
+    username and challenge_id labels.
+    Listeners are called with ("ADDED" | "MODIFIED" | "DELETED", pod) from the informer thread.
+    """
+
+    def __init__(self, api, namespace=INFORMER_NAMESPACE, label_selector="type=ctf",
+                 watch_timeout=INFORMER_WATCH_TIMEOUT, resync=INFORMER_RESYNC) -> None:
+        self._api = api
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.watch_timeout = watch_timeout
+        self.resync = resync
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._synced = threading.Event()
+        self._pods = {}
+        self._by_name = {}
+        self._by_username = {}
+        self._by_challenge = {}
+        self._listeners = []
+        self._resource_version = None
+        self._listed_at = 0.0
+
+        self._lists = 0
+        self._expired = 0
+        self._events = 0
+        self._errors = 0
+
+    def start(self):
+        """Starts the informer thread, safe to call more than once"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="pod-informer", daemon=True).start()
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def wait_for_sync(self, timeout=INFORMER_SYNC_TIMEOUT):
+        """Blocks until the first list has been loaded"""
+        self.start()
+        if not self._synced.wait(timeout):
+            raise exceptions.ServiceUnavailable("Instances are still being loaded, try again later", retry_after=1)
+
+    def get(self, name, namespace=None):
+        """The pod with the name, in the namespace if given, else in any namespace, preferring one that is not being deleted"""
+        with self._lock:
+            if namespace is not None:
+                return self._pods.get((namespace, name))
+            pods = [self._pods[key] for key in self._by_name.get(name, ())]
+        return min(pods, key=lambda pod: (pod.metadata.deletion_timestamp is not None, pod.metadata.namespace), default=None)
+
+    def list(self):
+        with self._lock:
+            return list(self._pods.values())
+
+    def by_username(self, username):
+        with self._lock:
+            return [self._pods[key] for key in self._by_username.get(username, ())]
+
+    def by_challenge(self, challenge_id):
+        with self._lock:
+            return [self._pods[key] for key in self._by_challenge.get(str(challenge_id), ())]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "synced": self._synced.is_set(),
+                "pods": len(self._pods),
+                "resource_version": self._resource_version,
+                "lists": self._lists,
+                "expired_resource_versions": self._expired,
+                "events": self._events,
+                "errors": self._errors,
+                "seconds_since_list": round(time.monotonic() - self._listed_at, 3) if self._listed_at else None,
+            }
+
+    def _run(self):
+        while True:
+            try:
+                v1 = self._api()
+                if self._resource_version is None or time.monotonic() - self._listed_at >= self.resync:
+                    self._list(v1)
+                self._watch(v1)
+            except kubernetes.client.exceptions.ApiException as e:
+                with self._lock:
+                    if e.status == 410:
+                        self._expired += 1
+                    else:
+                        self._errors += 1
+                    self._resource_version = None
+                if e.status != 410:
+                    print(f"Pod informer error: {e.status} {e.reason}")
+                    time.sleep(INFORMER_RETRY_BACKOFF)
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                    self._resource_version = None
+                print(f"Pod informer error: {e}")
+                time.sleep(INFORMER_RETRY_BACKOFF)
+
+    def _list(self, v1):
+        list_pods, args = self._list_call(v1)
+        result = list_pods(*args, label_selector=self.label_selector)
+        pods = {(pod.metadata.namespace, pod.metadata.name): pod for pod in result.items}
+        with self._lock:
+            previous = self._pods
+            self._pods = {}
+            self._by_name = {}
+            self._by_username = {}
+            self._by_challenge = {}
+            for pod in pods.values():
+                self._index(pod)
+            self._resource_version = result.metadata.resource_version
+            self._listed_at = time.monotonic()
+            self._lists += 1
+            listeners = list(self._listeners)
+        self._synced.set()
+
+        # Listeners see what changed while the watch was down
+        for key, pod in pods.items():
+            old = previous.get(key)
+            if old is None:
+                self._notify(listeners, "ADDED", pod)
+            elif old.metadata.resource_version != pod.metadata.resource_version:
+                self._notify(listeners, "MODIFIED", pod)
+        for key, pod in previous.items():
+            if key not in pods:
+                self._notify(listeners, "DELETED", pod)
+
+    def _watch(self, v1):
+        """Applies events until the watch times out, the resync is due or the resourceVersion expires"""
+        w = watch.Watch()
+        timeout = max(min(self.watch_timeout, int(self.resync - (time.monotonic() - self._listed_at))), 1)
+        list_pods, args = self._list_call(v1)
+        for event in w.stream(list_pods, *args, label_selector=self.label_selector,
+                              resource_version=self._resource_version, timeout_seconds=timeout,
+                              allow_watch_bookmarks=True):
+            pod = event["object"]
+            with self._lock:
+                if event["type"] == "BOOKMARK":
+                    self._resource_version = pod.metadata.resource_version
+                    continue
+                self._unindex((pod.metadata.namespace, pod.metadata.name))
+                if event["type"] != "DELETED":
+                    self._index(pod)
+                self._resource_version = pod.metadata.resource_version
+                self._events += 1
+                listeners = list(self._listeners)
+            self._notify(listeners, event["type"], pod)
+
+    def _list_call(self, v1):
+        """List function and its positional arguments, the watch takes the type of the objects from the function's docstring"""
+        if self.namespace is None:
+            return v1.list_pod_for_all_namespaces, ()
+        return v1.list_namespaced_pod, (self.namespace,)
+
+    def _index(self, pod):
+        key = (pod.metadata.namespace, pod.metadata.name)
+        labels = pod.metadata.labels or {}
+        self._pods[key] = pod
+        self._by_name.setdefault(pod.metadata.name, set()).add(key)
+        if "username" in labels:
+            self._by_username.setdefault(labels["username"], set()).add(key)
+        if "challenge_id" in labels:
+            self._by_challenge.setdefault(labels["challenge_id"], set()).add(key)
+
+    def _unindex(self, key):
+        pod = self._pods.pop(key, None)
+        if pod is None:
+            return
+        labels = pod.metadata.labels or {}
+        for index, value in [(self._by_name, pod.metadata.name), (self._by_username, labels.get("username")),
+                             (self._by_challenge, labels.get("challenge_id"))]:
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+
+    @staticmethod
+    def _notify(listeners, event_type, pod):
+        for listener in listeners:
+            try:
+                listener(event_type, pod)
+            except Exception as e:
+                print(f"Pod informer listener failed: {e}")
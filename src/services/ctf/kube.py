@@ -0,0 +1,114 @@
+import os
+import tempfile
+import threading
+import time
+from kubernetes import client, dynamic
+from pool import WAITRESS_THREADS
+from ratelimit import LimitedRestClient
+
+# Connections to the API server shared by the request threads, the informer and the scheduled jobs
+KUBE_POOL_SIZE = int(os.getenv("KUBE_POOL_SIZE", str(WAITRESS_THREADS + 2)))
+# Where API discovery is cached, point it at a volume to keep it warm across restarts
+KUBE_DISCOVERY_CACHE = os.getenv("KUBE_DISCOVERY_CACHE", os.path.join(tempfile.gettempdir(), "ctf-discovery.json"))
+KUBE_DISCOVERY_TTL = float(os.getenv("KUBE_DISCOVERY_TTL", "3600"))
+# How often the credentials file is checked for changes
+KUBE_CREDENTIALS_CHECK = float(os.getenv("KUBE_CREDENTIALS_CHECK", "10"))
+
+
+class KubeClients:
+    """Process-wide Kubernetes clients, built once and shared across requests.
+
+    load_configuration returns a client.Configuration and is only called again when the file at
+    credentials_path changes, e.g. a rotated service account token or an edited kubeconfig. API
+    discovery of the dynamic client is cached in discovery_cache and refreshed after discovery_ttl.
+    With a limiter, every request of the clients takes a token from it and is retried when throttled.
+    """
+
+    def __init__(self, load_configuration, credentials_path, pool_size=KUBE_POOL_SIZE,
+                 discovery_cache=KUBE_DISCOVERY_CACHE, discovery_ttl=KUBE_DISCOVERY_TTL, limiter=None) -> None:
+        self._load_configuration = load_configuration
+        self.credentials_path = credentials_path
+        self.limiter = limiter
+        self.pool_size = pool_size
+        self.discovery_cache = discovery_cache
+        self.discovery_ttl = discovery_ttl
+
+        self._lock = threading.Lock()
+        self._api_client = None
+        self._dynamic = None
+        self._discovered_at = 0.0
+        self._credentials_mtime = None
+        self._checked_at = 0.0
+
+        self._config_loads = 0
+        self._discoveries = 0
+
+    def api_client(self) -> client.ApiClient:
+        with self._lock:
+            self._ensure_client()
+            return self._api_client
+
+    def core(self) -> client.CoreV1Api:
+        return client.CoreV1Api(self.api_client())
+
+    def apps(self) -> client.AppsV1Api:
+        return client.AppsV1Api(self.api_client())
+
+    def custom(self) -> client.CustomObjectsApi:
+        return client.CustomObjectsApi(self.api_client())
+
+    def dynamic(self) -> dynamic.DynamicClient:
+        with self._lock:
+            self._ensure_client()
+            if self._dynamic is None:
+                self._expire_discovery_file()
+                self._dynamic = dynamic.DynamicClient(self._api_client, cache_file=self.discovery_cache)
+                self._discovered_at = time.monotonic()
+                self._discoveries += 1
+            elif time.monotonic() - self._discovered_at >= self.discovery_ttl:
+                self._dynamic.resources.invalidate_cache()
+                self._discovered_at = time.monotonic()
+                self._discoveries += 1
+            return self._dynamic
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pool_size": self.pool_size,
+                "config_loads": self._config_loads,
+                "discoveries": self._discoveries,
+            }
+
+    def _ensure_client(self):
+        """Builds the client on first use, and again when the credentials file has changed"""
+        now = time.monotonic()
+        if self._api_client is not None and now - self._checked_at < KUBE_CREDENTIALS_CHECK:
+            return
+        self._checked_at = now
+        mtime = self._mtime(self.credentials_path)
+        if self._api_client is not None and mtime == self._credentials_mtime:
+            return
+
+        configuration = self._load_configuration()
+        configuration.connection_pool_maxsize = self.pool_size
+        # Threads still holding the old client finish their calls with it
+        self._api_client = client.ApiClient(configuration)
+        if self.limiter is not None:
+            # The generated APIs, the dynamic client and watches all send through the rest client
+            self._api_client.rest_client = LimitedRestClient(self._api_client.rest_client, self.limiter)
+        # Discovery is bound to the old client, the cached results are still reused from disk
+        self._dynamic = None
+        self._credentials_mtime = mtime
+        self._config_loads += 1
+
+    def _expire_discovery_file(self):
+        mtime = self._mtime(self.discovery_cache)
+        if mtime is not None and time.time() - mtime >= self.discovery_ttl:
+            os.remove(self.discovery_cache)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
@@ -17,7 +17,12 @@ class Challenge:
         testing: bool,
         ready: bool,
         image_url: str,
-        competition_id: str
+        competition_id: str,
+        warm_pool_min: int = 0,
+        warm_pool_max: int = 0,
+        instance_mode: str = "per-user",
+        shared_replicas: int = 2,
+        placement: str = "default"
     ) -> None:
         self.id = id if id != "" else str(uuid.uuid4())
         self.name = name
@@ -35,9 +40,18 @@ class Challenge:
             image_url if image_url != "" else "ghcr.io/knative/helloworld-go:latest"
         )
         self.competition_id = competition_id
+        # Unassigned instances kept running, so /open can hand one out without a cold start
+        self.warm_pool_min = warm_pool_min
+        self.warm_pool_max = warm_pool_max
+        # per-user gives every player their own instance, scale-to-zero too but its pod only runs while it is used,
+        # shared runs shared_replicas pods behind one URL for everyone
+        self.instance_mode = instance_mode
+        self.shared_replicas = shared_replicas
+        # Where the instances' pods are scheduled: default, spread, binpack or pool:<name>
+        self.placement = placement
 
     def __repr__(self) -> str:
-        return f"<id:{self.id}, name:{self.name}, description:{self.description}, category:{self.category}, difficulty:{self.difficulty}, flag_format:{self.flag_format}, author:{self.author}, flag:{self.flag}, resource_limits:{self.resource_limits}, score:{self.score}, testing:{self.testing}, ready:{self.ready}, image_url:{self.image_url}, comp_id:{self.competition_id}>"
+        return f"<id:{self.id}, name:{self.name}, description:{self.description}, category:{self.category}, difficulty:{self.difficulty}, flag_format:{self.flag_format}, author:{self.author}, flag:{self.flag}, resource_limits:{self.resource_limits}, score:{self.score}, testing:{self.testing}, ready:{self.ready}, image_url:{self.image_url}, comp_id:{self.competition_id}, warm_pool_min:{self.warm_pool_min}, warm_pool_max:{self.warm_pool_max}, instance_mode:{self.instance_mode}, shared_replicas:{self.shared_replicas}, placement:{self.placement}>"
 
     def serialize(self) -> dict:
         """Function to convert this object to dict"""
@@ -56,4 +70,9 @@ class Challenge:
             "ready": self.ready,
             "image_url": self.image_url,
             "competition_id": self.competition_id,
+            "warm_pool_min": self.warm_pool_min,
+            "warm_pool_max": self.warm_pool_max,
+            "instance_mode": self.instance_mode,
+            "shared_replicas": self.shared_replicas,
+            "placement": self.placement,
         }
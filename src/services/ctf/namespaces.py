@@ -0,0 +1,181 @@
+import ast
+import os
+import threading
+import time
+from kubernetes.utils.quantity import parse_quantity
+from admission import MAX_INSTANCES_PER_COMPETITION
+
+# shared keeps every instance in the project namespace, per-competition gives every competition a namespace of its own
+NAMESPACE_MODE = os.getenv("NAMESPACE_MODE", "shared")
+DEFAULT_NAMESPACE = "project"
+# Instances opened with /test, of any competition
+TEST_NAMESPACE = os.getenv("TEST_NAMESPACE", "ctf-test")
+NAMESPACE_PREFIX = "ctf-comp-"
+# An ensured namespace is applied again after this many seconds, in case it was deleted meanwhile
+NAMESPACE_ENSURE_TTL = float(os.getenv("NAMESPACE_ENSURE_TTL", "300"))
+# Set on every namespace holding instances, the gateway admits routes from namespaces with it
+NAMESPACE_LABEL = "ctf-instances"
+GATEWAY_NAMESPACE = "project"
+ACTIVATOR_SERVICE = "service-ctf"
+
+
+def namespace_for(competition_id, mode) -> str:
+    """Namespace of the instances of a competition's challenge opened in the mode"""
+    if NAMESPACE_MODE != "per-competition":
+        return DEFAULT_NAMESPACE
+    if mode == "test":
+        return TEST_NAMESPACE
+    if competition_id is None:
+        return DEFAULT_NAMESPACE
+    return NAMESPACE_PREFIX + str(competition_id)
+
+
+def challenge_resources(challenge) -> tuple:
+    """((cpu, memory) requested, (cpu, memory) limited) per instance of the challenge, limits stand in for missing requests"""
+    resources = ast.literal_eval(challenge.resource_limits)["resources"] or {}
+    limits = resources.get("limits") or {}
+    requests = resources.get("requests") or {}
+    limit = (float(parse_quantity(limits.get("cpu", 0))), float(parse_quantity(limits.get("memory", 0))))
+    request = (float(parse_quantity(requests.get("cpu", limits.get("cpu", 0)))),
+               float(parse_quantity(requests.get("memory", limits.get("memory", 0)))))
+    return request, limit
+
+
+def generate_namespace_manifests(namespace, competition_id=None, challenges=(), max_instances=MAX_INSTANCES_PER_COMPETITION):
+    """Namespace, LimitRange and ResourceQuota of an instance namespace, sized from the challenges it will hold.
+
+    The LimitRange caps containers at the largest challenge's limits and fills in that challenge's
+    resources for containers without any. The ResourceQuota allows max_instances instances, plus
+    the warm pools, of the largest challenge, and is left out when instances are not limited.
+    A ReferenceGrant lets the namespace's routes reach the activator of scale-to-zero instances.
+    """
+    labels = {"type": NAMESPACE_LABEL, "istio-injection": "enabled"}
+    if competition_id is not None:
+        labels["competition_id"] = str(competition_id)
+    manifests = [{
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {"name": namespace, "namespace": "", "labels": labels,
+                     "annotations": {"ctf/managed-by": "ctf-service", "ctf/competition-id": str(competition_id or "")}},
+    }, {
+        "apiVersion": "gateway.networking.k8s.io/v1beta1",
+        "kind": "ReferenceGrant",
+        "metadata": {"name": "activator-" + namespace, "namespace": DEFAULT_NAMESPACE, "labels": {"type": NAMESPACE_LABEL}},
+        "spec": {
+            "from": [{"group": "gateway.networking.k8s.io", "kind": "HTTPRoute", "namespace": namespace}],
+            "to": [{"group": "", "kind": "Service", "name": ACTIVATOR_SERVICE}],
+        },
+    }]
+    if not challenges:
+        return manifests
+
+    sized = [challenge_resources(challenge) for challenge in challenges]
+    request = (max(r[0] for r, _ in sized), max(r[1] for r, _ in sized))
+    limit = (max(l[0] for _, l in sized), max(l[1] for _, l in sized))
+    container = {}
+    if limit[0] and limit[1]:
+        container["max"] = {"cpu": str(limit[0]), "memory": str(int(limit[1]))}
+        container["default"] = dict(container["max"])
+    if request[0] and request[1]:
+        container["defaultRequest"] = {"cpu": str(request[0]), "memory": str(int(request[1]))}
+    if container:
+        manifests.append({
+            "apiVersion": "v1",
+            "kind": "LimitRange",
+            "metadata": {"name": "ctf-limits", "namespace": namespace, "labels": {"type": NAMESPACE_LABEL}},
+            "spec": {"limits": [{"type": "Container", **container}]},
+        })
+
+    if max_instances:
+        pods = max_instances + sum(max(challenge.warm_pool_max, challenge.warm_pool_min) for challenge in challenges)
+        hard = {"pods": str(pods), "services": str(pods)}
+        if request[0] and request[1]:
+            hard["requests.cpu"] = str(request[0] * pods)
+            hard["requests.memory"] = str(int(request[1] * pods))
+        manifests.append({
+            "apiVersion": "v1",
+            "kind": "ResourceQuota",
+            "metadata": {"name": "ctf-quota", "namespace": namespace, "labels": {"type": NAMESPACE_LABEL}},
+            "spec": {"hard": hard},
+        })
+    return manifests
+
+
+class Namespaces:
+    """Namespaces holding the objects of instances, created on demand with limits derived from their competition.
+
+    ensure(namespace, competition_id) applies the namespace's manifests through apply(manifest),
+    which skips unchanged ones, at most once per ensure_ttl unless the namespace is refreshed after
+    its competition's challenges changed. read_challenges(competition_id) returns the challenges the
+    limits are derived from. names() are the namespaces that may hold instances, for calls that
+    cannot span namespaces. list_names() returns the existing ones and delete(name) removes one
+    with all its objects.
+    """
+
+    def __init__(self, apply, delete, list_names, read_challenges, ensure_ttl=NAMESPACE_ENSURE_TTL) -> None:
+        self._apply = apply
+        self._delete = delete
+        self._list_names = list_names
+        self._read_challenges = read_challenges
+        self.ensure_ttl = ensure_ttl
+
+        self._lock = threading.Lock()
+        # Namespace -> when it was last applied
+        self._ensured = {}
+        self._known = None
+
+        self._applied = 0
+        self._deleted = 0
+
+    def ensure(self, namespace, competition_id=None) -> str:
+        """Creates or updates the namespace unless that was done already, returns its name"""
+        if namespace == DEFAULT_NAMESPACE:
+            return namespace
+        with self._lock:
+            if namespace in self._ensured and time.monotonic() - self._ensured[namespace] < self.ensure_ttl:
+                return namespace
+        challenges = self._read_challenges(competition_id) if competition_id is not None else []
+        for manifest in generate_namespace_manifests(namespace, competition_id, challenges):
+            self._apply(manifest)
+        with self._lock:
+            self._ensured[namespace] = time.monotonic()
+            if self._known is not None:
+                self._known.add(namespace)
+            self._applied += 1
+        return namespace
+
+    def refresh(self, namespace):
+        """Applies the namespace again on its next use, after the challenges it is sized from changed"""
+        with self._lock:
+            self._ensured.pop(namespace, None)
+
+    def names(self) -> list:
+        """Every namespace that may hold instances, the default one included"""
+        if NAMESPACE_MODE != "per-competition":
+            return [DEFAULT_NAMESPACE]
+        with self._lock:
+            known = self._known
+        if known is None:
+            known = set(self._list_names())
+            with self._lock:
+                self._known = known | set(self._ensured)
+                known = self._known
+        return sorted(known | {DEFAULT_NAMESPACE})
+
+    def delete(self, namespace):
+        """Deletes the namespace and everything in it with one call"""
+        self._delete(namespace)
+        with self._lock:
+            self._ensured.pop(namespace, None)
+            if self._known is not None:
+                self._known.discard(namespace)
+            self._deleted += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": NAMESPACE_MODE,
+                "ensured": len(self._ensured),
+                "applied": self._applied,
+                "deleted": self._deleted,
+            }
@@ -0,0 +1,69 @@
+import os
+from werkzeug import exceptions
+
+# Node label and taint key of node pools, challenges pinned to pool:<name> only run on nodes labelled <key>=<name>
+NODE_POOL_LABEL = os.getenv("NODE_POOL_LABEL", "ctf/pool")
+# PriorityClasses of instances per mode, empty leaves the cluster's default priority.
+# Production instances pre-empt test instances when the cluster is full
+PRIORITY_CLASSES = {
+    "production": os.getenv("PRODUCTION_PRIORITY_CLASS", "ctf-production"),
+    "test": os.getenv("TEST_PRIORITY_CLASS", "ctf-test"),
+}
+PLACEMENTS = ["default", "spread", "binpack"]
+HOSTNAME = "kubernetes.io/hostname"
+
+
+def validate_placement(value):
+    """Raises if the value is not default, spread, binpack or pool:<name>"""
+    if value in PLACEMENTS or (isinstance(value, str) and value.startswith("pool:") and len(value) > len("pool:")):
+        return value
+    raise exceptions.BadRequest("placement must be default, spread, binpack or pool:<name>")
+
+
+def node_placement(placement) -> dict:
+    """nodeSelector and tolerations of the placement, which nodes its pods may run on, for admission as well"""
+    if not placement.startswith("pool:"):
+        return {"node_selector": {}, "tolerations": []}
+    pool = placement[len("pool:"):]
+    return {
+        "node_selector": {NODE_POOL_LABEL: pool},
+        "tolerations": [{"key": NODE_POOL_LABEL, "operator": "Equal", "value": pool, "effect": "NoSchedule"}],
+    }
+
+
+def place_pod(pod_spec, placement, challenge_id, mode) -> dict:
+    """Adds the scheduling of the placement and the mode's priority to a pod spec, returns it.
+
+    spread keeps the instances of a challenge on different nodes, so noisy challenges do not pile up.
+    binpack prefers nodes already running instances, leaving the others empty for the autoscaler to
+    remove. pool:<name> pins the instances to the nodes of a pool, tolerating its taint.
+    """
+    if placement == "spread":
+        pod_spec["topologySpreadConstraints"] = [{
+            "maxSkew": 1,
+            "topologyKey": HOSTNAME,
+            # A full node still takes the pod, an unschedulable instance would be worse than an uneven spread
+            "whenUnsatisfiable": "ScheduleAnyway",
+            "labelSelector": {"matchLabels": {"challenge_id": str(challenge_id), "type": "ctf"}},
+        }]
+    elif placement == "binpack":
+        pod_spec["affinity"] = {"podAffinity": {"preferredDuringSchedulingIgnoredDuringExecution": [{
+            "weight": 100,
+            "podAffinityTerm": {"topologyKey": HOSTNAME, "labelSelector": {"matchLabels": {"type": "ctf"}}},
+        }]}}
+    elif placement.startswith("pool:"):
+        nodes = node_placement(placement)
+        pod_spec["nodeSelector"] = nodes["node_selector"]
+        pod_spec["tolerations"] = nodes["tolerations"]
+
+    priority_class = PRIORITY_CLASSES.get(mode)
+    if priority_class:
+        pod_spec["priorityClassName"] = priority_class
+    return pod_spec
+
+
+def placement_annotations(placement) -> dict:
+    """Pod annotations of the placement, bin-packed pods may be moved so their nodes can be removed"""
+    if placement == "binpack":
+        return {"cluster-autoscaler.kubernetes.io/safe-to-evict": "true"}
+    return {}
@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import psycopg2
+from werkzeug import exceptions
+
+# waitress serves every request on one of these threads, so the pool never needs more connections than this
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", "4"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(WAITRESS_THREADS)))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_HEALTH_CHECK_AFTER = float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", "30"))
+DB_POOL_BORROW_TIMEOUT = float(os.getenv("DB_POOL_BORROW_TIMEOUT", "10"))
+
+
+class PooledConnection:
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections, shared by every request thread in the process"""
+
+    def __init__(self, connect, max_size=DB_POOL_SIZE, max_lifetime=DB_POOL_MAX_LIFETIME,
+                 health_check_after=DB_POOL_HEALTH_CHECK_AFTER, borrow_timeout=DB_POOL_BORROW_TIMEOUT) -> None:
+        self._connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.borrow_timeout = borrow_timeout
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._waiting = 0
+
+        self._borrows = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._failed_health_checks = 0
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection for the duration of the with-block, drop-in for connect() ... conn.close()"""
+        pooled = self._acquire()
+        try:
+            yield pooled.conn
+        finally:
+            self._release(pooled)
+
+    def stats(self) -> dict:
+        """Borrow-wait and lifecycle counters of the pool"""
+        with self._cond:
+            return {
+                "size": self._size,
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "borrows": self._borrows,
+                "waits": self._waits,
+                "wait_seconds_total": round(self._wait_seconds, 6),
+                "wait_seconds_max": round(self._max_wait_seconds, 6),
+                "timeouts": self._timeouts,
+                "opened": self._opened,
+                "recycled": self._recycled,
+                "failed_health_checks": self._failed_health_checks,
+            }
+
+    def close(self):
+        """Closes all idle connections, borrowed connections are closed when they are returned"""
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.popleft().conn)
+                self._size -= 1
+
+    def _acquire(self) -> PooledConnection:
+        start = time.monotonic()
+        deadline = start + self.borrow_timeout
+        pooled = None
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    # LIFO, so the connections that are in use stay warm and the rest can expire
+                    pooled = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot now, the connection is opened outside the lock
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise exceptions.ServiceUnavailable("No database connection available, try again later")
+                waited = True
+                self._waiting += 1
+                self._cond.wait(remaining)
+                self._waiting -= 1
+
+            wait = time.monotonic() - start
+            self._borrows += 1
+            if waited:
+                self._waits += 1
+            self._wait_seconds += wait
+            self._max_wait_seconds = max(self._max_wait_seconds, wait)
+
+        if pooled is not None and self._healthy(pooled):
+            return pooled
+        if pooled is not None:
+            self._close(pooled.conn)
+
+        try:
+            pooled = PooledConnection(self._connect())
+        except Exception:
+            self._free_slot()
+            raise
+        with self._cond:
+            self._opened += 1
+        return pooled
+
+    def _release(self, pooled: PooledConnection):
+        # psycopg2 marks the connection closed when the server side is lost, other errors leave it reusable
+        broken = False
+        if not pooled.conn.closed:
+            try:
+                # Never hand out a connection with an open transaction
+                pooled.conn.rollback()
+            except psycopg2.Error:
+                broken = True
+
+        expired = time.monotonic() - pooled.created > self.max_lifetime
+        if broken or expired or pooled.conn.closed:
+            self._close(pooled.conn)
+            with self._cond:
+                if expired:
+                    self._recycled += 1
+            self._free_slot()
+            return
+
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def _healthy(self, pooled: PooledConnection) -> bool:
+        """Checks a connection before it is handed out"""
+        now = time.monotonic()
+        if pooled.conn.closed:
+            self._count_failed_health_check()
+            return False
+        if now - pooled.created > self.max_lifetime:
+            with self._cond:
+                self._recycled += 1
+            return False
+        if now - pooled.last_used < self.health_check_after:
+            return True
+
+        # Idle for a while, the server or a proxy may have dropped it
+        try:
+            cursor = pooled.conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            pooled.conn.rollback()
+            return True
+        except psycopg2.Error:
+            self._count_failed_health_check()
+            return False
+
+    def _count_failed_health_check(self):
+        with self._cond:
+            self._failed_health_checks += 1
+
+    def _free_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
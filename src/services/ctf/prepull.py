@@ -0,0 +1,217 @@
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Pods of challenges use images already on the node, which pre-pulling puts there
+IMAGE_PULL_POLICY = os.getenv("IMAGE_PULL_POLICY", "IfNotPresent")
+# Keeps the pre-pull pod alive once the challenge image is on the node, without using resources
+PREPULL_PAUSE_IMAGE = os.getenv("PREPULL_PAUSE_IMAGE", "registry.k8s.io/pause:3.9")
+# A pre-pull still running after this many seconds is given up and its DaemonSet deleted
+PREPULL_TIMEOUT = float(os.getenv("PREPULL_TIMEOUT", "900"))
+PREPULL_SWEEP_INTERVAL = 10
+PREPULL_LABEL = "prepull"
+# Waiting reasons of a container whose image could not be pulled
+PULL_FAILED = {"ErrImagePull", "ImagePullBackOff", "InvalidImageName", "ErrImageNeverPull"}
+# Waiting reasons of a container that was created, so its image is on the node
+PULL_DONE = {"CrashLoopBackOff", "RunContainerError", "CreateContainerError"}
+
+
+def prepull_name(image) -> str:
+    return "prepull-" + hashlib.sha256(image.encode()).hexdigest()[:16]
+
+
+def generate_prepull_dict(image, namespace="project"):
+    """DaemonSet pulling the image on every node, its init container uses the image and exits right away"""
+    name = prepull_name(image)
+    labels = {PREPULL_LABEL: name, "type": "prepull"}
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": name, "labels": labels, "namespace": namespace, "annotations": {"ctf/image": image}},
+        "spec": {
+            "selector": {"matchLabels": {PREPULL_LABEL: name}},
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {
+                    "initContainers": [{
+                        "name": "pull",
+                        "image": image,
+                        "imagePullPolicy": IMAGE_PULL_POLICY,
+                        # The pull is what counts, images without a shell fail here after it finished
+                        "command": ["sh", "-c", "exit 0"],
+                        "resources": {"requests": {"cpu": "1m", "memory": "4Mi"}, "limits": {"cpu": "50m", "memory": "32Mi"}},
+                    }],
+                    "containers": [{
+                        "name": "pause",
+                        "image": PREPULL_PAUSE_IMAGE,
+                        "imagePullPolicy": "IfNotPresent",
+                        "resources": {"requests": {"cpu": "1m", "memory": "4Mi"}, "limits": {"cpu": "10m", "memory": "16Mi"}},
+                    }],
+                    "terminationGracePeriodSeconds": 0,
+                    "tolerations": [{"operator": "Exists"}],
+                },
+            },
+        },
+    }
+
+
+def node_pull_state(pod) -> str:
+    """pulled, pulling or failed, for the node the pre-pull pod runs on"""
+    statuses = (pod.status.init_container_statuses if pod.status else None) or []
+    if not statuses:
+        return "pulling"
+    status = statuses[0]
+    if status.image_id:
+        return "pulled"
+    waiting = status.state.waiting if status.state else None
+    if waiting is not None and waiting.reason in PULL_FAILED:
+        return "failed"
+    if waiting is not None and waiting.reason in PULL_DONE:
+        return "pulled"
+    return "pulling"
+
+
+class PrePuller:
+    """Pulls challenge images onto every node ahead of the first /open, with a short-lived DaemonSet per image.
+
+    submit(image) applies the DaemonSet with apply(manifest), and a sweeper follows its pods through
+    observe(name), which returns the number of nodes the DaemonSet should run on and its pods. Once
+    every node has the image, or the pull failed or timed out, the DaemonSet is removed with
+    delete(name). The state per node is kept afterwards so admins can see whether a competition is
+    warm. list_names() returns the names of existing pre-pull DaemonSets, the ones left behind by a
+    restart are deleted.
+    """
+
+    def __init__(self, apply, delete, observe, list_names=None, timeout=PREPULL_TIMEOUT, sweep_interval=PREPULL_SWEEP_INTERVAL) -> None:
+        self._apply = apply
+        self._delete = delete
+        self._observe = observe
+        self._list_names = list_names
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._images = {}
+
+        self._submitted = 0
+        self._errors = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="prepull", daemon=True).start()
+
+    def submit(self, image) -> dict:
+        """Starts pulling the image on every node, unless that is already under way"""
+        with self._lock:
+            current = self._images.get(image)
+            if current is not None and current["status"] == "pulling":
+                return self._public(current)
+            # Tracked before the DaemonSet exists, so the sweeper never takes it for a leftover
+            entry = self._images[image] = {
+                "image": image,
+                "name": prepull_name(image),
+                "status": "pulling",
+                "nodes": {},
+                "desired": None,
+                "started": time.monotonic(),
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "finished_at": None,
+            }
+        try:
+            self._apply(generate_prepull_dict(image))
+        except Exception:
+            with self._lock:
+                if self._images.get(image) is entry:
+                    del self._images[image]
+            raise
+        with self._lock:
+            self._submitted += 1
+            return self._public(entry)
+
+    def status(self, image) -> dict:
+        """State of the image per node, status is unknown for images that were never pre-pulled"""
+        with self._lock:
+            current = self._images.get(image)
+            if current is None:
+                return {"image": image, "status": "unknown", "nodes": {}, "desired": None, "started_at": None, "finished_at": None}
+            return self._public(current)
+
+    def sweep(self):
+        """Updates the images being pulled, removing the DaemonSets that are done"""
+        with self._lock:
+            pulling = [dict(current) for current in self._images.values() if current["status"] == "pulling"]
+
+        for current in pulling:
+            try:
+                desired, pods = self._observe(current["name"])
+            except Exception as e:
+                print(f"Could not observe pre-pull of {current['image']}: {e}")
+                with self._lock:
+                    self._errors += 1
+                continue
+            nodes = {pod.spec.node_name: node_pull_state(pod) for pod in pods if pod.spec.node_name}
+            states = set(nodes.values())
+            status = "pulling"
+            if desired and len(nodes) >= desired and "pulling" not in states:
+                status = "failed" if "failed" in states else "pulled"
+            elif time.monotonic() - current["started"] > self.timeout:
+                status = "timeout"
+
+            if status != "pulling":
+                try:
+                    self._delete(current["name"])
+                except Exception as e:
+                    print(f"Could not delete pre-pull of {current['image']}: {e}")
+                    with self._lock:
+                        self._errors += 1
+                    status = "pulling"
+            with self._lock:
+                entry = self._images.get(current["image"])
+                # Submitted again meanwhile, the newer pull is kept
+                if entry is None or entry["started"] != current["started"]:
+                    continue
+                entry["nodes"] = nodes
+                entry["desired"] = desired
+                if status != "pulling":
+                    entry["status"] = status
+                    entry["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+        if self._list_names is not None:
+            names = set(self._list_names())
+            with self._lock:
+                tracked = {current["name"] for current in self._images.values() if current["status"] == "pulling"}
+            for name in names - tracked:
+                try:
+                    self._delete(name)
+                except Exception as e:
+                    print(f"Could not delete leftover pre-pull {name}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [current["status"] for current in self._images.values()]
+            return {
+                "submitted": self._submitted,
+                "pulling": statuses.count("pulling"),
+                "pulled": statuses.count("pulled"),
+                "failed": statuses.count("failed"),
+                "timeout": statuses.count("timeout"),
+                "errors": self._errors,
+            }
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Pre-pull sweeper error: {e}")
+
+    @staticmethod
+    def _public(current) -> dict:
+        return {key: (dict(value) if isinstance(value, dict) else value) for key, value in current.items() if key != "started"}
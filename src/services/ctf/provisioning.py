@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+import kubernetes
+from kubernetes.utils import FailToCreateError
+from werkzeug import exceptions
+
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "4"))
+PROVISION_MAX_QUEUE = int(os.getenv("PROVISION_MAX_QUEUE", "200"))
+# Finished jobs are kept this long for the status endpoint
+PROVISION_JOB_TTL = float(os.getenv("PROVISION_JOB_TTL", "600"))
+
+
+class Provisioner:
+    """Creates challenge instances on a bounded pool of workers, off the request threads.
+
+    A job is a list of (name, create, delete) steps, whose creates run concurrently. create returns
+    created, updated or unchanged, or a bool for created, and when any step fails the created
+    ones are deleted again.
+    At most max_queue jobs may wait for a worker, beyond that new jobs are refused.
+    """
+
+    def __init__(self, workers=PROVISION_WORKERS, max_queue=PROVISION_MAX_QUEUE, job_ttl=PROVISION_JOB_TTL) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+        self._jobs_executor = ThreadPoolExecutor(workers, thread_name_prefix="provision")
+        # Separate pool for the steps, a job waiting on steps in its own pool could starve it
+        self._steps_executor = ThreadPoolExecutor(workers * 3, thread_name_prefix="provision-step")
+
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._finished = {}
+        # (username, challenge_id) -> id of the instance's latest job
+        self._latest = {}
+        self._queued = 0
+        self._running = 0
+
+        self._succeeded = 0
+        self._failed = 0
+        self._rolled_back = 0
+        self._seconds_total = 0.0
+
+    def submit(self, username, challenge_id, mode, steps, on_failed=None, on_succeeded=None) -> dict:
+        """Queues the job and returns it right away, on_failed is called after a failed job was rolled back"""
+        with self._lock:
+            self._prune()
+            if self._queued >= self.max_queue:
+                raise exceptions.ServiceUnavailable("Too many instances are being opened, try again later", retry_after=5)
+            job = {
+                "id": str(uuid.uuid4()),
+                "status": "queued",
+                "username": username,
+                "challenge_id": str(challenge_id),
+                "mode": mode,
+                "steps": {name: "pending" for name, _, _ in steps},
+                "error": None,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "finished_at": None,
+            }
+            self._jobs[job["id"]] = job
+            self._latest[(username, str(challenge_id))] = job["id"]
+            self._queued += 1
+        self._jobs_executor.submit(self._run, job, steps, on_failed, on_succeeded)
+        return dict(job)
+
+    def job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else {**job, "steps": dict(job["steps"])}
+
+    def latest(self, username, challenge_id):
+        """The latest job of the user's instance of the challenge, None once it has been pruned"""
+        with self._lock:
+            job_id = self._latest.get((username, str(challenge_id)))
+        return self.job(job_id) if job_id is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self._succeeded + self._failed
+            return {
+                "workers": self.workers,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "succeeded": self._succeeded,
+                "failed": self._failed,
+                "rolled_back": self._rolled_back,
+                "seconds_avg": round(self._seconds_total / finished, 3) if finished else None,
+            }
+
+    def _run(self, job, steps, on_failed, on_succeeded):
+        start = time.monotonic()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            job["status"] = "running"
+
+        futures = {self._steps_executor.submit(create): (name, delete) for name, create, delete in steps}
+        wait(futures)
+        created, errors = [], []
+        for future, (name, delete) in futures.items():
+            error = future.exception()
+            if error is not None:
+                state = "failed"
+                errors.append(f"{name}: {describe_error(error)}")
+            else:
+                state = future.result()
+                if not isinstance(state, str):
+                    state = "created" if state else "updated"
+                if state == "created":
+                    created.append((name, delete))
+            with self._lock:
+                job["steps"][name] = state
+
+        if errors:
+            for name, delete in created:
+                try:
+                    delete()
+                    with self._lock:
+                        job["steps"][name] = "rolled back"
+                except Exception as e:
+                    if not (isinstance(e, kubernetes.client.exceptions.ApiException) and e.status == 404):
+                        print(f"Could not roll back {name} of job {job['id']}: {describe_error(e)}")
+
+        with self._lock:
+            self._running -= 1
+            self._seconds_total += time.monotonic() - start
+            job["finished_at"] = datetime.now(timezone.utc).isoformat()
+            self._finished[job["id"]] = time.monotonic()
+            if errors:
+                job["status"] = "failed"
+                job["error"] = "; ".join(errors)
+                self._failed += 1
+                self._rolled_back += 1 if created else 0
+            else:
+                job["status"] = "succeeded"
+                self._succeeded += 1
+        callback = on_failed if errors else on_succeeded
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Callback of job {job['id']} failed: {e}")
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, finished in self._finished.items() if now - finished > self.job_ttl]:
+            job = self._jobs.pop(job_id)
+            del self._finished[job_id]
+            key = (job["username"], job["challenge_id"])
+            if self._latest.get(key) == job_id:
+                del self._latest[key]
+
+
+def describe_error(error) -> str:
+    """Short form of the errors the Kubernetes client raises"""
+    if isinstance(error, FailToCreateError):
+        error = error.api_exceptions[0]
+    if isinstance(error, kubernetes.client.exceptions.ApiException):
+        if error.status == 409:
+            return "already exists"
+        return f"{error.status} {error.reason}"
+    return str(error)
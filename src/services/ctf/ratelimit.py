@@ -0,0 +1,248 @@
+import email.utils
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from kubernetes.client.exceptions import ApiException
+from werkzeug import exceptions
+
+# Requests per second to the API server and how many may go at once after a quiet spell, 0 disables limiting
+KUBE_QPS = float(os.getenv("KUBE_QPS", "20"))
+KUBE_BURST = int(os.getenv("KUBE_BURST", "40"))
+# Seconds a request thread waits for its turn before answering 503, background calls wait as long as it takes
+KUBE_INTERACTIVE_WAIT = float(os.getenv("KUBE_INTERACTIVE_WAIT", "10"))
+# Retries of a throttled or failed call, backing off from KUBE_BACKOFF_BASE seconds up to KUBE_BACKOFF_MAX
+KUBE_MAX_RETRIES = int(os.getenv("KUBE_MAX_RETRIES", "3"))
+KUBE_BACKOFF_BASE = float(os.getenv("KUBE_BACKOFF_BASE", "0.2"))
+KUBE_BACKOFF_MAX = float(os.getenv("KUBE_BACKOFF_MAX", "10"))
+# In priority order, a waiting interactive call always goes before a waiting background one
+LANES = ["interactive", "background"]
+
+
+class RateLimiter:
+    """Token bucket shared by every Kubernetes call of the process, with a queue per priority lane.
+
+    Tokens refill at qps up to burst. The call at the head of the first non-empty lane takes the
+    next token, so opens and closes never wait behind housekeeping. The lane of a call is the one
+    set with lane(name) on its thread, or default_lane() otherwise. While the API server has asked
+    to slow down with Retry-After, every lane is paused.
+    """
+
+    def __init__(self, qps=KUBE_QPS, burst=KUBE_BURST, default_lane=lambda: "background",
+                 interactive_wait=KUBE_INTERACTIVE_WAIT) -> None:
+        self.qps = qps
+        self.burst = burst
+        self._default_lane = default_lane
+        self.interactive_wait = interactive_wait
+
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._queues = {lane: deque() for lane in LANES}
+
+        self._requests = {lane: 0 for lane in LANES}
+        self._waited = {lane: 0.0 for lane in LANES}
+        self._max_wait = {lane: 0.0 for lane in LANES}
+        self._timeouts = 0
+        self._throttled = 0
+        self._server_errors = 0
+        self._retries = 0
+        self._paused = 0
+
+    @contextmanager
+    def lane(self, name):
+        """Sends the Kubernetes calls of this thread in the lane until the block exits"""
+        previous = getattr(self._local, "lane", None)
+        self._local.lane = name
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def in_lane(self, name, func):
+        """func, with its Kubernetes calls sent in the lane whichever thread runs it"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.lane(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def current_lane(self) -> str:
+        return getattr(self._local, "lane", None) or self._default_lane()
+
+    def acquire(self, lane) -> float:
+        """Blocks until the lane's turn and a token, returns the seconds waited"""
+        start = time.monotonic()
+        deadline = start + self.interactive_wait if lane == "interactive" and self.interactive_wait else None
+        with self._cond:
+            queue = self._queues[lane]
+            ticket = object()
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    paused = self._paused_until - now
+                    if self._next() is ticket and paused <= 0 and (self._tokens >= 1 or self.qps <= 0):
+                        self._tokens -= 1
+                        break
+                    if deadline is not None and now >= deadline:
+                        self._timeouts += 1
+                        raise exceptions.ServiceUnavailable("Kubernetes API is busy, try again later", retry_after=1)
+                    if paused > 0:
+                        timeout = paused
+                    elif self._next() is ticket:
+                        timeout = (1 - self._tokens) / self.qps
+                    else:
+                        # Woken when the calls ahead have taken their tokens
+                        timeout = None
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - now) if timeout is not None else deadline - now
+                    self._cond.wait(timeout)
+            finally:
+                queue.remove(ticket)
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            self._requests[lane] += 1
+            self._waited[lane] += waited
+            self._max_wait[lane] = max(self._max_wait[lane], waited)
+        return waited
+
+    def pause(self, seconds):
+        """Holds back every lane for the seconds the API server asked for"""
+        with self._cond:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                self._paused += 1
+
+    def record(self, status, retried):
+        with self._cond:
+            if status == 429:
+                self._throttled += 1
+            elif status >= 500:
+                self._server_errors += 1
+            if retried:
+                self._retries += 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "qps": self.qps,
+                "burst": self.burst,
+                "tokens": round(max(self._tokens, 0), 2),
+                "paused_for": round(max(self._paused_until - time.monotonic(), 0), 2),
+                "lanes": {lane: {
+                    "queued": len(self._queues[lane]),
+                    "requests": self._requests[lane],
+                    "avg_wait": round(self._waited[lane] / self._requests[lane], 4) if self._requests[lane] else 0,
+                    "max_wait": round(self._max_wait[lane], 4),
+                } for lane in LANES},
+                "timeouts": self._timeouts,
+                "throttled": self._throttled,
+                "server_errors": self._server_errors,
+                "retries": self._retries,
+                "pauses": self._paused,
+            }
+
+    def _next(self):
+        for lane in LANES:
+            if self._queues[lane]:
+                return self._queues[lane][0]
+        return None
+
+    def _refill(self, now):
+        if self.qps > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.qps)
+        self._refilled_at = now
+
+
+def retryable(method, status) -> bool:
+    """Throttled calls were never processed and are always sent again, failed ones only when repeating them is harmless"""
+    if status == 429:
+        return True
+    return status is not None and status >= 500 and method.upper() != "POST"
+
+
+def parse_retry_after(value):
+    """Seconds of a Retry-After header, given as seconds or as an HTTP date, None without one"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt, base=KUBE_BACKOFF_BASE, cap=KUBE_BACKOFF_MAX) -> float:
+    """Seconds before retry number attempt, exponential with full jitter so throttled threads spread out"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LimitedRestClient:
+    """Stands in for the rest client of an ApiClient, every request takes a token from the limiter.
+
+    Calls answered with 429, or with 5xx unless they create something, are sent again after a
+    jittered backoff, or after Retry-After when the API server gives one. A Retry-After longer
+    than backoff_max is honoured by pausing the limiter, but the call fails right away instead of
+    holding its thread.
+    """
+
+    def __init__(self, rest_client, limiter, max_retries=KUBE_MAX_RETRIES,
+                 backoff_base=KUBE_BACKOFF_BASE, backoff_max=KUBE_BACKOFF_MAX) -> None:
+        self._rest_client = rest_client
+        self._limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def __getattr__(self, name):
+        return getattr(self._rest_client, name)
+
+    def request(self, method, url, *args, **kwargs):
+        lane = self._limiter.current_lane()
+        attempt = 0
+        while True:
+            self._limiter.acquire(lane)
+            error = None
+            try:
+                response = self._rest_client.request(method, url, *args, **kwargs)
+                status = getattr(response, "status", None)
+                retry_after = response.getheader("Retry-After") if hasattr(response, "getheader") else None
+            except ApiException as e:
+                error = e
+                status = e.status
+                retry_after = e.headers.get("Retry-After") if e.headers else None
+
+            if not retryable(method, status):
+                if error is not None:
+                    raise error
+                return response
+
+            retry_after = parse_retry_after(retry_after)
+            if retry_after is not None:
+                self._limiter.pause(retry_after)
+            retry = attempt < self.max_retries and (retry_after is None or retry_after <= self.backoff_max)
+            self._limiter.record(status, retry)
+            if not retry:
+                if error is not None:
+                    raise error
+                return response
+            if error is None:
+                # Frees the connection of the answer that is thrown away
+                response.read()
+            delay = backoff(attempt, self.backoff_base, self.backoff_max)
+            if retry_after is not None:
+                delay += retry_after
+            attempt += 1
+            time.sleep(delay)
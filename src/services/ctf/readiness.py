@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from warm_pool import is_ready
+
+# Upper bounds in seconds of the open-to-ready histogram buckets, the last bucket is +Inf
+READY_BUCKETS = [float(bucket) for bucket in os.getenv("READY_BUCKETS", "1,2,5,10,20,30,60,120,300").split(",")]
+READY_POLL_TIMEOUT = float(os.getenv("READY_POLL_TIMEOUT", "30"))
+READY_POLL_MAX_TIMEOUT = 60
+# Opens that never became ready are forgotten after this many seconds
+READY_PENDING_TTL = 900
+
+
+class ReadinessTracker:
+    """Wakes long-polls on instance readiness and records the time from open to ready per challenge.
+
+    Fed by the pod informer, so a poll returns as soon as the watch event that marks the pod Ready
+    arrives, without polling the API server. mark(keys, "ready") is called with the (username,
+    challenge_id) of every instance that became Ready, off the informer thread. Waiters hold a
+    request thread, so at most max_waiters polls wait at once, the others get the current state.
+    """
+
+    def __init__(self, informer, mark, max_waiters, buckets=READY_BUCKETS) -> None:
+        self._informer = informer
+        self._mark = mark
+        self.max_waiters = max_waiters
+        self.buckets = sorted(buckets)
+        # A single worker keeps the database writes in order and off the watch
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="readiness")
+
+        self._cond = threading.Condition()
+        self._opened = {}
+        self._waiters = 0
+        self._histograms = {}
+
+        self._polls = 0
+        self._poll_timeouts = 0
+        self._polls_rejected = 0
+
+    def opened(self, challenge_id, username):
+        """Starts the open-to-ready clock of the instance"""
+        now = time.monotonic()
+        with self._cond:
+            self._opened = {key: at for key, at in self._opened.items() if now - at < READY_PENDING_TTL}
+            self._opened[(str(challenge_id), username)] = now
+
+    def on_pod_event(self, event_type, pod):
+        """Pod informer listener"""
+        labels = pod.metadata.labels or {}
+        if event_type == "DELETED" or "username" not in labels or not is_ready(pod):
+            return
+        key = (labels["challenge_id"], labels["username"])
+        with self._cond:
+            opened = self._opened.pop(key, None)
+            if opened is not None:
+                self._observe(key[0], time.monotonic() - opened)
+            self._cond.notify_all()
+        if opened is not None:
+            self._executor.submit(self._mark_ready, key)
+
+    def wait(self, challenge_id, username, timeout=READY_POLL_TIMEOUT):
+        """The user's pod of the challenge once it is Ready, or its current state after timeout. None if there is no pod"""
+        timeout = min(max(timeout, 0), READY_POLL_MAX_TIMEOUT)
+        with self._cond:
+            self._polls += 1
+            pod = self._pod(challenge_id, username)
+            if pod is None or is_ready(pod) or timeout == 0:
+                return pod
+            if self._waiters >= self.max_waiters:
+                self._polls_rejected += 1
+                return pod
+            self._waiters += 1
+            try:
+                deadline = time.monotonic() + timeout
+                while True:
+                    pod = self._pod(challenge_id, username)
+                    remaining = deadline - time.monotonic()
+                    if pod is None or is_ready(pod):
+                        return pod
+                    if remaining <= 0:
+                        self._poll_timeouts += 1
+                        return pod
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "waiting": self._waiters,
+                "pending": len(self._opened),
+                "polls": self._polls,
+                "poll_timeouts": self._poll_timeouts,
+                "polls_rejected": self._polls_rejected,
+                "open_to_ready_seconds": {
+                    challenge_id: {
+                        "buckets": {str(bucket): count for bucket, count in zip(self.buckets + ["+Inf"], histogram["counts"])},
+                        "count": histogram["count"],
+                        "sum": round(histogram["sum"], 3),
+                    }
+                    for challenge_id, histogram in self._histograms.items()
+                },
+            }
+
+    def _pod(self, challenge_id, username):
+        for pod in self._informer.by_username(username):
+            if (pod.metadata.labels or {}).get("challenge_id") == str(challenge_id) and pod.metadata.deletion_timestamp is None:
+                return pod
+        return None
+
+    def _observe(self, challenge_id, seconds):
+        """Adds to the cumulative histogram of the challenge, callers hold the lock"""
+        histogram = self._histograms.setdefault(challenge_id, {"counts": [0] * (len(self.buckets) + 1), "count": 0, "sum": 0.0})
+        for i, bucket in enumerate(self.buckets + [float("inf")]):
+            if seconds <= bucket:
+                histogram["counts"][i] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+    def _mark_ready(self, key):
+        challenge_id, username = key
+        try:
+            self._mark([(username, challenge_id)], "ready")
+        except Exception as e:
+            print(f"Could not mark instance ctf-{challenge_id}-{username} ready: {e}")
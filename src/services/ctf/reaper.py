@@ -0,0 +1,126 @@
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Lifetime of instances per mode in seconds, 0 keeps them until they are closed
+TEST_INSTANCE_TTL = float(os.getenv("TEST_INSTANCE_TTL", "600"))
+PRODUCTION_INSTANCE_TTL = float(os.getenv("PRODUCTION_INSTANCE_TTL", "0"))
+REAPER_WORKERS = int(os.getenv("REAPER_WORKERS", "4"))
+# Wait before trying an instance again whose deletion failed
+REAPER_RETRY_AFTER = 30
+# Set on pods claimed from the warm pool, their lifetime starts at the claim
+CLAIMED_AT_ANNOTATION = "ctf/claimed-at"
+
+
+class Reaper:
+    """Deletes instances once their mode's TTL has passed, driven by the pod informer's events.
+
+    Deadlines are kept in a min-heap and the reaper sleeps until the earliest one, so the API server
+    is only called for instances that actually expire. A pod's deadline is its creation, or claim,
+    time plus the TTL, which also holds for pods that never started. Pods are tracked by
+    (namespace, name), and delete is called with (challenge_id, username, namespace, mode) of the
+    expired pod on a bounded pool of workers.
+    """
+
+    def __init__(self, delete, ttls=None, workers=REAPER_WORKERS) -> None:
+        self._delete = delete
+        self.ttls = ttls if ttls is not None else {"test": TEST_INSTANCE_TTL, "production": PRODUCTION_INSTANCE_TTL}
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="reaper")
+
+        self._cond = threading.Condition()
+        self._started = False
+        self._heap = []
+        # Latest deadline per pod, heap entries that no longer match it are stale
+        self._deadlines = {}
+        self._deleting = set()
+
+        self._reaped = 0
+        self._failures = 0
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="reaper", daemon=True).start()
+
+    def on_pod_event(self, event_type, pod):
+        """Pod informer listener"""
+        key = (pod.metadata.namespace, pod.metadata.name)
+        deadline = None if event_type == "DELETED" else self.deadline(pod)
+        with self._cond:
+            if deadline is None:
+                self._deadlines.pop(key, None)
+                return
+            if self._deadlines.get(key, (None,))[0] == deadline:
+                return
+            labels = pod.metadata.labels
+            self._deadlines[key] = (deadline, labels["challenge_id"], labels["username"], labels.get("mode"))
+            heapq.heappush(self._heap, (deadline, key))
+            if self._heap[0][1] == key:
+                self._cond.notify()
+
+    def deadline(self, pod):
+        """Wall clock time the pod expires at, None if it never does"""
+        labels = pod.metadata.labels or {}
+        ttl = self.ttls.get(labels.get("mode"), 0)
+        # Unclaimed warm pool pods belong to nobody yet
+        if not ttl or "username" not in labels or "challenge_id" not in labels:
+            return None
+        annotations = pod.metadata.annotations or {}
+        if CLAIMED_AT_ANNOTATION in annotations:
+            return float(annotations[CLAIMED_AT_ANNOTATION]) + ttl
+        return pod.metadata.creation_timestamp.timestamp() + ttl
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "tracked": len(self._deadlines),
+                "deleting": len(self._deleting),
+                "next_expiry_in": round(self._heap[0][0] - time.time(), 3) if self._heap else None,
+                "reaped": self._reaped,
+                "failures": self._failures,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # Drop entries that were replaced or whose pod is gone
+                    while self._heap and self._deadlines.get(self._heap[0][1], (None,))[0] != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    remaining = self._heap[0][0] - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                deadline, key = heapq.heappop(self._heap)
+                if key in self._deleting:
+                    continue
+                _, challenge_id, username, mode = self._deadlines[key]
+                self._deleting.add(key)
+            self._executor.submit(self._reap, key, challenge_id, username, mode)
+
+    def _reap(self, key, challenge_id, username, mode):
+        namespace, name = key
+        try:
+            self._delete(challenge_id, username, namespace, mode)
+            with self._cond:
+                self._reaped += 1
+        except Exception as e:
+            print(f"Could not delete expired instance {namespace}/{name}: {e}")
+            with self._cond:
+                self._failures += 1
+                if key in self._deadlines:
+                    retry = time.time() + REAPER_RETRY_AFTER
+                    self._deadlines[key] = (retry, challenge_id, username, mode)
+                    heapq.heappush(self._heap, (retry, key))
+                    self._cond.notify()
+        finally:
+            with self._cond:
+                self._deleting.discard(key)
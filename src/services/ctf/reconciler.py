@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from warm_pool import is_ready
+
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "30"))
+# Objects younger than this may still be on their way, they are left alone
+RECONCILE_GRACE = float(os.getenv("RECONCILE_GRACE", "120"))
+# Repairs and deletions per pass, the rest waits for the next pass
+RECONCILE_BATCH = int(os.getenv("RECONCILE_BATCH", "50"))
+
+
+class Reconciler:
+    """Drives the pods, Services and HTTPRoutes of instances towards the instances table.
+
+    Every pass reads the table once, takes the pods from the informer and lists the Services and
+    HTTPRoutes once each. Missing objects of recorded instances are created again, objects without
+    a record are deleted, expired records are removed with their objects and instances whose pod
+    became Ready are marked so. The first pass adopts pods without a record instead of deleting
+    them, so instances that predate the table or a restart are kept.
+
+    The callbacks keep the Kubernetes and database calls out of here:
+    read() -> instance dicts, list_objects(kind) -> objects, repair(instance, kinds),
+    delete_object(kind, name, namespace), expire(instance), mark(keys, state), adopt(rows).
+    """
+
+    def __init__(self, informer, read, list_objects, repair, delete_object, expire, mark, adopt,
+                 interval=RECONCILE_INTERVAL, grace=RECONCILE_GRACE, batch=RECONCILE_BATCH) -> None:
+        self._informer = informer
+        self._read = read
+        self._list_objects = list_objects
+        self._repair = repair
+        self._delete_object = delete_object
+        self._expire = expire
+        self._mark = mark
+        self._adopt = adopt
+        self.interval = interval
+        self.grace = grace
+        self.batch = batch
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._passes = 0
+        self._repaired = 0
+        self._orphans_deleted = 0
+        self._expired = 0
+        self._adopted = 0
+        self._errors = 0
+        self._last_pass_seconds = None
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="reconciler", daemon=True).start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "passes": self._passes,
+                "repaired": self._repaired,
+                "orphans_deleted": self._orphans_deleted,
+                "expired": self._expired,
+                "adopted": self._adopted,
+                "errors": self._errors,
+                "last_pass_seconds": self._last_pass_seconds,
+            }
+
+    def _run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                self._informer.wait_for_sync()
+                self.reconcile()
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                print(f"Reconciler error: {e}")
+            with self._lock:
+                self._last_pass_seconds = round(time.monotonic() - start, 3)
+            time.sleep(self.interval)
+
+    def reconcile(self):
+        """One pass over every instance"""
+        instances = {instance_key(instance["challenge_id"], instance["username"]): instance for instance in self._read()}
+        actual = {"pod": {}, "service": {}, "route": {}}
+        now = time.time()
+        for pod in self._informer.list():
+            labels = pod.metadata.labels or {}
+            # Unclaimed warm pool pods are nobody's instance
+            if "username" in labels and pod.metadata.deletion_timestamp is None:
+                actual["pod"][labels.get("ctf-id-username")] = pod
+        for kind in ["service", "route"]:
+            for obj in self._list_objects(kind):
+                labels = obj.metadata.labels or {}
+                # Shared challenges have no records, their objects are not instances
+                if "ctf-id-username" in labels and labels.get("instance_mode") != "shared" and obj.metadata.deletion_timestamp is None:
+                    actual[kind][labels["ctf-id-username"]] = obj
+
+        with self._lock:
+            first_pass = self._passes == 0
+        budget = self.batch
+
+        if first_pass:
+            adopt = [
+                (pod.metadata.labels["username"], pod.metadata.labels["challenge_id"], pod.metadata.labels.get("competition_id"), pod.metadata.labels.get("mode", "production"))
+                for key, pod in actual["pod"].items() if key not in instances
+            ]
+            self._adopt(adopt)
+            with self._lock:
+                self._adopted += len(adopt)
+            instances = {instance_key(instance["challenge_id"], instance["username"]): instance for instance in self._read()}
+
+        ready, expired = [], []
+        for key, instance in instances.items():
+            if instance["expired"]:
+                expired.append(instance)
+                continue
+            pod = actual["pod"].get(key)
+            if pod is not None and instance["state"] != "ready" and is_ready(pod):
+                ready.append((instance["username"], instance["challenge_id"]))
+            if instance["age_seconds"] < self.grace or budget <= 0:
+                continue
+            # Owned by a provisioning job, unless it has been that long that the job was lost in a restart
+            if instance["state"] == "provisioning" and instance["age_seconds"] < self.grace * 5:
+                continue
+            missing = [kind for kind in ["pod", "service", "route"] if key not in actual[kind]]
+            if missing:
+                budget -= 1
+                try:
+                    self._repair(instance, missing)
+                    with self._lock:
+                        self._repaired += 1
+                except Exception as e:
+                    print(f"Could not repair {missing} of instance {key}: {e}")
+
+        for instance in expired[:max(budget, 0)]:
+            budget -= 1
+            try:
+                self._expire(instance)
+                with self._lock:
+                    self._expired += 1
+            except Exception as e:
+                print(f"Could not expire instance {instance_key(instance['challenge_id'], instance['username'])}: {e}")
+
+        for kind, objects in actual.items():
+            for key, obj in objects.items():
+                if key in instances or budget <= 0:
+                    continue
+                if now - obj.metadata.creation_timestamp.timestamp() < self.grace:
+                    continue
+                budget -= 1
+                try:
+                    self._delete_object(kind, obj.metadata.name, obj.metadata.namespace)
+                    with self._lock:
+                        self._orphans_deleted += 1
+                except Exception as e:
+                    print(f"Could not delete orphan {kind} {obj.metadata.name}: {e}")
+
+        self._mark(ready, "ready")
+        with self._lock:
+            self._passes += 1
+
+
+def instance_key(challenge_id, username) -> str:
+    """Value of the ctf-id-username label of the instance's objects"""
+    return "ctf-" + str(challenge_id) + "-" + username
+
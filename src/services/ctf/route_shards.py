@@ -0,0 +1,219 @@
+import os
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from batching import MicroBatcher
+
+# per-instance gives every instance an HTTPRoute of its own, sharded merges them into routes per challenge
+ROUTE_MODE = os.getenv("ROUTE_MODE", "per-instance")
+# Gateway API allows at most 16 rules per HTTPRoute
+ROUTE_SHARD_RULES = 16
+ROUTE_BATCH_SIZE = int(os.getenv("ROUTE_BATCH_SIZE", "500"))
+ROUTE_BATCH_WAIT = float(os.getenv("ROUTE_BATCH_WAIT_MS", "200")) / 1000
+SHARD_LABEL = "route-shard"
+
+
+class RouteShards:
+    """Keeps the routes of instances as rules of shared HTTPRoutes, one per shard of up to 16 instances of a challenge in a namespace.
+
+    Every route change costs the gateway a config push, so instead of an HTTPRoute per instance the
+    rule of the instance's route is merged into a shard route of its challenge. Changes arriving
+    within batch_wait are grouped and every shard they touch is written once, with write(route) for
+    shards that still have rules and delete(name, namespace) for empty ones. The assignment of instances to
+    shards lives in memory and is loaded from list_routes() on first use, or again after a failed
+    write, so there must be a single writer.
+    """
+
+    def __init__(self, write, delete, list_routes, max_rules=ROUTE_SHARD_RULES,
+                 batch_size=ROUTE_BATCH_SIZE, batch_wait=ROUTE_BATCH_WAIT) -> None:
+        self._write = write
+        self._delete = delete
+        self._list_routes = list_routes
+        self.max_rules = max_rules
+        self._batcher = MicroBatcher("routes", self._flush, batch_size, batch_wait)
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        # (namespace, challenge_id) -> shard name -> instance key -> rule
+        self._shards = {}
+        # instance key -> ((namespace, challenge_id), shard name)
+        self._assigned = {}
+        # Shared by all shards of a challenge in a namespace: labels and parentRefs
+        self._templates = {}
+        self._added_at = {}
+
+        self._writes = 0
+        self._deletes = 0
+
+    def add(self, route_dict) -> str:
+        """Merges the rule of an instance's route into a shard, returns created, updated or unchanged once written"""
+        return self._batcher.submit(("add", route_dict))
+
+    def remove(self, key):
+        """Drops the rule of the instance with the ctf-id-username key once written, unknown keys are skipped"""
+        return self._batcher.submit(("remove", key))
+
+    def has(self, key) -> bool:
+        self._ensure_loaded()
+        with self._lock:
+            return key in self._assigned
+
+    def reset(self):
+        """Forgets the assignments, e.g. after shard routes were deleted in bulk, they are loaded again on next use"""
+        with self._lock:
+            self._loaded = False
+
+    def objects(self) -> list:
+        """One object per instance rule, shaped like the client's objects so the reconciler can treat them as routes"""
+        self._ensure_loaded()
+        with self._lock:
+            return [
+                SimpleNamespace(metadata=SimpleNamespace(
+                    name="rt-" + key[len("ctf-"):],
+                    namespace=group[0],
+                    labels={"ctf-id-username": key, "challenge_id": group[1], "type": "ctf"},
+                    deletion_timestamp=None,
+                    creation_timestamp=self._added_at[key],
+                ))
+                for key, (group, _) in self._assigned.items()
+            ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": ROUTE_MODE,
+                "shards": sum(len(shards) for shards in self._shards.values()),
+                "rules": len(self._assigned),
+                "writes": self._writes,
+                "deletes": self._deletes,
+                "batches": self._batcher.stats(),
+            }
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded:
+                return
+        routes = self._list_routes()
+        shards, assigned, templates, added_at = {}, {}, {}, {}
+        for route in routes:
+            metadata = route["metadata"]
+            group = (metadata["namespace"], metadata["labels"]["challenge_id"])
+            created = metadata.get("creationTimestamp")
+            created = datetime.fromisoformat(created) if created else datetime.now(timezone.utc)
+            templates[group] = self._template(route)
+            rules = shards.setdefault(group, {}).setdefault(metadata["name"], {})
+            for rule in route["spec"].get("rules") or []:
+                key = rule_key(rule)
+                rules[key] = rule
+                assigned[key] = (group, metadata["name"])
+                added_at[key] = created
+        with self._lock:
+            self._shards, self._assigned, self._templates, self._added_at = shards, assigned, templates, added_at
+            self._loaded = True
+
+    def _flush(self, items):
+        self._ensure_loaded()
+        results, touched = [], []
+        with self._lock:
+            for operation, value in items:
+                result, shard = self._merge(value) if operation == "add" else self._drop(value)
+                results.append(result)
+                touched.append(shard)
+            # Every shard is written once, however many of its instances changed
+            changed = list(dict.fromkeys(shard for shard in touched if shard is not None))
+            writes = [(group, name, self._shard_dict(group, name)) for group, name in changed]
+
+        failed = {}
+        for group, name, route in writes:
+            try:
+                if route is None:
+                    self._delete(name, group[0])
+                else:
+                    self._write(route)
+                with self._lock:
+                    if route is None:
+                        self._deletes += 1
+                    else:
+                        self._writes += 1
+            except Exception as e:
+                failed[(group, name)] = e
+
+        if failed:
+            # The cluster no longer matches the assignments, they are loaded again before the next batch
+            self.reset()
+            for i, shard in enumerate(touched):
+                if shard in failed:
+                    results[i] = failed[shard]
+        return results
+
+    def _merge(self, route_dict):
+        """Adds or replaces the rule of an instance, returns its result and the shard it changed. Callers hold the lock"""
+        key = route_dict["metadata"]["labels"]["ctf-id-username"]
+        challenge_id = str(route_dict["metadata"]["labels"]["challenge_id"])
+        group = (route_dict["metadata"]["namespace"], challenge_id)
+        rule = route_dict["spec"]["rules"][0]
+        self._templates.setdefault(group, self._template(route_dict))
+        shards = self._shards.setdefault(group, {})
+
+        if key in self._assigned:
+            group, name = self._assigned[key]
+            if self._shards[group][name][key] == rule:
+                return "unchanged", None
+            self._shards[group][name][key] = rule
+            return "updated", (group, name)
+
+        name = next((name for name in sorted(shards) if len(shards[name]) < self.max_rules), None)
+        if name is None:
+            index = 0
+            while shard_name(challenge_id, index) in shards:
+                index += 1
+            name = shard_name(challenge_id, index)
+            shards[name] = {}
+        shards[name][key] = rule
+        self._assigned[key] = (group, name)
+        self._added_at[key] = datetime.now(timezone.utc)
+        return "created", (group, name)
+
+    def _drop(self, key):
+        """Removes the rule of an instance, returns no result and the shard it changed. Callers hold the lock"""
+        if key not in self._assigned:
+            return None, None
+        group, name = self._assigned.pop(key)
+        self._added_at.pop(key, None)
+        del self._shards[group][name][key]
+        return None, (group, name)
+
+    def _shard_dict(self, group, name):
+        """Manifest of the shard, None once it has no rules left and is to be deleted"""
+        rules = self._shards[group][name]
+        if not rules:
+            del self._shards[group][name]
+            return None
+        template = self._templates[group]
+        return {
+            "apiVersion": "gateway.networking.k8s.io/v1",
+            "kind": "HTTPRoute",
+            "metadata": {"name": name, "labels": dict(template["labels"]), "namespace": template["namespace"]},
+            # Sorted, so an unchanged shard has an unchanged content hash
+            "spec": {"parentRefs": template["parentRefs"], "rules": [rules[key] for key in sorted(rules)]},
+        }
+
+    @staticmethod
+    def _template(route):
+        labels = route["metadata"].get("labels") or {}
+        return {
+            "labels": {"challenge_id": str(labels["challenge_id"]), "name": labels.get("name", ""), "type": "ctf", SHARD_LABEL: "true"},
+            "namespace": route["metadata"]["namespace"],
+            "parentRefs": route["spec"]["parentRefs"],
+        }
+
+
+def shard_name(challenge_id, index) -> str:
+    """rts- rather than rt-, so a shard never shares its name with the route of an instance"""
+    return f"rts-{challenge_id}-{index}"
+
+
+def rule_key(rule) -> str:
+    """ctf-id-username key of the instance a rule routes to, from its /ctf/<challenge_id>-<username> path"""
+    return "ctf-" + rule["matches"][0]["path"]["value"][len("/ctf/"):]
+
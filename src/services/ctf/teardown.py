@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from provisioning import describe_error
+
+TEARDOWN_WORKERS = int(os.getenv("TEARDOWN_WORKERS", "2"))
+# Challenge ids per set-based selector, keeps the selectors well below the URL length limit
+TEARDOWN_SELECTOR_CHUNK = int(os.getenv("TEARDOWN_SELECTOR_CHUNK", "50"))
+TEARDOWN_JOB_TTL = 3600
+# Routes first so traffic stops, Deployments of shared challenges before their pods are deleted
+TEARDOWN_KINDS = ["route", "service", "deployment", "pod"]
+
+
+def teardown_selectors(challenge_ids=None, username=None, mode=None, chunk=TEARDOWN_SELECTOR_CHUNK) -> [str]:
+    """Label selectors matching the instances of the challenges and/or the user, optionally of one mode"""
+    if not challenge_ids and username is None:
+        raise ValueError("A teardown needs challenges or a user, it would remove every instance otherwise")
+    common = []
+    if username is not None:
+        common.append(f"username={username}")
+    if mode is not None:
+        common.append(f"mode={mode}")
+    if not challenge_ids:
+        return [",".join(common)]
+    challenge_ids = sorted(str(challenge_id) for challenge_id in challenge_ids)
+    return [
+        ",".join([f"challenge_id in ({','.join(challenge_ids[i:i + chunk])})"] + common)
+        for i in range(0, len(challenge_ids), chunk)
+    ]
+
+
+class Teardown:
+    """Removes many instances at once in background jobs, with one deletecollection call per kind and selector.
+
+    A job drops the instance records and then deletes the routes, Services, Deployments and pods
+    matching its selectors, so clearing a whole competition takes a few calls instead of three per
+    instance.
+    delete_collection(kind, selector) makes the call and remove_records(scope) drops the rows.
+    Namespaces holding nothing but the scope's instances are deleted whole with delete_namespace(name),
+    before the selectors clean up the rest. Progress is reported per kind and as calls done out of the total.
+    """
+
+    def __init__(self, delete_collection, remove_records, delete_namespace=None, workers=TEARDOWN_WORKERS, job_ttl=TEARDOWN_JOB_TTL) -> None:
+        self._delete_collection = delete_collection
+        self._remove_records = remove_records
+        self._delete_namespace = delete_namespace
+        self.job_ttl = job_ttl
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="teardown")
+
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._finished = {}
+        self._running = 0
+
+        self._succeeded = 0
+        self._failed = 0
+        self._calls = 0
+
+    def submit(self, username, scope, selectors, on_done=None, namespaces=()) -> dict:
+        """Queues the teardown and returns its job right away, username is who asked for it"""
+        with self._lock:
+            self._prune()
+            job = {
+                "id": str(uuid.uuid4()),
+                "status": "queued",
+                "username": username,
+                "scope": scope,
+                "selectors": list(selectors),
+                "namespaces": list(namespaces),
+                "steps": {kind: "pending" for kind in ["records"] + (["namespaces"] if namespaces else []) + TEARDOWN_KINDS},
+                "progress": {"done": 0, "total": len(selectors) * len(TEARDOWN_KINDS) + len(namespaces) + 1},
+                "error": None,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "finished_at": None,
+            }
+            self._jobs[job["id"]] = job
+        self._executor.submit(self._run, job, on_done)
+        return dict(job)
+
+    def job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else {**job, "steps": dict(job["steps"]), "progress": dict(job["progress"]), "namespaces": list(job["namespaces"])}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._running,
+                "succeeded": self._succeeded,
+                "failed": self._failed,
+                "calls": self._calls,
+            }
+
+    def _run(self, job, on_done):
+        with self._lock:
+            self._running += 1
+            job["status"] = "running"
+
+        errors = []
+        # Records go first, objects left behind by a failed call are then orphans the reconciler deletes,
+        # rather than missing objects of recorded instances it would create again
+        self._step(job, "records", "running")
+        try:
+            self._remove_records(job["scope"])
+            self._step(job, "records", "deleted")
+        except Exception as e:
+            errors.append(f"records: {e}")
+            self._step(job, "records", "failed")
+        with self._lock:
+            job["progress"]["done"] += 1
+
+        if job["namespaces"]:
+            self._step(job, "namespaces", "running")
+            failed = False
+            for namespace in job["namespaces"]:
+                try:
+                    self._delete_namespace(namespace)
+                except Exception as e:
+                    failed = True
+                    errors.append(f"namespace {namespace}: {describe_error(e)}")
+                with self._lock:
+                    self._calls += 1
+                    job["progress"]["done"] += 1
+            self._step(job, "namespaces", "failed" if failed else "deleted")
+
+        for kind in TEARDOWN_KINDS:
+            self._step(job, kind, "running")
+            failed = False
+            for selector in job["selectors"]:
+                try:
+                    self._delete_collection(kind, selector)
+                except Exception as e:
+                    failed = True
+                    errors.append(f"{kind} {selector}: {describe_error(e)}")
+                with self._lock:
+                    self._calls += 1
+                    job["progress"]["done"] += 1
+            self._step(job, kind, "failed" if failed else "deleted")
+
+        with self._lock:
+            self._running -= 1
+            job["finished_at"] = datetime.now(timezone.utc).isoformat()
+            self._finished[job["id"]] = time.monotonic()
+            if errors:
+                job["status"] = "failed"
+                job["error"] = "; ".join(errors)
+                self._failed += 1
+            else:
+                job["status"] = "succeeded"
+                self._succeeded += 1
+        if on_done is not None:
+            try:
+                on_done()
+            except Exception as e:
+                print(f"Callback of teardown {job['id']} failed: {e}")
+
+    def _step(self, job, kind, state):
+        with self._lock:
+            job["steps"][kind] = state
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, finished in self._finished.items() if now - finished > self.job_ttl]:
+            del self._jobs[job_id]
+            del self._finished[job_id]
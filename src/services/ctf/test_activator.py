@@ -0,0 +1,232 @@
+import http.client
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from types import SimpleNamespace
+from activator import Activator, ACTIVATOR_HEADER
+
+NAME = "ctf-0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c-alice"
+KEY = "project/" + NAME
+
+
+class DummyBackend(BaseHTTPRequestHandler):
+    """Stands in for a challenge pod, echoes what it received"""
+
+    def do_GET(self):
+        body = f"{self.command} {self.path} {self.headers.get('X-Test', '')}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeScaler:
+    """Stands in for the Kubernetes side, the pod becomes ready start_delay seconds after scale_up"""
+
+    def __init__(self, backend, start_delay=0.2):
+        self.backend_address = backend
+        self.start_delay = start_delay
+        self.scale_ups = []
+        self.scale_downs = []
+        self.ready_at = {}
+
+    def scale_up(self, key):
+        self.scale_ups.append(key)
+        self.ready_at[key] = time.monotonic() + self.start_delay
+
+    def scale_down(self, key):
+        self.scale_downs.append(key)
+        self.ready_at.pop(key, None)
+
+    def backend(self, key):
+        ready_at = self.ready_at.get(key)
+        return self.backend_address if ready_at is not None and time.monotonic() >= ready_at else None
+
+    def list_active(self):
+        return list(self.ready_at)
+
+
+@pytest.fixture
+def backend():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DummyBackend)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield f"127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def activated(backend):
+    scaler = FakeScaler(backend)
+    activator = Activator(scaler.scale_up, scaler.scale_down, scaler.backend, scaler.list_active,
+                          idle_timeout=60, wake_timeout=1, sweep_interval=3600, poll_interval=0.02)
+    port = activator.start(host="127.0.0.1", port=0)
+    yield activator, scaler, port
+    activator.stop()
+
+
+def pod(namespace, name=NAME):
+    return SimpleNamespace(metadata=SimpleNamespace(namespace=namespace, name=name))
+
+
+def request(port, path="/", key=KEY, method="GET", body=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    headers = {"X-Test": "passed"}
+    if key is not None:
+        headers[ACTIVATOR_HEADER] = key
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    result = response.status, response.read().decode()
+    connection.close()
+    return result
+
+
+def test_first_request_wakes_the_instance_and_is_held_until_ready(activated):
+    activator, scaler, port = activated
+    start = time.monotonic()
+    assert request(port, "/flag?x=1") == (200, "GET /flag?x=1 passed")
+    assert time.monotonic() - start >= scaler.start_delay
+    assert scaler.scale_ups == [KEY]
+    assert activator.stats()["wakes"] == 1
+
+
+def test_running_instance_is_proxied_without_waking(activated):
+    activator, scaler, port = activated
+    scaler.ready_at[KEY] = 0
+    assert request(port, method="POST", body=b"data") == (200, "POST / passed")
+    assert scaler.scale_ups == []
+
+
+def test_concurrent_first_requests_start_one_pod(activated):
+    activator, scaler, port = activated
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(request(port))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [status for status, _ in results] == [200] * 5
+    assert scaler.scale_ups == [KEY]
+
+
+def test_instance_that_does_not_start_times_out(activated):
+    activator, scaler, port = activated
+    scaler.start_delay = 10
+    status, _ = request(port)
+    assert status == 504
+    assert activator.stats()["wake_timeouts"] == 1
+    assert activator.stats()["in_flight"] == 0
+
+
+def test_failing_scale_up_is_a_bad_gateway(activated):
+    activator, scaler, port = activated
+
+    def fail(key):
+        raise RuntimeError("no such instance")
+
+    activator._scale_up = fail
+    assert request(port)[0] == 502
+
+
+def test_requests_without_an_instance_are_rejected(activated):
+    activator, scaler, port = activated
+    assert request(port, key=None)[0] == 404
+    assert request(port, key="svc-../../etc")[0] == 404
+    assert request(port, key=NAME)[0] == 404
+    assert scaler.scale_ups == []
+
+
+def test_idle_instances_are_scaled_down(activated):
+    activator, scaler, port = activated
+    request(port)
+    activator.sweep()
+    assert scaler.scale_downs == []
+
+    activator.idle_timeout = 0
+    activator.sweep()
+    assert scaler.scale_downs == [KEY]
+    assert activator.stats()["tracked"] == 0
+
+
+def test_instances_with_requests_in_flight_are_kept(activated):
+    activator, scaler, port = activated
+    scaler.ready_at[KEY] = 0
+    activator.idle_timeout = 0
+    activator.acquire(KEY)
+    activator.sweep()
+    assert scaler.scale_downs == []
+    activator.release(KEY)
+    activator.sweep()
+    assert scaler.scale_downs == [KEY]
+
+
+def test_pods_started_before_a_restart_are_scaled_down_once_idle(activated):
+    activator, scaler, port = activated
+    scaler.ready_at[KEY] = 0
+    activator.sweep()
+    assert scaler.scale_downs == []
+    activator.idle_timeout = 0
+    activator.sweep()
+    assert scaler.scale_downs == [KEY]
+
+
+def test_request_during_scale_down_waits_for_the_pod_to_go(activated):
+    activator, scaler, port = activated
+    deleting = threading.Event()
+    terminating = set()
+    scale_down = scaler.scale_down
+
+    def slow_scale_down(key):
+        deleting.set()
+        time.sleep(0.1)
+        scale_down(key)
+        terminating.add(key)
+
+    activator._scale_down = slow_scale_down
+    activator._present = lambda key: key in terminating or key in scaler.ready_at
+    scaler.ready_at[KEY] = 0
+    activator.sweep()
+    activator.idle_timeout = 0
+    sweeper = threading.Thread(target=activator.sweep)
+    sweeper.start()
+    deleting.wait()
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(request(port)))
+    waiter.start()
+    sweeper.join()
+    time.sleep(0.1)
+    # Deleted but still terminating, the request is held instead of waking the old pod
+    assert scaler.scale_ups == []
+    terminating.clear()
+    activator.on_pod_event("DELETED", pod("project"))
+    waiter.join()
+    assert result == [(200, "GET / passed")]
+    assert scaler.scale_downs == [KEY]
+    assert scaler.scale_ups == [KEY]
+
+
+def test_pods_with_the_same_name_in_other_namespaces_are_other_instances(activated):
+    activator, scaler, port = activated
+    test_key = "ctf-test/" + NAME
+    scaler.ready_at[KEY] = 0
+    scaler.ready_at[test_key] = 0
+    assert request(port, key=test_key) == (200, "GET / passed")
+    activator.acquire(KEY)
+    assert activator.stats()["tracked"] == 2
+    activator.idle_timeout = 0
+    activator.sweep()
+    # Only the idle test instance goes, the one in project has a request in flight
+    assert scaler.scale_downs == [test_key]
+
+
+def test_route_names_the_instance_with_its_namespace():
+    from utils import generate_activated_route_dict
+    route = generate_activated_route_dict("0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c", "alice", "test", "web", "ctf-test")
+    header, = route["spec"]["rules"][0]["filters"][-1]["requestHeaderModifier"]["set"]
+    assert header == {"name": ACTIVATOR_HEADER, "value": "ctf-test/" + NAME}
@@ -0,0 +1,168 @@
+import pytest
+from werkzeug import exceptions
+from kubernetes.client import (
+    V1Container, V1Node, V1NodeCondition, V1NodeSpec, V1NodeStatus, V1ObjectMeta,
+    V1Pod, V1PodSpec, V1PodStatus, V1ResourceRequirements, V1Taint,
+)
+from admission import Admission, resource_requests
+from placement import node_placement, NODE_POOL_LABEL
+
+
+def node(name, cpu="4", memory="8Gi", ready=True, unschedulable=False, taints=None, labels=None):
+    return V1Node(
+        metadata=V1ObjectMeta(name=name, labels=labels),
+        spec=V1NodeSpec(unschedulable=unschedulable, taints=taints),
+        status=V1NodeStatus(
+            allocatable={"cpu": cpu, "memory": memory},
+            conditions=[V1NodeCondition(type="Ready", status="True" if ready else "False")],
+        ),
+    )
+
+
+def pod(username, challenge_id, node_name=None, cpu="1", memory="1Gi", competition_id=None, phase="Running", node_selector=None):
+    labels = {"ctf-id-username": f"ctf-{challenge_id}-{username}", "username": username, "challenge_id": challenge_id, "type": "ctf"}
+    if competition_id is not None:
+        labels["competition_id"] = competition_id
+    return V1Pod(
+        metadata=V1ObjectMeta(name=f"ctf-{challenge_id}-{username}", labels=labels),
+        spec=V1PodSpec(
+            node_name=node_name,
+            node_selector=node_selector,
+            containers=[V1Container(name="ctf", resources=V1ResourceRequirements(requests={"cpu": cpu, "memory": memory}))],
+        ),
+        status=V1PodStatus(phase=phase),
+    )
+
+
+def resources(cpu="1", memory="1Gi"):
+    return {"requests": {"cpu": cpu, "memory": memory}}
+
+
+def admission(pods, nodes, **kwargs):
+    kwargs.setdefault("headroom", 0)
+    return Admission(lambda: pods, lambda: nodes, **kwargs)
+
+
+def test_resource_requests_fall_back_to_limits():
+    assert resource_requests({"limits": {"cpu": "500m", "memory": "128Mi"}}) == (0.5, 128 * 1024 ** 2)
+    assert resource_requests({"requests": {"cpu": "250m"}, "limits": {"cpu": "1", "memory": "1Gi"}}) == (0.25, 1024 ** 3)
+    assert resource_requests({}) == (0.0, 0.0)
+
+
+def test_usage_per_node_and_user():
+    pods = [pod("alice", "c1", "n1", cpu="1"), pod("alice", "c2", "n2", cpu="2"), pod("bob", "c1", None, cpu="500m")]
+    usage = admission(pods, [node("n1"), node("n2")]).usage([node("n1"), node("n2")])
+    assert usage["free"]["n1"][0] == 3
+    assert usage["free"]["n2"][0] == 2
+    assert usage["pending"][0] == 0.5
+    assert usage["users"] == {"alice": 2, "bob": 1}
+
+
+def test_unschedulable_and_tainted_nodes_are_ignored():
+    nodes = [
+        node("cordoned", unschedulable=True),
+        node("not-ready", ready=False),
+        node("tainted", taints=[V1Taint(key="node-role.kubernetes.io/control-plane", effect="NoSchedule")]),
+        node("ok", cpu="1"),
+    ]
+    assert list(admission([], nodes).usage(nodes)["free"]) == ["ok"]
+
+
+def test_admits_within_capacity():
+    a = admission([], [node("n1", cpu="2")])
+    a.admit("alice", "c1", None, resources(cpu="2"))
+    assert a.stats()["admitted"] == 1
+
+
+def test_rejects_pod_larger_than_any_node():
+    # Enough capacity in total, but split over two nodes
+    a = admission([], [node("n1", cpu="1"), node("n2", cpu="1")])
+    with pytest.raises(exceptions.ServiceUnavailable) as e:
+        a.admit("alice", "c1", None, resources(cpu="1500m"))
+    assert e.value.retry_after is not None
+
+
+def test_pending_pods_and_reservations_use_capacity():
+    a = admission([pod("bob", "c1", None, cpu="1")], [node("n1", cpu="2")], max_per_user=0)
+    a.admit("alice", "c1", None, resources(cpu="1"))
+    with pytest.raises(exceptions.ServiceUnavailable):
+        a.admit("carol", "c1", None, resources(cpu="1"))
+
+
+def test_user_quota_counts_pods_and_reservations():
+    a = admission([pod("alice", "c1", "n1")], [node("n1")], max_per_user=2)
+    a.admit("alice", "c2", None, resources())
+    with pytest.raises(exceptions.TooManyRequests) as e:
+        a.admit("alice", "c3", None, resources())
+    assert e.value.retry_after is not None
+    a.admit("bob", "c3", None, resources())
+
+
+def test_competition_quota():
+    pods = [pod("alice", "c1", "n1", competition_id="comp1"), pod("bob", "c1", "n1", competition_id="comp2")]
+    a = admission(pods, [node("n1")], max_per_competition=1)
+    with pytest.raises(exceptions.TooManyRequests):
+        a.admit("carol", "c1", "comp1", resources())
+    a.admit("carol", "c1", "comp3", resources())
+
+
+def test_warm_pool_claims_skip_the_capacity_check():
+    a = admission([], [node("n1", cpu="1")])
+    a.admit("alice", "c1", None, resources(cpu="2"), needs_capacity=False)
+    with pytest.raises(exceptions.ServiceUnavailable):
+        a.admit("bob", "c1", None, resources(cpu="2"))
+
+
+def test_reservation_is_dropped_once_the_pod_exists_or_released():
+    pods = []
+    a = admission(pods, [node("n1", cpu="2")], max_per_user=1)
+    a.admit("alice", "c1", None, resources(cpu="1"))
+    pods.append(pod("alice", "c1", "n1", cpu="1"))
+    assert a.usage([node("n1", cpu="2")])["pending"] == [0.0, 0.0]
+    a.release("alice", "c1")
+    pods.clear()
+    a.admit("alice", "c2", None, resources(cpu="1"))
+
+
+def test_finished_pods_free_their_resources():
+    a = admission([pod("alice", "c1", "n1", cpu="2", phase="Failed")], [node("n1", cpu="2")], max_per_user=0)
+    a.admit("bob", "c1", None, resources(cpu="2"))
+
+
+def test_headroom_is_kept_free():
+    a = admission([], [node("n1", cpu="2")], headroom=0.5)
+    with pytest.raises(exceptions.ServiceUnavailable):
+        a.admit("alice", "c1", None, resources(cpu="1500m"))
+
+
+def pool_node(name, pool, cpu="4"):
+    return node(name, cpu=cpu, labels={NODE_POOL_LABEL: pool},
+                taints=[V1Taint(key=NODE_POOL_LABEL, value=pool, effect="NoSchedule")])
+
+
+def test_pinned_challenges_are_admitted_on_their_pool_only():
+    nodes = [node("general", cpu="1"), pool_node("gpu1", "gpu", cpu="4")]
+    a = admission([pod("bob", "c0", "general", cpu="1")], nodes, max_per_user=0)
+    # The general node is full, the pool still has room
+    a.admit("alice", "c1", None, resources(cpu="2"), **node_placement("pool:gpu"))
+    with pytest.raises(exceptions.ServiceUnavailable):
+        a.admit("carol", "c2", None, resources(cpu="1"))
+    assert list(a.usage(nodes, **node_placement("pool:gpu"))["free"]) == ["gpu1"]
+
+
+def test_full_pool_rejects_even_with_general_capacity():
+    nodes = [node("general", cpu="4"), pool_node("gpu1", "gpu", cpu="2")]
+    a = admission([pod("bob", "c0", "gpu1", cpu="2")], nodes, max_per_user=0)
+    with pytest.raises(exceptions.ServiceUnavailable):
+        a.admit("alice", "c1", None, resources(cpu="1"), **node_placement("pool:gpu"))
+    a.admit("alice", "c1", None, resources(cpu="1"))
+
+
+def test_unscheduled_pods_count_against_their_own_pool():
+    selector = node_placement("pool:gpu")["node_selector"]
+    nodes = [node("general", cpu="2"), pool_node("gpu1", "gpu", cpu="2")]
+    pods = [pod("bob", "c0", None, cpu="2", node_selector=selector)]
+    a = admission(pods, nodes, max_per_user=0)
+    a.admit("alice", "c1", None, resources(cpu="2"))
+    with pytest.raises(exceptions.ServiceUnavailable):
+        a.admit("carol", "c1", None, resources(cpu="1"), **node_placement("pool:gpu"))
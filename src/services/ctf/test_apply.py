@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+from apply import Applier, content_hash, CONTENT_HASH_ANNOTATION
+
+
+def service(port=80):
+    return {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "svc", "namespace": "project"},
+            "spec": {"ports": [{"port": port}]}}
+
+
+class FakeDynamic:
+    """Stands in for the dynamic client, answers an apply with 201 the first time an object is seen"""
+
+    def __init__(self):
+        self.applied = []
+        self.resources = SimpleNamespace(get=lambda api_version, kind: kind)
+
+    def server_side_apply(self, resources, body, namespace, field_manager, force_conflicts, serialize):
+        status = 200 if any(applied["metadata"]["name"] == body["metadata"]["name"] for applied in self.applied) else 201
+        self.applied.append(body)
+        return SimpleNamespace(status=status)
+
+
+def applier():
+    dynamic = FakeDynamic()
+    return Applier(lambda: dynamic, field_manager="test"), dynamic
+
+
+def test_one_apply_creates_then_updates():
+    apply, dynamic = applier()
+    assert apply.apply(service()) == "created"
+    assert apply.apply(service(8080)) == "updated"
+    assert dynamic.applied[0]["metadata"]["annotations"][CONTENT_HASH_ANNOTATION] == content_hash(service())
+
+
+def test_unchanged_manifests_are_not_sent():
+    apply, dynamic = applier()
+    apply.apply(service())
+    assert apply.apply(service()) == "unchanged"
+    assert len(dynamic.applied) == 1
+    assert apply.stats()["unchanged"] == 1
+
+
+def test_live_object_decides_over_the_cache():
+    apply, dynamic = applier()
+    live = SimpleNamespace(metadata=SimpleNamespace(annotations={CONTENT_HASH_ANNOTATION: content_hash(service())}))
+    assert apply.apply(service(), current=live) == "unchanged"
+    live.metadata.annotations = {}
+    assert apply.apply(service(), current=live) == "created"
+
+
+def test_forgotten_objects_are_applied_again():
+    apply, dynamic = applier()
+    apply.apply(service())
+    apply.forget("Service", "project", "svc")
+    apply.apply(service())
+    apply.clear()
+    apply.apply(service())
+    assert len(dynamic.applied) == 3
+
+
+def test_hash_ignores_its_own_annotation():
+    annotated = service()
+    annotated["metadata"]["annotations"] = {CONTENT_HASH_ANNOTATION: "old"}
+    assert content_hash(annotated) == content_hash(service())
+    assert content_hash(service(8080)) != content_hash(service())
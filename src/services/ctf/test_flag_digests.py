@@ -0,0 +1,30 @@
+import hashlib
+import hmac
+from types import SimpleNamespace
+from flask_jwt_extended import decode_token
+import utils
+from utils import flag_digest, notify_challenges_changed
+
+
+def test_flag_digest_is_keyed_with_the_salt():
+    salt = "00" * 16
+    assert flag_digest(salt, "flag{right}") == hmac.new(bytes(16), b"flag{right}", hashlib.sha256).hexdigest()
+    assert flag_digest("11" * 16, "flag{right}") != flag_digest(salt, "flag{right}")
+
+
+def test_changes_are_announced_with_the_service_token(monkeypatch):
+    import app
+    sent = []
+
+    def post(url, json, timeout, headers):
+        sent.append((json, headers))
+        return SimpleNamespace(status_code=200, text="")
+
+    monkeypatch.setattr(utils.requests, "post", post)
+    # Challenge changes are made without a token, the call must not depend on the caller's
+    with app.app.test_request_context("/challenges/x", method="PATCH"):
+        notify_challenges_changed(["x"])
+        (body, headers), = sent
+        claims = decode_token(headers["Authorization"].removeprefix("Bearer "))
+    assert body == {"challenge_ids": ["x"]}
+    assert claims["role"] == "service"
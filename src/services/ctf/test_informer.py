@@ -0,0 +1,122 @@
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from werkzeug import exceptions
+from kubernetes.client import V1ObjectMeta, V1Pod, V1PodList, V1ListMeta
+from informer import PodInformer
+from reaper import Reaper
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+NAME = f"ctf-{CHALLENGE_ID}-alice"
+
+
+def pod(namespace, mode="production", deleting=False, created=None):
+    return V1Pod(metadata=V1ObjectMeta(
+        name=NAME,
+        namespace=namespace,
+        resource_version="1",
+        creation_timestamp=created or datetime.now(timezone.utc),
+        deletion_timestamp=datetime.now(timezone.utc) if deleting else None,
+        labels={"type": "ctf", "username": "alice", "challenge_id": CHALLENGE_ID, "mode": mode},
+    ))
+
+
+def informer(pods):
+    """An informer loaded with the pods by one list of every namespace"""
+    v1 = SimpleNamespace(list_pod_for_all_namespaces=lambda label_selector: V1PodList(
+        items=pods, metadata=V1ListMeta(resource_version="1")))
+    pod_informer = PodInformer(lambda: v1, namespace=None)
+    pod_informer._list(v1)
+    return pod_informer
+
+
+def test_pods_with_the_same_name_in_different_namespaces_are_kept_apart():
+    pods = [pod("ctf-test", mode="test"), pod("ctf-comp-1")]
+    pod_informer = informer(pods)
+    assert len(pod_informer.list()) == 2
+    assert len(pod_informer.by_username("alice")) == 2
+    assert len(pod_informer.by_challenge(CHALLENGE_ID)) == 2
+    assert pod_informer.get(NAME, "ctf-test").metadata.labels["mode"] == "test"
+    assert pod_informer.get(NAME, "ctf-comp-1").metadata.labels["mode"] == "production"
+    assert pod_informer.get(NAME, "project") is None
+
+
+def test_get_without_namespace_prefers_a_pod_that_is_not_being_deleted():
+    pod_informer = informer([pod("a", deleting=True), pod("b")])
+    assert pod_informer.get(NAME).metadata.namespace == "b"
+
+
+def test_reaper_tracks_and_deletes_pods_per_namespace():
+    deleted = []
+    reaper = Reaper(lambda *instance: deleted.append(instance), ttls={"test": 0.1, "production": 0})
+    old = datetime.fromtimestamp(time.time() - 1, timezone.utc)
+    test_pod, other_test_pod = pod("ctf-test", mode="test", created=old), pod("ctf-test-2", mode="test", created=old)
+    reaper.on_pod_event("ADDED", test_pod)
+    reaper.on_pod_event("ADDED", other_test_pod)
+    assert reaper.stats()["tracked"] == 2
+    reaper.on_pod_event("DELETED", other_test_pod)
+    assert reaper.stats()["tracked"] == 1
+
+    reaper.start()
+    for _ in range(50):
+        if deleted:
+            break
+        time.sleep(0.02)
+    assert deleted == [(CHALLENGE_ID, "alice", "ctf-test", "test")]
+
+
+def named(name, version="1", username="alice"):
+    return V1Pod(metadata=V1ObjectMeta(name=name, namespace="project", resource_version=version,
+                                       labels={"type": "ctf", "username": username, "challenge_id": CHALLENGE_ID}))
+
+
+class FakeWatch:
+    """Stands in for kubernetes.watch.Watch, streams the given events"""
+    events = []
+
+    def stream(self, func, *args, **kwargs):
+        yield from type(self).events
+
+
+def test_relist_tells_listeners_what_changed():
+    pod_informer = informer([named("a"), named("b")])
+    seen = []
+    pod_informer.add_listener(lambda event_type, pod: seen.append((event_type, pod.metadata.name)))
+    v1 = SimpleNamespace(list_pod_for_all_namespaces=lambda label_selector: V1PodList(
+        items=[named("a"), named("b", version="2"), named("c")], metadata=V1ListMeta(resource_version="2")))
+    pod_informer._list(v1)
+    assert sorted(seen) == [("ADDED", "c"), ("MODIFIED", "b")]
+
+    v1.list_pod_for_all_namespaces = lambda label_selector: V1PodList(items=[named("c")], metadata=V1ListMeta(resource_version="3"))
+    pod_informer._list(v1)
+    assert sorted(seen[2:]) == [("DELETED", "a"), ("DELETED", "b")]
+    assert [pod.metadata.name for pod in pod_informer.by_username("alice")] == ["c"]
+
+
+def test_watch_events_update_the_cache_and_its_indexes(monkeypatch):
+    monkeypatch.setattr("informer.watch.Watch", FakeWatch)
+    pod_informer = informer([named("a")])
+    seen = []
+    pod_informer.add_listener(lambda event_type, pod: seen.append(event_type))
+    pod_informer.add_listener(lambda event_type, pod: 1 / 0)
+    FakeWatch.events = [
+        {"type": "ADDED", "object": named("b", version="2", username="bob")},
+        {"type": "MODIFIED", "object": named("a", version="3", username="carol")},
+        {"type": "DELETED", "object": named("b", version="4", username="bob")},
+        {"type": "BOOKMARK", "object": V1Pod(metadata=V1ObjectMeta(resource_version="5"))},
+    ]
+    pod_informer._watch(SimpleNamespace(list_pod_for_all_namespaces=None))
+    # A failing listener does not keep the others from their events
+    assert seen == ["ADDED", "MODIFIED", "DELETED"]
+    assert pod_informer.get("b") is None
+    assert pod_informer.by_username("alice") == []
+    assert pod_informer.by_username("carol")[0].metadata.resource_version == "3"
+    assert pod_informer.stats()["resource_version"] == "5"
+
+
+def test_reads_wait_for_the_first_list():
+    pod_informer = PodInformer(lambda: None)
+    pod_informer._started = True
+    with pytest.raises(exceptions.ServiceUnavailable):
+        pod_informer.wait_for_sync(timeout=0.01)
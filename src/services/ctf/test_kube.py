@@ -0,0 +1,58 @@
+import os
+import time
+from kubernetes import client
+import kube
+from kube import KubeClients
+from ratelimit import RateLimiter, LimitedRestClient
+
+
+class Loader:
+    def __init__(self):
+        self.loads = 0
+
+    def __call__(self):
+        self.loads += 1
+        configuration = client.Configuration()
+        configuration.host = "https://kubernetes.invalid"
+        return configuration
+
+
+def test_one_client_is_shared(tmp_path):
+    credentials = tmp_path / "token"
+    credentials.write_text("a")
+    load = Loader()
+    kube_clients = KubeClients(load, str(credentials), pool_size=7)
+    assert kube_clients.api_client() is kube_clients.api_client()
+    assert kube_clients.core().api_client is kube_clients.apps().api_client
+    assert kube_clients.api_client().configuration.connection_pool_maxsize == 7
+    assert load.loads == 1
+
+
+def test_client_is_rebuilt_when_the_credentials_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(kube, "KUBE_CREDENTIALS_CHECK", 0)
+    credentials = tmp_path / "token"
+    credentials.write_text("a")
+    load = Loader()
+    kube_clients = KubeClients(load, str(credentials))
+    first = kube_clients.api_client()
+    assert kube_clients.api_client() is first
+    os.utime(credentials, (time.time() + 60, time.time() + 60))
+    assert kube_clients.api_client() is not first
+    assert kube_clients.stats()["config_loads"] == 2
+
+
+def test_requests_go_through_the_limiter(tmp_path):
+    limiter = RateLimiter()
+    kube_clients = KubeClients(Loader(), str(tmp_path / "missing"), limiter=limiter)
+    assert isinstance(kube_clients.api_client().rest_client, LimitedRestClient)
+
+
+def test_stale_discovery_cache_is_removed(tmp_path):
+    cache = tmp_path / "discovery.json"
+    cache.write_text("{}")
+    kube_clients = KubeClients(Loader(), str(tmp_path / "token"), discovery_cache=str(cache), discovery_ttl=3600)
+    kube_clients._expire_discovery_file()
+    assert cache.exists()
+    os.utime(cache, (time.time() - 7200, time.time() - 7200))
+    kube_clients._expire_discovery_file()
+    assert not cache.exists()
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+import namespaces
+from namespaces import Namespaces, generate_namespace_manifests, namespace_for, DEFAULT_NAMESPACE, TEST_NAMESPACE, NAMESPACE_PREFIX
+
+COMPETITION_ID = "5f0c8a3e-7d2b-4e1a-9c6f-2b3d4e5f6a7b"
+
+
+def challenge(cpu="500m", memory="256Mi", warm_pool_max=0):
+    return SimpleNamespace(resource_limits=str({"resources": {"limits": {"cpu": cpu, "memory": memory}}}),
+                           warm_pool_min=0, warm_pool_max=warm_pool_max)
+
+
+def by_kind(manifests):
+    return {manifest["kind"]: manifest for manifest in manifests}
+
+
+def test_namespace_follows_the_mode(monkeypatch):
+    assert namespace_for(COMPETITION_ID, "production") == DEFAULT_NAMESPACE
+    monkeypatch.setattr(namespaces, "NAMESPACE_MODE", "per-competition")
+    assert namespace_for(COMPETITION_ID, "production") == NAMESPACE_PREFIX + COMPETITION_ID
+    assert namespace_for(COMPETITION_ID, "test") == TEST_NAMESPACE
+    assert namespace_for(None, "production") == DEFAULT_NAMESPACE
+
+
+def test_limits_and_quota_are_sized_from_the_largest_challenge():
+    manifests = by_kind(generate_namespace_manifests("ctf-comp-x", COMPETITION_ID, [challenge(), challenge("1", "1Gi", 2)], max_instances=10))
+    limits, = manifests["LimitRange"]["spec"]["limits"]
+    assert limits["max"] == {"cpu": "1.0", "memory": str(1024 ** 3)}
+    hard = manifests["ResourceQuota"]["spec"]["hard"]
+    assert hard["pods"] == "12"
+    assert hard["requests.cpu"] == "12.0"
+    assert manifests["Namespace"]["metadata"]["labels"]["competition_id"] == COMPETITION_ID
+    assert manifests["ReferenceGrant"]["spec"]["from"][0]["namespace"] == "ctf-comp-x"
+
+
+def test_unlimited_instances_get_no_quota():
+    manifests = by_kind(generate_namespace_manifests("ctf-test", challenges=[challenge()], max_instances=0))
+    assert "ResourceQuota" not in manifests
+    assert "LimitRange" in manifests
+
+
+class FakeCluster:
+    def __init__(self, existing=()):
+        self.applied, self.deleted = [], []
+        self.existing = list(existing)
+
+    def namespaces(self, **kwargs):
+        return Namespaces(self.applied.append, self.deleted.append, lambda: self.existing, lambda competition_id: [challenge()], **kwargs)
+
+
+def test_namespace_is_applied_once_until_refreshed():
+    cluster = FakeCluster()
+    ns = cluster.namespaces()
+    ns.ensure("ctf-comp-x", COMPETITION_ID)
+    applied = len(cluster.applied)
+    ns.ensure("ctf-comp-x", COMPETITION_ID)
+    assert len(cluster.applied) == applied
+    ns.refresh("ctf-comp-x")
+    ns.ensure("ctf-comp-x", COMPETITION_ID)
+    assert len(cluster.applied) == 2 * applied
+    assert ns.ensure(DEFAULT_NAMESPACE) == DEFAULT_NAMESPACE
+    assert ns.stats()["applied"] == 2
+
+
+def test_names_cover_existing_and_ensured_namespaces(monkeypatch):
+    monkeypatch.setattr(namespaces, "NAMESPACE_MODE", "per-competition")
+    cluster = FakeCluster(existing=["ctf-comp-old"])
+    ns = cluster.namespaces()
+    ns.ensure("ctf-comp-new")
+    assert ns.names() == ["ctf-comp-new", "ctf-comp-old", DEFAULT_NAMESPACE]
+    ns.delete("ctf-comp-old")
+    assert cluster.deleted == ["ctf-comp-old"]
+    assert ns.names() == ["ctf-comp-new", DEFAULT_NAMESPACE]
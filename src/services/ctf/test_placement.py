@@ -0,0 +1,70 @@
+import pytest
+from werkzeug import exceptions
+from placement import validate_placement, NODE_POOL_LABEL
+from utils import generate_pod_dict, generate_warm_pod_dict, generate_shared_manifests
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+RESOURCES = {"limits": {"cpu": "500m", "memory": "256Mi"}}
+
+
+def pod(placement="default", mode="production"):
+    return generate_pod_dict(CHALLENGE_ID, "alice", "nginx:latest", RESOURCES, mode, "web", placement=placement)
+
+
+def test_default_placement_leaves_scheduling_alone():
+    spec = pod()["spec"]
+    assert "topologySpreadConstraints" not in spec
+    assert "affinity" not in spec
+    assert "nodeSelector" not in spec
+    assert "annotations" not in pod()["metadata"]
+
+
+def test_spread_keeps_a_challenges_instances_apart():
+    constraint, = pod("spread")["spec"]["topologySpreadConstraints"]
+    assert constraint["topologyKey"] == "kubernetes.io/hostname"
+    assert constraint["maxSkew"] == 1
+    assert constraint["whenUnsatisfiable"] == "ScheduleAnyway"
+    assert constraint["labelSelector"]["matchLabels"] == {"challenge_id": CHALLENGE_ID, "type": "ctf"}
+
+
+def test_binpack_prefers_busy_nodes_and_may_be_evicted():
+    manifest = pod("binpack")
+    term, = manifest["spec"]["affinity"]["podAffinity"]["preferredDuringSchedulingIgnoredDuringExecution"]
+    assert term["podAffinityTerm"]["topologyKey"] == "kubernetes.io/hostname"
+    assert term["podAffinityTerm"]["labelSelector"]["matchLabels"] == {"type": "ctf"}
+    assert manifest["metadata"]["annotations"] == {"cluster-autoscaler.kubernetes.io/safe-to-evict": "true"}
+
+
+def test_pool_pins_to_the_pool_and_tolerates_its_taint():
+    spec = pod("pool:gpu")["spec"]
+    assert spec["nodeSelector"] == {NODE_POOL_LABEL: "gpu"}
+    assert spec["tolerations"] == [{"key": NODE_POOL_LABEL, "operator": "Equal", "value": "gpu", "effect": "NoSchedule"}]
+
+
+@pytest.mark.parametrize("mode, priority_class", [("production", "ctf-production"), ("test", "ctf-test")])
+def test_priority_class_follows_the_mode(mode, priority_class):
+    assert pod(mode=mode)["spec"]["priorityClassName"] == priority_class
+
+
+def test_warm_pods_are_placed_like_instances():
+    spec = generate_warm_pod_dict(CHALLENGE_ID, "nginx:latest", RESOURCES, "web", placement="spread")["spec"]
+    assert spec["priorityClassName"] == "ctf-production"
+    assert spec["topologySpreadConstraints"][0]["labelSelector"]["matchLabels"]["challenge_id"] == CHALLENGE_ID
+
+
+def test_shared_deployment_template_carries_the_placement():
+    deployment = generate_shared_manifests(CHALLENGE_ID, "nginx:latest", RESOURCES, "web", 2, placement="binpack")[0]
+    template = deployment["spec"]["template"]
+    assert "podAffinity" in template["spec"]["affinity"]
+    assert template["metadata"]["annotations"] == {"cluster-autoscaler.kubernetes.io/safe-to-evict": "true"}
+
+
+@pytest.mark.parametrize("value", ["default", "spread", "binpack", "pool:gpu"])
+def test_valid_placements(value):
+    assert validate_placement(value) == value
+
+
+@pytest.mark.parametrize("value", ["", "pack", "pool:", None])
+def test_invalid_placements(value):
+    with pytest.raises(exceptions.BadRequest):
+        validate_placement(value)
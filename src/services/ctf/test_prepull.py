@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+import pytest
+from prepull import PrePuller, generate_prepull_dict, node_pull_state, prepull_name
+
+IMAGE = "registry.example.com/web:1"
+
+
+def pod(node, image_id=None, waiting=None):
+    status = SimpleNamespace(image_id=image_id, state=SimpleNamespace(waiting=SimpleNamespace(reason=waiting) if waiting else None))
+    return SimpleNamespace(spec=SimpleNamespace(node_name=node), status=SimpleNamespace(init_container_statuses=[status]))
+
+
+class FakeCluster:
+    """Records applied and deleted DaemonSets, observe answers with desired and pods"""
+
+    def __init__(self, desired=2, pods=()):
+        self.applied, self.deleted = [], []
+        self.desired, self.pods = desired, list(pods)
+        self.leftovers = []
+
+    def prepuller(self, **kwargs):
+        return PrePuller(self.applied.append, self.deleted.append, lambda name: (self.desired, self.pods),
+                         self.list_names, **kwargs)
+
+    def list_names(self):
+        names = self.leftovers + [manifest["metadata"]["name"] for manifest in self.applied]
+        return [name for name in names if name not in self.deleted]
+
+
+@pytest.mark.parametrize("pull_pod, state", [
+    (pod("a", image_id="sha256:1"), "pulled"),
+    (pod("a", waiting="ImagePullBackOff"), "failed"),
+    (pod("a", waiting="CrashLoopBackOff"), "pulled"),
+    (pod("a", waiting="PodInitializing"), "pulling"),
+    (SimpleNamespace(status=None), "pulling"),
+])
+def test_node_pull_state(pull_pod, state):
+    assert node_pull_state(pull_pod) == state
+
+
+def test_daemonset_pulls_the_image_on_every_node():
+    manifest = generate_prepull_dict(IMAGE)
+    assert manifest["metadata"]["name"] == prepull_name(IMAGE)
+    assert manifest["spec"]["template"]["spec"]["initContainers"][0]["image"] == IMAGE
+    assert manifest["spec"]["template"]["spec"]["tolerations"] == [{"operator": "Exists"}]
+
+
+def test_pull_finishes_once_every_node_has_the_image():
+    cluster = FakeCluster(desired=2, pods=[pod("a", image_id="sha256:1"), pod("b")])
+    prepuller = cluster.prepuller()
+    assert prepuller.submit(IMAGE)["status"] == "pulling"
+    # A second submit while pulling does not apply again
+    prepuller.submit(IMAGE)
+    assert len(cluster.applied) == 1
+
+    prepuller.sweep()
+    assert prepuller.status(IMAGE)["nodes"] == {"a": "pulled", "b": "pulling"}
+    assert cluster.deleted == []
+
+    cluster.pods[1] = pod("b", image_id="sha256:1")
+    prepuller.sweep()
+    assert prepuller.status(IMAGE)["status"] == "pulled"
+    assert cluster.deleted == [prepull_name(IMAGE)]
+
+
+def test_failed_pull_is_reported_and_cleaned_up():
+    cluster = FakeCluster(desired=1, pods=[pod("a", waiting="ErrImagePull")])
+    prepuller = cluster.prepuller()
+    prepuller.submit(IMAGE)
+    prepuller.sweep()
+    assert prepuller.status(IMAGE)["status"] == "failed"
+    assert cluster.deleted == [prepull_name(IMAGE)]
+
+
+def test_slow_pull_times_out():
+    cluster = FakeCluster(desired=2, pods=[pod("a")])
+    prepuller = cluster.prepuller(timeout=0)
+    prepuller.submit(IMAGE)
+    prepuller.sweep()
+    assert prepuller.status(IMAGE)["status"] == "timeout"
+
+
+def test_daemonsets_left_by_a_restart_are_deleted():
+    cluster = FakeCluster()
+    cluster.leftovers = ["prepull-old"]
+    prepuller = cluster.prepuller()
+    prepuller.sweep()
+    assert cluster.deleted == ["prepull-old"]
+    assert prepuller.status(IMAGE)["status"] == "unknown"
+
+
+def test_prepull_endpoint_is_for_admins():
+    import app
+    from flask_jwt_extended import create_access_token
+    with app.app.app_context():
+        token = create_access_token(identity="alice", additional_claims={"role": "developer"})
+    client = app.app.test_client()
+    assert client.post("/prepull", json={"challenge_ids": []}).status_code == 401
+    assert client.post("/prepull", json={"challenge_ids": []}, headers={"Authorization": f"Bearer {token}"}).status_code == 403
@@ -0,0 +1,80 @@
+import threading
+import time
+import pytest
+from kubernetes.client.exceptions import ApiException
+from werkzeug import exceptions
+from provisioning import Provisioner, describe_error
+
+
+def finished(provisioner, job, timeout=2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        current = provisioner.job(job["id"])
+        if current["status"] in ["succeeded", "failed"]:
+            return current
+        time.sleep(0.01)
+    raise AssertionError(f"job {job['id']} did not finish")
+
+
+def step(name, result="created", deleted=None):
+    def create():
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return name, create, lambda: deleted.append(name) if deleted is not None else None
+
+
+def test_job_is_queued_and_runs_its_steps():
+    provisioner = Provisioner(workers=1)
+    succeeded = threading.Event()
+    job = provisioner.submit("alice", "challenge", "production", [step("pod"), step("service", "unchanged"), step("route", False)],
+                             on_succeeded=succeeded.set)
+    job = finished(provisioner, job)
+    assert job["status"] == "succeeded"
+    assert job["steps"] == {"pod": "created", "service": "unchanged", "route": "updated"}
+    assert succeeded.wait(1)
+    assert provisioner.latest("alice", "challenge")["id"] == job["id"]
+
+
+def test_failed_job_rolls_back_what_it_created():
+    provisioner = Provisioner(workers=1)
+    deleted = []
+    failed = threading.Event()
+    job = provisioner.submit("alice", "challenge", "production", [
+        step("pod", deleted=deleted), step("service", "unchanged", deleted), step("route", ApiException(status=409), deleted),
+    ], on_failed=failed.set)
+    job = finished(provisioner, job)
+    assert job["status"] == "failed"
+    assert job["error"] == "route: already exists"
+    assert job["steps"]["pod"] == "rolled back"
+    # Only what the job created is deleted, the unchanged Service was there before
+    assert deleted == ["pod"]
+    assert failed.wait(1)
+    assert provisioner.stats()["rolled_back"] == 1
+
+
+def test_full_queue_refuses_new_jobs():
+    provisioner = Provisioner(workers=1, max_queue=1)
+    release = threading.Event()
+    blocking = ("pod", lambda: release.wait(2), lambda: None)
+    first = provisioner.submit("alice", "a", "production", [blocking])
+    while provisioner.job(first["id"])["status"] == "queued":
+        time.sleep(0.01)
+    provisioner.submit("bob", "a", "production", [step("pod")])
+    with pytest.raises(exceptions.ServiceUnavailable):
+        provisioner.submit("carol", "a", "production", [step("pod")])
+    release.set()
+
+
+def test_finished_jobs_are_pruned():
+    provisioner = Provisioner(workers=1, job_ttl=0)
+    job = finished(provisioner, provisioner.submit("alice", "a", "production", [step("pod")]))
+    time.sleep(0.01)
+    provisioner.submit("bob", "a", "production", [step("pod")])
+    assert provisioner.job(job["id"]) is None
+    assert provisioner.latest("alice", "a") is None
+
+
+def test_describe_error():
+    assert describe_error(ApiException(status=403, reason="Forbidden")) == "403 Forbidden"
+    assert describe_error(ValueError("bad manifest")) == "bad manifest"
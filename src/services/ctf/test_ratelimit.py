@@ -0,0 +1,147 @@
+import threading
+import time
+import pytest
+from kubernetes.client.exceptions import ApiException
+from werkzeug import exceptions
+from ratelimit import RateLimiter, LimitedRestClient, parse_retry_after, retryable
+
+
+class FakeResponse:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.drained = False
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self):
+        self.drained = True
+
+
+class FakeRestClient:
+    """Answers with the given statuses in turn, raising ApiException for errors like older clients do"""
+
+    def __init__(self, *answers, raise_errors=True):
+        self.answers = list(answers)
+        self.raise_errors = raise_errors
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, time.monotonic()))
+        status, headers = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+        if status >= 400 and self.raise_errors:
+            error = ApiException(status=status)
+            error.headers = headers
+            raise error
+        return FakeResponse(status, headers)
+
+
+def limited(rest_client, limiter=None, **kwargs):
+    return LimitedRestClient(rest_client, limiter or RateLimiter(qps=0, burst=1), backoff_base=0.01, **kwargs)
+
+
+def test_burst_then_paced_at_qps():
+    limiter = RateLimiter(qps=50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        limiter.acquire("background")
+    # 5 from the burst, the other 10 at 50 per second
+    assert time.monotonic() - start >= 0.18
+    assert limiter.stats()["lanes"]["background"]["requests"] == 15
+
+
+def test_interactive_goes_before_background():
+    limiter = RateLimiter(qps=20, burst=1)
+    limiter.acquire("background")
+    order = []
+
+    def call(lane):
+        limiter.acquire(lane)
+        order.append(lane)
+
+    background = [threading.Thread(target=call, args=("background",)) for _ in range(3)]
+    for thread in background:
+        thread.start()
+    time.sleep(0.01)
+    interactive = threading.Thread(target=call, args=("interactive",))
+    interactive.start()
+    for thread in background + [interactive]:
+        thread.join()
+    # The first background call may have been next in line already, the interactive one overtakes the rest
+    assert order.index("interactive") <= 1
+
+
+def test_interactive_wait_is_bounded():
+    limiter = RateLimiter(qps=1, burst=1, interactive_wait=0.05)
+    limiter.acquire("interactive")
+    with pytest.raises(exceptions.ServiceUnavailable):
+        limiter.acquire("interactive")
+    assert limiter.stats()["timeouts"] == 1
+
+
+def test_lane_follows_the_thread():
+    limiter = RateLimiter(default_lane=lambda: "background")
+    assert limiter.current_lane() == "background"
+    with limiter.lane("interactive"):
+        assert limiter.current_lane() == "interactive"
+    assert limiter.in_lane("interactive", limiter.current_lane)() == "interactive"
+
+
+def test_throttled_call_is_retried():
+    rest = FakeRestClient((429, {}), (429, {}), (200, {}))
+    response = limited(rest).request("GET", "/api/v1/pods")
+    assert response.status == 200
+    assert len(rest.calls) == 3
+
+
+def test_retry_after_is_honoured():
+    limiter = RateLimiter(qps=0, burst=1)
+    rest = FakeRestClient((429, {"Retry-After": "0.2"}), (200, {}))
+    limited(rest, limiter).request("DELETE", "/api/v1/namespaces/project/pods/x")
+    assert rest.calls[1][2] - rest.calls[0][2] >= 0.2
+    assert limiter.stats()["throttled"] == 1
+    assert limiter.stats()["pauses"] == 1
+
+
+def test_long_retry_after_fails_fast_but_pauses():
+    limiter = RateLimiter(qps=0, burst=1)
+    rest = FakeRestClient((429, {"Retry-After": "60"}))
+    with pytest.raises(ApiException):
+        limited(rest, limiter).request("GET", "/api/v1/pods")
+    assert len(rest.calls) == 1
+    assert limiter.stats()["paused_for"] > 50
+
+
+def test_server_errors_are_not_retried_for_creates():
+    rest = FakeRestClient((503, {}), (201, {}))
+    with pytest.raises(ApiException):
+        limited(rest).request("POST", "/api/v1/namespaces/project/pods")
+    assert len(rest.calls) == 1
+
+
+def test_retries_give_up():
+    rest = FakeRestClient((500, {}))
+    with pytest.raises(ApiException):
+        limited(rest, max_retries=2).request("GET", "/api/v1/pods")
+    assert len(rest.calls) == 3
+
+
+def test_error_responses_without_exceptions_are_retried():
+    rest = FakeRestClient((503, {}), (200, {}), raise_errors=False)
+    assert limited(rest).request("PATCH", "/apis/apps/v1/deployments/x").status == 200
+    assert len(rest.calls) == 2
+
+
+@pytest.mark.parametrize("method, status, expected", [
+    ("POST", 429, True), ("GET", 503, True), ("POST", 500, False), ("GET", 404, False), ("GET", 200, False),
+])
+def test_retryable(method, status, expected):
+    assert retryable(method, status) == expected
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
@@ -0,0 +1,74 @@
+import threading
+import time
+from kubernetes.client import V1ObjectMeta, V1Pod, V1PodStatus, V1PodCondition
+from readiness import ReadinessTracker
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+
+
+def pod(ready):
+    return V1Pod(
+        metadata=V1ObjectMeta(name=f"ctf-{CHALLENGE_ID}-alice", namespace="project",
+                              labels={"challenge_id": CHALLENGE_ID, "username": "alice"}),
+        status=V1PodStatus(conditions=[V1PodCondition(type="Ready", status="True" if ready else "False")]),
+    )
+
+
+class FakeInformer:
+    def __init__(self):
+        self.pods = []
+
+    def by_username(self, username):
+        return self.pods
+
+
+def tracker(max_waiters=4):
+    informer, marked = FakeInformer(), []
+    return ReadinessTracker(informer, lambda keys, state: marked.append((keys, state)), max_waiters, buckets=[1, 10]), informer, marked
+
+
+def test_poll_returns_when_the_pod_becomes_ready():
+    readiness, informer, _ = tracker()
+    informer.pods = [pod(ready=False)]
+    result = []
+    poll = threading.Thread(target=lambda: result.append(readiness.wait(CHALLENGE_ID, "alice", timeout=5)))
+    start = time.monotonic()
+    poll.start()
+    time.sleep(0.05)
+    informer.pods = [pod(ready=True)]
+    readiness.on_pod_event("MODIFIED", informer.pods[0])
+    poll.join()
+    assert time.monotonic() - start < 1
+    assert result[0] is informer.pods[0]
+
+
+def test_poll_times_out_with_the_current_state():
+    readiness, informer, _ = tracker()
+    informer.pods = [pod(ready=False)]
+    assert readiness.wait(CHALLENGE_ID, "alice", timeout=0.05) is informer.pods[0]
+    informer.pods = []
+    assert readiness.wait(CHALLENGE_ID, "alice", timeout=5) is None
+    assert readiness.stats()["poll_timeouts"] == 1
+
+
+def test_polls_beyond_max_waiters_are_answered_right_away():
+    readiness, informer, _ = tracker(max_waiters=0)
+    informer.pods = [pod(ready=False)]
+    start = time.monotonic()
+    readiness.wait(CHALLENGE_ID, "alice", timeout=5)
+    assert time.monotonic() - start < 1
+    assert readiness.stats()["polls_rejected"] == 1
+
+
+def test_open_to_ready_is_recorded_and_marked():
+    readiness, _, marked = tracker()
+    readiness.opened(CHALLENGE_ID, "alice")
+    readiness.on_pod_event("MODIFIED", pod(ready=False))
+    readiness.on_pod_event("MODIFIED", pod(ready=True))
+    # A second Ready event of the same pod is not another open
+    readiness.on_pod_event("MODIFIED", pod(ready=True))
+    histogram = readiness.stats()["open_to_ready_seconds"][CHALLENGE_ID]
+    assert histogram["count"] == 1
+    assert histogram["buckets"] == {"1": 1, "10": 1, "+Inf": 1}
+    readiness._executor.shutdown(wait=True)
+    assert marked == [([("alice", CHALLENGE_ID)], "ready")]
@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, timezone
+from kubernetes.client import V1ObjectMeta, V1Pod
+import reaper as reaper_module
+from reaper import Reaper, CLAIMED_AT_ANNOTATION
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+
+
+def pod(username, age, mode="test", claimed_at=None, warm=False):
+    labels = {"challenge_id": CHALLENGE_ID, "mode": mode}
+    if not warm:
+        labels["username"] = username
+    return V1Pod(metadata=V1ObjectMeta(
+        name=f"ctf-{CHALLENGE_ID}-{username}", namespace="project", labels=labels,
+        creation_timestamp=datetime.fromtimestamp(time.time() - age, timezone.utc),
+        annotations={CLAIMED_AT_ANNOTATION: str(claimed_at)} if claimed_at is not None else None,
+    ))
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_deadline_follows_the_mode_and_the_claim():
+    reaper = Reaper(lambda *instance: None, ttls={"test": 600, "production": 0})
+    created = pod("alice", age=100)
+    assert abs(reaper.deadline(created) - (created.metadata.creation_timestamp.timestamp() + 600)) < 0.001
+    assert reaper.deadline(pod("alice", age=100, claimed_at=1000.0)) == 1600.0
+    assert reaper.deadline(pod("alice", age=100, mode="production")) is None
+    assert reaper.deadline(pod("alice", age=100, warm=True)) is None
+
+
+def test_instances_are_deleted_in_deadline_order():
+    deleted = []
+    reaper = Reaper(lambda *instance: deleted.append(instance[1]), ttls={"test": 1})
+    reaper.on_pod_event("ADDED", pod("later", age=0.8))
+    reaper.on_pod_event("ADDED", pod("first", age=1))
+    reaper.on_pod_event("ADDED", pod("last", age=0))
+    reaper.start()
+    assert wait_for(lambda: len(deleted) == 2)
+    assert deleted == ["first", "later"]
+    assert reaper.stats()["tracked"] == 3
+
+
+def test_deleted_pods_are_not_reaped():
+    deleted = []
+    reaper = Reaper(lambda *instance: deleted.append(instance), ttls={"test": 0.2})
+    closed = pod("alice", age=0)
+    reaper.on_pod_event("ADDED", closed)
+    reaper.on_pod_event("DELETED", closed)
+    reaper.start()
+    time.sleep(0.3)
+    assert deleted == []
+
+
+def test_failed_deletions_are_retried(monkeypatch):
+    monkeypatch.setattr(reaper_module, "REAPER_RETRY_AFTER", 0.05)
+    attempts = []
+
+    def delete(*instance):
+        attempts.append(instance)
+        if len(attempts) == 1:
+            raise RuntimeError("API server is down")
+
+    reaper = Reaper(delete, ttls={"test": 1})
+    reaper.on_pod_event("ADDED", pod("alice", age=2))
+    reaper.start()
+    assert wait_for(lambda: len(attempts) == 2)
+    assert reaper.stats()["failures"] == 1
+    assert wait_for(lambda: reaper.stats()["reaped"] == 1)
@@ -0,0 +1,154 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from kubernetes.client import V1ObjectMeta, V1Pod, V1PodStatus, V1PodCondition
+from reconciler import Reconciler, instance_key
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+COMPETITION_ID = "5f0c8a3e-7d2b-4e1a-9c6f-2b3d4e5f6a7b"
+OLD = datetime.now(timezone.utc) - timedelta(hours=1)
+
+
+def instance(username, expired=False, state="running", age=3600, mode="production"):
+    return {"username": username, "challenge_id": CHALLENGE_ID, "competition_id": COMPETITION_ID, "mode": mode,
+            "state": state, "age_seconds": age, "expired": expired}
+
+
+def pod(username, ready=False):
+    return V1Pod(
+        metadata=V1ObjectMeta(name=instance_key(CHALLENGE_ID, username), namespace="project", creation_timestamp=OLD, labels={
+            "username": username, "challenge_id": CHALLENGE_ID, "ctf-id-username": instance_key(CHALLENGE_ID, username)}),
+        status=V1PodStatus(conditions=[V1PodCondition(type="Ready", status="True" if ready else "False")]),
+    )
+
+
+def obj(username):
+    return SimpleNamespace(metadata=V1ObjectMeta(
+        name=instance_key(CHALLENGE_ID, username), namespace="project", creation_timestamp=OLD,
+        labels={"ctf-id-username": instance_key(CHALLENGE_ID, username)}))
+
+
+class Cluster:
+    """Stands in for the informer, the instances table and the Kubernetes calls, recording what the reconciler does"""
+
+    def __init__(self, instances, pods, services=(), routes=()):
+        self.instances = list(instances)
+        self.pods = list(pods)
+        self.objects = {"service": list(services), "route": list(routes)}
+        self.calls = []
+
+    def list(self):
+        return self.pods
+
+    def adopt(self, rows):
+        self.calls.append(("adopt", rows))
+        self.instances += [instance(username, mode=mode) for username, _, _, mode in rows]
+
+    def reconciler(self, **kwargs):
+        return Reconciler(
+            self,
+            read=lambda: self.instances,
+            list_objects=lambda kind: self.objects[kind],
+            repair=lambda instance, kinds: self.calls.append(("repair", instance["username"], kinds)),
+            delete_object=lambda kind, name, namespace: self.calls.append(("delete", kind, name)),
+            expire=lambda instance: self.calls.append(("expire", instance["username"])),
+            mark=lambda keys, state: self.calls.append(("mark", keys, state)),
+            adopt=self.adopt,
+            **kwargs,
+        )
+
+
+def test_pass_repairs_expires_deletes_orphans_and_marks_ready():
+    cluster = Cluster(
+        [instance("alice"), instance("bob", expired=True), instance("carol")],
+        [pod("alice", ready=True), pod("bob"), pod("carol"), pod("mallory")],
+        services=[obj("alice"), obj("bob"), obj("carol")],
+        routes=[obj("alice"), obj("bob")],
+    )
+    reconciler = cluster.reconciler()
+    reconciler._passes = 1
+    reconciler.reconcile()
+    assert ("repair", "carol", ["route"]) in cluster.calls
+    assert ("expire", "bob") in cluster.calls
+    assert ("delete", "pod", instance_key(CHALLENGE_ID, "mallory")) in cluster.calls
+    assert ("mark", [("alice", CHALLENGE_ID)], "ready") in cluster.calls
+    assert reconciler.stats()["expired"] == 1
+
+
+def test_failing_expiry_does_not_stop_the_pass():
+    cluster = Cluster([instance("alice", expired=True)], [pod("alice"), pod("mallory")])
+    reconciler = cluster.reconciler()
+    reconciler._passes = 1
+
+    def expire(instance):
+        raise RuntimeError("API server is down")
+
+    reconciler._expire = expire
+    reconciler.reconcile()
+    assert ("delete", "pod", instance_key(CHALLENGE_ID, "mallory")) in cluster.calls
+    assert cluster.calls[-1] == ("mark", [], "ready")
+
+
+def test_first_pass_adopts_pods_without_a_record():
+    cluster = Cluster([], [pod("alice")])
+    reconciler = cluster.reconciler()
+    reconciler.reconcile()
+    assert ("adopt", [("alice", CHALLENGE_ID, None, "production")]) in cluster.calls
+    assert not any(call[0] == "delete" for call in cluster.calls)
+
+
+def test_young_and_provisioning_instances_are_left_alone():
+    cluster = Cluster([instance("alice", age=1), instance("bob", state="provisioning", age=200)], [])
+    reconciler = cluster.reconciler()
+    reconciler._passes = 1
+    reconciler.reconcile()
+    assert not any(call[0] == "repair" for call in cluster.calls)
+
+
+def test_app_expires_recorded_instances_in_their_namespace(monkeypatch):
+    import app
+    calls = []
+    monkeypatch.setattr(app, "delete_instance", lambda *args: calls.append(("delete_instance", *args)))
+    monkeypatch.setattr(app, "remove_instances_matching", lambda *args: calls.append(("remove", *args)))
+    app.reconciler._expire(instance("alice", expired=True, mode="test"))
+    assert calls == [
+        ("delete_instance", CHALLENGE_ID, "alice", app.namespace_for(COMPETITION_ID, "test")),
+        ("remove", [CHALLENGE_ID], "alice", "test"),
+    ]
+
+
+def test_young_orphans_are_kept():
+    young = pod("mallory")
+    young.metadata.creation_timestamp = datetime.now(timezone.utc)
+    cluster = Cluster([], [young])
+    reconciler = cluster.reconciler()
+    reconciler._passes = 1
+    reconciler.reconcile()
+    assert not any(call[0] == "delete" for call in cluster.calls)
+
+
+def test_repairs_and_deletions_per_pass_are_bounded():
+    cluster = Cluster([instance(f"user{i}") for i in range(5)], [pod(f"orphan{i}") for i in range(5)])
+    reconciler = cluster.reconciler(batch=3)
+    reconciler._passes = 1
+    reconciler.reconcile()
+    assert len([call for call in cluster.calls if call[0] in ["repair", "delete"]]) == 3
+    reconciler.reconcile()
+    assert len([call for call in cluster.calls if call[0] in ["repair", "delete"]]) == 6
+
+
+def test_instances_left_provisioning_by_a_lost_job_are_repaired():
+    cluster = Cluster([instance("alice", state="provisioning", age=3600)], [])
+    reconciler = cluster.reconciler(grace=120)
+    reconciler._passes = 1
+    reconciler.reconcile()
+    assert ("repair", "alice", ["pod", "service", "route"]) in cluster.calls
+
+
+def test_objects_of_shared_challenges_are_not_orphans():
+    shared = obj("shared")
+    shared.metadata.labels["instance_mode"] = "shared"
+    cluster = Cluster([], [], services=[shared])
+    reconciler = cluster.reconciler()
+    reconciler._passes = 1
+    reconciler.reconcile()
+    assert not any(call[0] == "delete" for call in cluster.calls)
@@ -0,0 +1,91 @@
+import threading
+import pytest
+from route_shards import RouteShards, shard_name, rule_key
+from utils import generate_route_dict
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+
+
+def route(username):
+    return generate_route_dict(CHALLENGE_ID, username, "production", "web")
+
+
+class FakeApiServer:
+    """Keeps HTTPRoutes by name, writes fail while failing is set"""
+
+    def __init__(self):
+        self.routes = {}
+        self.writes = []
+        self.failing = False
+
+    def write(self, route):
+        if self.failing:
+            raise RuntimeError("API server is down")
+        self.writes.append(route["metadata"]["name"])
+        self.routes[route["metadata"]["name"]] = route
+
+    def delete(self, name, namespace):
+        self.routes.pop(name)
+
+    def list_routes(self):
+        return list(self.routes.values())
+
+
+def shards(api, **kwargs):
+    return RouteShards(api.write, api.delete, api.list_routes, batch_wait=0.05, **kwargs)
+
+
+def test_concurrent_adds_are_one_write_of_one_shard():
+    api = FakeApiServer()
+    route_shards = shards(api)
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(route_shards.add(route(f"user{i}")))) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["created"] * 10
+    assert api.writes == [shard_name(CHALLENGE_ID, 0)]
+    assert len(api.routes[shard_name(CHALLENGE_ID, 0)]["spec"]["rules"]) == 10
+    assert route_shards.has(f"ctf-{CHALLENGE_ID}-user3")
+
+
+def test_full_shards_spill_into_a_new_one():
+    api = FakeApiServer()
+    route_shards = shards(api, max_rules=2)
+    for username in ["a", "b", "c"]:
+        route_shards.add(route(username))
+    assert sorted(api.routes) == [shard_name(CHALLENGE_ID, 0), shard_name(CHALLENGE_ID, 1)]
+    assert route_shards.add(route("a")) == "unchanged"
+
+
+def test_removing_the_last_rule_deletes_the_shard():
+    api = FakeApiServer()
+    route_shards = shards(api)
+    route_shards.add(route("alice"))
+    route_shards.remove(f"ctf-{CHALLENGE_ID}-alice")
+    route_shards.remove("ctf-unknown")
+    assert api.routes == {}
+    assert route_shards.stats()["deletes"] == 1
+
+
+def test_assignments_are_loaded_from_the_cluster():
+    api = FakeApiServer()
+    shards(api).add(route("alice"))
+    restarted = shards(api)
+    assert restarted.has(f"ctf-{CHALLENGE_ID}-alice")
+    assert [obj.metadata.labels["ctf-id-username"] for obj in restarted.objects()] == [f"ctf-{CHALLENGE_ID}-alice"]
+    assert rule_key(route("alice")["spec"]["rules"][0]) == f"ctf-{CHALLENGE_ID}-alice"
+
+
+def test_failed_write_is_raised_and_the_cluster_loaded_again():
+    api = FakeApiServer()
+    route_shards = shards(api)
+    route_shards.add(route("alice"))
+    api.failing = True
+    with pytest.raises(RuntimeError):
+        route_shards.add(route("bob"))
+    api.failing = False
+    # bob was never written, the reloaded shards do not have him
+    assert not route_shards.has(f"ctf-{CHALLENGE_ID}-bob")
+    assert route_shards.add(route("bob")) == "created"
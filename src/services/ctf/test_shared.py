@@ -0,0 +1,49 @@
+import pytest
+from flask_jwt_extended import create_access_token
+from werkzeug import exceptions
+from models import Challenge
+from utils import generate_shared_manifests, shared_url, validate_instance_mode
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+RESOURCES = {"limits": {"cpu": "500m", "memory": "256Mi"}}
+
+
+def challenge():
+    return Challenge(CHALLENGE_ID, "web", "", "web", "easy", "flag{}", "author", "flag{x}", str({"resources": RESOURCES}),
+                     100, False, True, "nginx:latest", "competition", instance_mode="shared", shared_replicas=3)
+
+
+def test_shared_instance_is_one_deployment_service_and_route():
+    deployment, service, route = generate_shared_manifests(CHALLENGE_ID, "nginx:latest", RESOURCES, "web", 3)
+    assert deployment["spec"]["replicas"] == 3
+    selector = deployment["spec"]["selector"]["matchLabels"]
+    assert selector.items() <= deployment["spec"]["template"]["metadata"]["labels"].items()
+    for manifest in [deployment, service, route]:
+        # Without a username, quotas, the reaper and readiness leave them alone
+        assert "username" not in manifest["metadata"]["labels"]
+        assert manifest["metadata"]["labels"]["instance_mode"] == "shared"
+    assert route["spec"]["rules"][0]["matches"][0]["path"]["value"] == shared_url(CHALLENGE_ID)
+
+
+@pytest.mark.parametrize("value", ["per-user", "scale-to-zero", "shared"])
+def test_valid_instance_modes(value):
+    assert validate_instance_mode(value) == value
+
+
+def test_invalid_instance_mode():
+    with pytest.raises(exceptions.BadRequest):
+        validate_instance_mode("pooled")
+
+
+def test_open_of_a_shared_challenge_records_nothing(monkeypatch):
+    import app
+    applied = []
+    monkeypatch.setattr(app, "read_challenge", lambda challenge_id: challenge())
+    monkeypatch.setattr(app, "ensure_shared_instance", applied.append)
+    monkeypatch.setattr(app, "provision_instance", lambda *args: pytest.fail("a shared challenge has no instance per user"))
+    with app.app.app_context():
+        token = create_access_token(identity="alice", additional_claims={"role": "user"})
+    response = app.app.test_client().get(f"/open/{CHALLENGE_ID}", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.get_json()["url"] == shared_url(CHALLENGE_ID)
+    assert [opened.id for opened in applied] == [CHALLENGE_ID]
@@ -0,0 +1,65 @@
+import threading
+import time
+import pytest
+from teardown import Teardown, teardown_selectors, TEARDOWN_KINDS
+
+
+def finished(teardown, job, timeout=2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        current = teardown.job(job["id"])
+        if current["status"] in ["succeeded", "failed"]:
+            return current
+        time.sleep(0.01)
+    raise AssertionError(f"teardown {job['id']} did not finish")
+
+
+def test_selectors_chunk_the_challenges():
+    assert teardown_selectors(["b", "a", "c"], chunk=2) == ["challenge_id in (a,b)", "challenge_id in (c)"]
+    assert teardown_selectors(["a"], username="alice", mode="test") == ["challenge_id in (a),username=alice,mode=test"]
+    assert teardown_selectors(username="alice") == ["username=alice"]
+
+
+def test_selector_for_everything_is_refused():
+    with pytest.raises(ValueError):
+        teardown_selectors([], mode="test")
+
+
+def test_records_then_namespaces_then_every_kind_per_selector():
+    calls = []
+    done = threading.Event()
+    teardown = Teardown(lambda kind, selector: calls.append((kind, selector)), lambda scope: calls.append(("records", scope)),
+                        delete_namespace=lambda name: calls.append(("namespace", name)))
+    job = teardown.submit("admin", {"competition_id": "c"}, ["s1", "s2"], on_done=done.set, namespaces=["ctf-comp-c"])
+    job = finished(teardown, job)
+    assert job["status"] == "succeeded"
+    assert job["progress"] == {"done": 10, "total": 10}
+    assert calls[:2] == [("records", {"competition_id": "c"}), ("namespace", "ctf-comp-c")]
+    assert calls[2:] == [(kind, selector) for kind in TEARDOWN_KINDS for selector in ["s1", "s2"]]
+    assert done.wait(1)
+
+
+def test_failed_calls_fail_the_job_but_the_rest_still_runs():
+    def delete_collection(kind, selector):
+        if kind == "service":
+            raise RuntimeError("forbidden")
+        calls.append(kind)
+
+    calls = []
+    teardown = Teardown(delete_collection, lambda scope: None)
+    job = finished(teardown, teardown.submit("admin", {}, ["s"]))
+    assert job["status"] == "failed"
+    assert job["steps"]["service"] == "failed"
+    assert job["steps"]["pod"] == "deleted"
+    assert calls == ["route", "deployment", "pod"]
+    assert "service s: forbidden" in job["error"]
+
+
+def test_teardown_endpoint_is_for_admins():
+    import app
+    from flask_jwt_extended import create_access_token
+    with app.app.app_context():
+        token = create_access_token(identity="alice", additional_claims={"role": "user"})
+    client = app.app.test_client()
+    assert client.post("/teardown", json={"username": "bob"}).status_code == 401
+    assert client.post("/teardown", json={"username": "bob"}, headers={"Authorization": f"Bearer {token}"}).status_code == 403
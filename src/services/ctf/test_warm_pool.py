@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+from kubernetes.client import V1ObjectMeta, V1Pod, V1PodStatus, V1PodCondition
+from kubernetes.client.exceptions import ApiException
+from warm_pool import WarmPool
+
+CHALLENGE_ID = "0b6e2c1a-3f5d-4c8e-9a7b-1d2e3f4a5b6c"
+RESOURCES = "{'resources': {'limits': {'cpu': '500m', 'memory': '256Mi'}}}"
+
+
+def warm(name, ready=True, challenge_id=CHALLENGE_ID):
+    return V1Pod(
+        metadata=V1ObjectMeta(name=f"ctf-{challenge_id}-{name}", namespace="project", resource_version="1",
+                              labels={"challenge_id": challenge_id, "warm": "true"}),
+        status=V1PodStatus(phase="Running", conditions=[V1PodCondition(type="Ready", status="True" if ready else "False")]),
+    )
+
+
+class FakeInformer:
+    def __init__(self, pods):
+        self.pods = pods
+
+    def list(self):
+        return self.pods
+
+    def by_challenge(self, challenge_id):
+        return [pod for pod in self.pods if pod.metadata.labels["challenge_id"] == challenge_id]
+
+
+class FakeCoreV1:
+    """Records the calls, patches of the pods named in conflicts fail with 409"""
+
+    def __init__(self, conflicts=()):
+        self.conflicts = set(conflicts)
+        self.patched, self.created, self.deleted = [], [], []
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        if name in self.conflicts:
+            raise ApiException(status=409)
+        self.patched.append((name, body))
+
+    def create_namespaced_pod(self, namespace, body):
+        self.created.append(body["metadata"]["name"])
+
+    def delete_namespaced_pod(self, name, namespace):
+        self.deleted.append(name)
+
+
+def pool(pods, v1, warm_pool_min=1, warm_pool_max=3):
+    challenge = SimpleNamespace(id=CHALLENGE_ID, warm_pool_min=warm_pool_min, warm_pool_max=warm_pool_max, resource_limits=RESOURCES)
+    count = iter(range(100))
+    generate = lambda challenge, resources: {"metadata": {"name": f"ctf-{challenge.id}-new{next(count)}", "namespace": "project"}}
+    return WarmPool(FakeInformer(pods), lambda: v1, lambda: [challenge], generate)
+
+
+def test_claim_relabels_a_ready_pod_for_the_user():
+    v1 = FakeCoreV1()
+    warm_pool = pool([warm("starting", ready=False), warm("ready")], v1)
+    assert warm_pool.claim(CHALLENGE_ID, "alice").endswith("ready")
+    (name, body), = v1.patched
+    assert body["metadata"]["resourceVersion"] == "1"
+    assert body["metadata"]["labels"]["username"] == "alice"
+    assert body["metadata"]["labels"]["warm"] is None
+    assert warm_pool.stats()["hits"] == 1
+
+
+def test_claim_moves_on_when_another_request_was_first():
+    taken = warm("taken")
+    v1 = FakeCoreV1(conflicts=[taken.metadata.name])
+    warm_pool = pool([taken, warm("free")], v1)
+    assert warm_pool.claim(CHALLENGE_ID, "alice").endswith("free")
+    assert warm_pool.stats()["claim_conflicts"] == 1
+
+
+def test_empty_pool_is_a_miss():
+    warm_pool = pool([], FakeCoreV1())
+    assert warm_pool.claim(CHALLENGE_ID, "alice") is None
+    assert warm_pool.claim(CHALLENGE_ID, "alice", namespace="other") is None
+    assert warm_pool.stats()["misses"] == 2
+
+
+def test_replenisher_keeps_the_minimum_and_refills_after_claims():
+    v1 = FakeCoreV1()
+    warm_pool = pool([], v1, warm_pool_min=1, warm_pool_max=3)
+    warm_pool._replenish()
+    assert len(v1.created) == 1
+    # Pods being created count until the informer sees them
+    warm_pool._replenish()
+    assert len(v1.created) == 1
+    warm_pool.claim(CHALLENGE_ID, "alice")
+    warm_pool.claim(CHALLENGE_ID, "bob")
+    warm_pool._replenish()
+    assert len(v1.created) == 3
+
+
+def test_replenisher_deletes_surplus_and_orphaned_pods():
+    v1 = FakeCoreV1()
+    other = warm("other", challenge_id="11111111-2222-3333-4444-555555555555")
+    warm_pool = pool([warm("a"), warm("b"), warm("c", ready=False), other], v1, warm_pool_min=0, warm_pool_max=2)
+    warm_pool._replenish()
+    assert sorted(v1.deleted) == sorted([warm("c").metadata.name, other.metadata.name])
@@ -1,19 +1,39 @@
 from functools import wraps
-from flask import request
+from flask import request, has_request_context
 import kubernetes
 from werkzeug import exceptions
-from flask_jwt_extended import get_jwt
+from flask_jwt_extended import get_jwt, create_access_token
 from kubernetes import client, config, utils
 import yaml
 import json
 import os
+import hashlib
+import hmac
+import uuid
+import requests
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from informer import PodInformer
+from kube import KubeClients
+from ratelimit import RateLimiter
+from apply import Applier
+from route_shards import RouteShards, ROUTE_MODE, SHARD_LABEL
+from activator import ACTIVATOR_HEADER, activator_key
+from prepull import IMAGE_PULL_POLICY, PREPULL_LABEL
+from placement import place_pod, placement_annotations, validate_placement, node_placement
+from namespaces import NAMESPACE_MODE, DEFAULT_NAMESPACE, GATEWAY_NAMESPACE, NAMESPACE_LABEL, ACTIVATOR_SERVICE
 
 mode = os.getenv("KUBERNETES_MODE", "local")
+# Activator port of this service, the routes of scale-to-zero instances point there
+ACTIVATOR_SERVICE_PORT = int(os.getenv("ACTIVATOR_SERVICE_PORT", "8082"))
+# Seconds a challenge container gets to start listening before it is restarted
+POD_STARTUP_TIMEOUT = int(os.getenv("POD_STARTUP_TIMEOUT", "120"))
 
-def load_kubernetes_config():
+def kubernetes_configuration():
     """Loads appropriate Kubernetes config based on environment (local or cloud)."""
+    configuration = client.Configuration()
     if mode == "in-cluster":
-        config.load_incluster_config()
+        config.load_incluster_config(client_configuration=configuration)
     else:
         # Path to shared kubeconfig file
         kubeconfig_path = os.environ.get("KUBECONFIG", "/k3s-config/k3s.yaml")
@@ -23,10 +43,118 @@ def load_kubernetes_config():
             # Update server field
             config_data['clusters'][0]['cluster'][
                 'server'] = f"https://{k3s_server_hostname}:6443"
-            kubeconfig_dict = config.kube_config.Configuration()
             config.load_kube_config_from_dict(
-                config_data, client_configuration=kubeconfig_dict)
-            client.Configuration.set_default(kubeconfig_dict)
+                config_data, client_configuration=configuration)
+    return configuration
+
+def kubernetes_credentials_path():
+    """File whose changes mean the Kubernetes credentials must be loaded again"""
+    if mode == "in-cluster":
+        return "/var/run/secrets/kubernetes.io/serviceaccount/token"
+    return os.environ.get("KUBECONFIG", "/k3s-config/k3s.yaml")
+
+def kubernetes_lane():
+    """Calls made while serving a request go first, the jobs and housekeeping threads wait behind them"""
+    return "interactive" if has_request_context() else "background"
+
+# Every Kubernetes call of the process is paced by one limiter
+kube_limiter = RateLimiter(default_lane=kubernetes_lane)
+
+# One pooled Kubernetes client for the whole process
+kube = KubeClients(kubernetes_configuration, kubernetes_credentials_path(), limiter=kube_limiter)
+
+# Challenge pods of every user, served from memory instead of listing them per request
+pod_informer = PodInformer(kube.core, namespace=None if NAMESPACE_MODE == "per-competition" else DEFAULT_NAMESPACE)
+
+# Instance objects are written with server-side apply, unchanged ones are skipped
+applier = Applier(kube.dynamic)
+
+def delete_route_shard(name, namespace=DEFAULT_NAMESPACE):
+    applier.forget("HTTPRoute", namespace, name)
+    try:
+        kube.custom().delete_namespaced_custom_object(
+            group="gateway.networking.k8s.io",
+            version="v1",
+            namespace=namespace,
+            plural="httproutes",
+            name=name,
+        )
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise e
+
+def list_route_shards():
+    return list_routes(f"{SHARD_LABEL}=true")
+
+def list_routes(label_selector):
+    """HTTPRoutes matching the label selector, in every namespace when instances have namespaces of their own"""
+    if NAMESPACE_MODE == "per-competition":
+        return kube.custom().list_cluster_custom_object(
+            group="gateway.networking.k8s.io",
+            version="v1",
+            plural="httproutes",
+            label_selector=label_selector,
+        )["items"]
+    return kube.custom().list_namespaced_custom_object(
+        group="gateway.networking.k8s.io",
+        version="v1",
+        namespace=DEFAULT_NAMESPACE,
+        plural="httproutes",
+        label_selector=label_selector,
+    )["items"]
+
+# In sharded mode the routes of instances are rules of a few HTTPRoutes per challenge
+# Shards are written for the instances being opened and closed, from the batcher's thread
+route_shards = RouteShards(kube_limiter.in_lane("interactive", applier.apply),
+                           kube_limiter.in_lane("interactive", delete_route_shard), list_route_shards)
+
+def apply_route(route_dict):
+    """Applies the route of an instance, as an HTTPRoute of its own or as a rule of a shard"""
+    if ROUTE_MODE == "sharded":
+        return route_shards.add(route_dict)
+    return applier.apply(route_dict)
+
+def parse_uuid(value):
+    """Canonical string form of a UUID, None if the value is not one"""
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+def parse_instance_key(key):
+    """(challenge_id, username) of a ctf-<challenge_id>-<username> instance key"""
+    return key[4:40], key[41:]
+
+def flag_digest(salt, flag):
+    """Digest of the flag keyed with the salt, lets the competition service check flags without knowing them"""
+    return hmac.new(bytes.fromhex(salt), str(flag).encode(), hashlib.sha256).hexdigest()
+
+def service_authorization():
+    """Short-lived token of the ctf service itself, for competition endpoints no user may call"""
+    token = create_access_token(identity="service-ctf", expires_delta=timedelta(minutes=1),
+                                additional_claims={"role": "service"})
+    return {"Authorization": f"Bearer {token}"}
+
+def notify_challenges_changed(challenge_ids):
+    """Tells the competition service to drop its cached flags of the challenges, best effort.
+
+    Only the replica behind service-comp that gets the call is told, the others serve the old
+    digests until their entries expire, at most FLAG_CACHE_TTL seconds.
+    """
+    if mode == "in-cluster":
+        comp_endpoint = "http://service-comp/flag-cache/invalidate"
+    else:
+        comp_endpoint = "http://localhost:8080/flag-cache/invalidate"
+
+    try:
+        # The challenge endpoints are open to anyone, so the call carries the service's own token
+        response = requests.post(comp_endpoint, json={"challenge_ids": list(challenge_ids)}, timeout=2,
+                                 headers=service_authorization())
+        if response.status_code != 200:
+            print(f"Could not invalidate the flag cache: {response.status_code} {response.text}")
+    except requests.RequestException as e:
+        # The cached entries expire on their own
+        print(f"Could not invalidate the flag cache: {e}")
 
 def validate_json_fields(fields):
     """Wrapper method to help validate json inputs"""
@@ -112,29 +240,128 @@ def authorize(allowed_roles):
         return wrapper
     return decorator
 
-def apply_simple_item(
-    dynamic_client: kubernetes.dynamic.DynamicClient,
-    manifest: dict,
-    verbose: bool = False,
-):
-    """Used to apply kubernetes manifests which are from CRD's"""
-    api_version = manifest.get("apiVersion")
-    kind = manifest.get("kind")
-    resource_name = manifest.get("metadata").get("name")
-    namespace = manifest.get("metadata").get("namespace")
-    crd_api = dynamic_client.resources.get(api_version=api_version, kind=kind)
+def instance_steps(pod_dict, service_dict, route_dict, claimed_pod=None, scaled_to_zero=False):
+    """(name, create, delete) steps of the objects of one challenge instance, for the provisioner"""
+    """claimed_pod is the name of a warm pool pod already assigned to the user, no pod is created then.
+    Instances scaled to zero get no pod either, the activator starts it on the first request"""
+    namespace = pod_dict["metadata"]["namespace"]
+    pod_name = claimed_pod or pod_dict["metadata"]["name"]
+    steps = [
+        ("service",
+         lambda: applier.apply(service_dict),
+         lambda: delete_object("service", service_dict["metadata"]["name"], namespace)),
+        ("route",
+         lambda: apply_route(route_dict),
+         lambda: delete_object("route", route_dict["metadata"]["name"], namespace)),
+    ]
+    if not scaled_to_zero:
+        steps.insert(0, ("pod",
+                         (lambda: "unchanged") if claimed_pod else lambda: applier.apply(pod_dict, current=pod_informer.get(pod_name, namespace)),
+                         lambda: delete_object("pod", pod_name, namespace)))
+    return steps
+
+def delete_instance(challenge_id, username, namespace=DEFAULT_NAMESPACE):
+    """Deletes the pod, service and httproute of the user's instance of the challenge, missing ones are skipped"""
+    instance = str(challenge_id) + "-" + username
+    # By label, since pods claimed from the warm pool keep their own name
+    for kind in ["route", "service", "pod"]:
+        delete_collection(kind, f"ctf-id-username=ctf-{instance}", namespace)
+    for kind, name in [("Pod", "ctf-" + instance), ("Service", "svc-" + instance), ("HTTPRoute", "rt-" + instance)]:
+        applier.forget(kind, namespace, name)
+    if ROUTE_MODE == "sharded":
+        route_shards.remove("ctf-" + instance)
+
+def delete_collection(kind, label_selector, namespace=DEFAULT_NAMESPACE):
+    """Deletes every pod, deployment, service or route matching the label selector in one call"""
+    if kind == "pod":
+        kube.core().delete_collection_namespaced_pod(namespace, label_selector=label_selector)
+    elif kind == "deployment":
+        kube.apps().delete_collection_namespaced_deployment(namespace, label_selector=label_selector)
+    elif kind == "service":
+        kube.core().delete_collection_namespaced_service(namespace, label_selector=label_selector)
+    else:
+        kube.custom().delete_collection_namespaced_custom_object(
+            group="gateway.networking.k8s.io",
+            version="v1",
+            namespace=namespace,
+            plural="httproutes",
+            label_selector=label_selector,
+        )
+
+def list_instance_objects(kind):
+    """Services or HTTPRoutes of challenge instances, routes are given the same shape as the client's objects"""
+    if kind == "service":
+        if NAMESPACE_MODE == "per-competition":
+            return kube.core().list_service_for_all_namespaces(label_selector="type=ctf").items
+        return kube.core().list_namespaced_service(DEFAULT_NAMESPACE, label_selector="type=ctf").items
+    # Shards stand for their rules, which are listed one by one below
+    routes = list_routes(f"type=ctf,!{SHARD_LABEL}")
+    shards = route_shards.objects() if ROUTE_MODE == "sharded" else []
+    return shards + [
+        SimpleNamespace(metadata=SimpleNamespace(
+            name=route["metadata"]["name"],
+            namespace=route["metadata"]["namespace"],
+            labels=route["metadata"].get("labels"),
+            deletion_timestamp=route["metadata"].get("deletionTimestamp"),
+            creation_timestamp=datetime.fromisoformat(route["metadata"]["creationTimestamp"]),
+        ))
+        for route in routes
+    ]
+
+def delete_object(kind, name, namespace=DEFAULT_NAMESPACE):
+    """Deletes one pod, service or route of an instance, a missing one is skipped"""
+    if kind == "route" and ROUTE_MODE == "sharded" and route_shards.has("ctf-" + name[len("rt-"):]):
+        route_shards.remove("ctf-" + name[len("rt-"):])
+        return
+    applier.forget({"pod": "Pod", "service": "Service", "route": "HTTPRoute"}[kind], namespace, name)
+    try:
+        if kind == "pod":
+            kube.core().delete_namespaced_pod(name, namespace)
+        elif kind == "service":
+            kube.core().delete_namespaced_service(name, namespace)
+        else:
+            kube.custom().delete_namespaced_custom_object(
+                group="gateway.networking.k8s.io",
+                version="v1",
+                namespace=namespace,
+                plural="httproutes",
+                name=name,
+            )
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise e
 
+def delete_prepull(name, namespace=DEFAULT_NAMESPACE):
+    """Deletes a pre-pull DaemonSet and its pods, a missing one is skipped"""
+    applier.forget("DaemonSet", namespace, name)
     try:
-        crd_api.get(namespace=namespace, name=resource_name)
-        crd_api.patch(body=manifest, content_type="application/merge-patch+json")
-        if verbose:
-            print(f"{namespace}/{resource_name} patched")
-    except kubernetes.dynamic.exceptions.NotFoundError:
-        crd_api.create(body=manifest, namespace=namespace)
-        if verbose:
-            print(f"{namespace}/{resource_name} created")
-
-def generate_pod_dict(challenge_id, username, image, resources, mode, name):
+        kube.apps().delete_namespaced_daemon_set(name, namespace, propagation_policy="Background")
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise e
+
+def observe_prepull(name, namespace=DEFAULT_NAMESPACE):
+    """Number of nodes the pre-pull DaemonSet should run on, and its pods"""
+    daemon_set = kube.apps().read_namespaced_daemon_set(name, namespace)
+    desired = daemon_set.status.desired_number_scheduled if daemon_set.status else 0
+    pods = kube.core().list_namespaced_pod(namespace, label_selector=f"{PREPULL_LABEL}={name}").items
+    return desired, pods
+
+def list_prepulls(namespace=DEFAULT_NAMESPACE):
+    return [daemon_set.metadata.name for daemon_set in kube.apps().list_namespaced_daemon_set(namespace, label_selector="type=prepull").items]
+
+def delete_namespace(name):
+    """Deletes an instance namespace with everything in it, a missing one is skipped"""
+    try:
+        kube.core().delete_namespace(name)
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise e
+
+def list_namespaces():
+    return [namespace.metadata.name for namespace in kube.core().list_namespace(label_selector=f"type={NAMESPACE_LABEL}").items]
+
+def generate_pod_dict(challenge_id, username, image, resources, mode, name, competition_id=None, namespace=DEFAULT_NAMESPACE, placement="default"):
     """Used to generate pod manifest in pythin dict form"""
     pod_dict = {
         "apiVersion": "v1",
@@ -148,22 +375,49 @@ def generate_pod_dict(challenge_id, username, image, resources, mode, name):
                 "name": name,
                 "mode": mode,
                 "type": "ctf"},
-            "namespace": "project",
+            "namespace": namespace,
         },
         "spec": {
             "containers": [
                 {
                     "name": "ctf-" + str(challenge_id) + "-" + username,
                     "image": image,
+                    "imagePullPolicy": IMAGE_PULL_POLICY,
                     "resources": resources,
                     "ports": [{"containerPort": 8080}],
+                    # Probed every second while starting so readiness is seen quickly, less often afterwards
+                    "startupProbe": {
+                        "tcpSocket": {"port": 8080},
+                        "periodSeconds": 1,
+                        "failureThreshold": POD_STARTUP_TIMEOUT,
+                    },
+                    "readinessProbe": {
+                        "tcpSocket": {"port": 8080},
+                        "periodSeconds": 5,
+                        "failureThreshold": 3,
+                    },
                 }
             ]
         },
     }
+    if competition_id is not None:
+        pod_dict["metadata"]["labels"]["competition_id"] = str(competition_id)
+    place_pod(pod_dict["spec"], placement, challenge_id, mode)
+    if placement_annotations(placement):
+        pod_dict["metadata"]["annotations"] = placement_annotations(placement)
     return pod_dict
 
-def generate_service_dict(challenge_id, username, mode, name):
+def generate_warm_pod_dict(challenge_id, image, resources, name, namespace=DEFAULT_NAMESPACE, placement="default"):
+    """Used to generate the pod manifest of an unassigned warm pool instance, claimed later by relabelling it"""
+    suffix = uuid.uuid4().hex[:8]
+    pod_dict = generate_pod_dict(challenge_id, "warm-" + suffix, image, resources, "production", name, namespace=namespace, placement=placement)
+    labels = pod_dict["metadata"]["labels"]
+    # No username until the pod is claimed, ctf-id-username stays unique so no Service selects it yet
+    del labels["username"]
+    labels["warm"] = "true"
+    return pod_dict
+
+def generate_service_dict(challenge_id, username, mode, name, namespace=DEFAULT_NAMESPACE):
     """Used to generate service manifest in pythin dict form"""
     service_dict = {
         "apiVersion": "v1",
@@ -175,8 +429,9 @@ def generate_service_dict(challenge_id, username, mode, name):
                 "username": username,
                 "name": name,
                 "challenge_id": challenge_id,
-                "mode": mode},
-            "namespace": "project",
+                "mode": mode,
+                "type": "ctf"},
+            "namespace": namespace,
         },
         "spec": {
             "selector": {"ctf-id-username": "ctf-" + str(challenge_id) + "-" + username},
@@ -186,7 +441,7 @@ def generate_service_dict(challenge_id, username, mode, name):
     }
     return service_dict
 
-def generate_route_dict(challenge_id, username, mode, name):
+def generate_route_dict(challenge_id, username, mode, name, namespace=DEFAULT_NAMESPACE):
     """Used to generate service manifest in pythin dict form"""
     route_dict = {
         "apiVersion": "gateway.networking.k8s.io/v1",
@@ -198,8 +453,9 @@ def generate_route_dict(challenge_id, username, mode, name):
                 "username": username,
                 "name": name,
                 "challenge_id": challenge_id,
-                "mode": mode},
-            "namespace": "project",
+                "mode": mode,
+                "type": "ctf"},
+            "namespace": namespace,
         },
         "spec": {
             "parentRefs": [{"name": "project-gateway"}],
@@ -232,16 +488,77 @@ def generate_route_dict(challenge_id, username, mode, name):
             ],
         },
     }
+    if namespace != GATEWAY_NAMESPACE:
+        route_dict["spec"]["parentRefs"][0]["namespace"] = GATEWAY_NAMESPACE
     return route_dict
 
+def generate_activated_route_dict(challenge_id, username, mode, name, namespace=DEFAULT_NAMESPACE):
+    """Used to generate the route manifest of a scale-to-zero instance, its requests go through the activator"""
+    route_dict = generate_route_dict(challenge_id, username, mode, name, namespace)
+    rule = route_dict["spec"]["rules"][0]
+    rule["backendRefs"] = [{"name": ACTIVATOR_SERVICE, "port": ACTIVATOR_SERVICE_PORT}]
+    if namespace != DEFAULT_NAMESPACE:
+        # Allowed by the ReferenceGrant created with the namespace
+        rule["backendRefs"][0]["namespace"] = DEFAULT_NAMESPACE
+    # Tells the activator which instance the request is for
+    rule["filters"].append({
+        "type": "RequestHeaderModifier",
+        "requestHeaderModifier": {"set": [{"name": ACTIVATOR_HEADER, "value": activator_key(namespace, "ctf-" + str(challenge_id) + "-" + username)}]},
+    })
+    return route_dict
+
+def shared_labels(challenge_id, name):
+    """Labels of the objects of a shared challenge, no username so the per-user machinery ignores them"""
+    return {
+        "ctf-id-username": "ctf-" + str(challenge_id) + "-shared",
+        "name": name,
+        "challenge_id": str(challenge_id),
+        "mode": "production",
+        "instance_mode": "shared",
+        "type": "ctf",
+    }
+
+def generate_shared_manifests(challenge_id, image, resources, name, replicas, placement="default"):
+    """Deployment, Service and HTTPRoute manifests of a shared challenge, served to every user from one URL"""
+    labels = shared_labels(challenge_id, name)
+    pod_dict = generate_pod_dict(challenge_id, "shared", image, resources, "production", name, placement=placement)
+    pod_dict["metadata"]["labels"] = labels
+    deployment_dict = {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": "ctf-" + str(challenge_id) + "-shared", "labels": labels, "namespace": DEFAULT_NAMESPACE},
+        "spec": {
+            "replicas": replicas,
+            "selector": {"matchLabels": {"ctf-id-username": labels["ctf-id-username"]}},
+            "template": {"metadata": {"labels": labels}, "spec": pod_dict["spec"]},
+        },
+    }
+    if "annotations" in pod_dict["metadata"]:
+        deployment_dict["spec"]["template"]["metadata"]["annotations"] = pod_dict["metadata"]["annotations"]
+    service_dict = generate_service_dict(challenge_id, "shared", "production", name)
+    service_dict["metadata"]["labels"] = labels
+    route_dict = generate_route_dict(challenge_id, "shared", "production", name)
+    route_dict["metadata"]["labels"] = labels
+    return deployment_dict, service_dict, route_dict
+
+def shared_url(challenge_id):
+    """Path of a shared challenge on the gateway"""
+    return "/ctf/" + str(challenge_id) + "-shared"
+
+def validate_instance_mode(value):
+    """Raises if the value is not per-user, scale-to-zero or shared"""
+    if value not in ["per-user", "scale-to-zero", "shared"]:
+        raise exceptions.BadRequest("instance_mode must be per-user, scale-to-zero or shared")
+    return value
+
 def get_active_instances(claims):
     """Returns all active instances"""
-    load_kubernetes_config()
-    v1 = client.CoreV1Api()
+    pod_informer.wait_for_sync()
     if claims["role"] == "admin":
-        active_challenges = v1.list_namespaced_pod(namespace='project', label_selector=f'type=ctf').items
+        # Unclaimed warm pool pods are not anyone's instance
+        active_challenges = [pod for pod in pod_informer.list() if "username" in (pod.metadata.labels or {})]
     else:
-        active_challenges = v1.list_namespaced_pod(namespace='project', label_selector=f'type=ctf,username={claims["sub"]}').items
+        active_challenges = pod_informer.by_username(claims["sub"])
 
     active_challenges_labels = [challenge.metadata.labels for challenge in active_challenges]
-    return active_challenges_labels
\ No newline at end of file
+    return active_challenges_labels
@@ -0,0 +1,197 @@
+import ast
+import os
+import threading
+import time
+import kubernetes
+from reaper import CLAIMED_AT_ANNOTATION
+
+WARM_POOL_INTERVAL = float(os.getenv("WARM_POOL_INTERVAL", "5"))
+# Pods created by the replenisher count towards the pool until the informer sees them
+WARM_POOL_CREATE_GRACE = 60
+WARM_POOL_CLAIM_ATTEMPTS = 3
+
+
+class WarmPool:
+    """Pre-started, unassigned instances per challenge, handed out by /open instead of a cold start.
+
+    A claim relabels a warm pod with the user, guarded by its resourceVersion so two requests can
+    never claim the same pod. The replenisher keeps warm_pool_min unassigned pods per challenge and,
+    after claims, refills up to warm_pool_max to absorb bursts. Pods above warm_pool_max, or of
+    challenges without a pool any more, are deleted. generate_pod(challenge, resources) returns the
+    manifest of a warm pod of the challenge, in the namespace it should live in.
+    """
+
+    def __init__(self, informer, api, read_challenges, generate_pod, interval=WARM_POOL_INTERVAL) -> None:
+        self._informer = informer
+        self._api = api
+        self._read_challenges = read_challenges
+        self._generate_pod = generate_pod
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._creating = {}
+        self._claimed_since_tick = {}
+        self._depth = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._conflicts = 0
+        self._created = 0
+        self._deleted = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="warm-pool", daemon=True).start()
+
+    def available(self, challenge_id, namespace=None) -> bool:
+        return len(self._candidates(str(challenge_id), namespace)) > 0
+
+    def claim(self, challenge_id, username, competition_id=None, namespace=None):
+        """Assigns a warm pod of the challenge to the user, returns its name or None if the pool is empty.
+        With a namespace only pods in it are claimed, the instance's other objects are created there"""
+        challenge_id = str(challenge_id)
+        v1 = self._api()
+        for pod in self._candidates(challenge_id, namespace)[:WARM_POOL_CLAIM_ATTEMPTS]:
+            body = {
+                "metadata": {
+                    # Fails with 409 when another request relabelled the pod first
+                    "resourceVersion": pod.metadata.resource_version,
+                    "annotations": {CLAIMED_AT_ANNOTATION: str(time.time())},
+                    "labels": {
+                        "username": username,
+                        "ctf-id-username": "ctf-" + challenge_id + "-" + username,
+                        "competition_id": str(competition_id) if competition_id is not None else None,
+                        "warm": None,
+                    },
+                }
+            }
+            try:
+                v1.patch_namespaced_pod(pod.metadata.name, pod.metadata.namespace, body)
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status not in [404, 409]:
+                    raise e
+                with self._lock:
+                    self._conflicts += 1
+                continue
+            with self._lock:
+                self._hits += 1
+                self._claimed_since_tick[challenge_id] = self._claimed_since_tick.get(challenge_id, 0) + 1
+            return pod.metadata.name
+
+        with self._lock:
+            self._misses += 1
+            self._claimed_since_tick[challenge_id] = self._claimed_since_tick.get(challenge_id, 0) + 1
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            claims = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / claims, 3) if claims else None,
+                "claim_conflicts": self._conflicts,
+                "created": self._created,
+                "deleted": self._deleted,
+                "depth": dict(self._depth),
+            }
+
+    def _warm_pods(self, challenge_id):
+        return [
+            pod for pod in self._informer.by_challenge(challenge_id)
+            if (pod.metadata.labels or {}).get("warm") == "true" and pod.metadata.deletion_timestamp is None
+        ]
+
+    def _candidates(self, challenge_id, namespace=None):
+        """Warm pods of the challenge that may be claimed, ready ones first"""
+        pods = [
+            pod for pod in self._warm_pods(challenge_id)
+            if (pod.status is None or pod.status.phase not in ["Failed", "Succeeded"]) and namespace in [None, pod.metadata.namespace]
+        ]
+        return sorted(pods, key=lambda pod: not is_ready(pod))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._informer.wait_for_sync()
+                self._replenish()
+            except Exception as e:
+                print(f"Warm pool replenisher error: {e}")
+
+    def _replenish(self):
+        v1 = self._api()
+        challenges = {str(challenge.id): challenge for challenge in self._read_challenges()}
+        with self._lock:
+            claimed, self._claimed_since_tick = self._claimed_since_tick, {}
+            now = time.monotonic()
+            self._creating = {name: at for name, at in self._creating.items() if now - at < WARM_POOL_CREATE_GRACE}
+
+        depth = {}
+        for challenge_id, challenge in challenges.items():
+            pods = self._warm_pods(challenge_id)
+            for pod in pods:
+                if pod.status is not None and pod.status.phase in ["Failed", "Succeeded"]:
+                    self._delete(v1, pod)
+            alive = self._candidates(challenge_id)
+            names = {pod.metadata.name for pod in alive}
+            with self._lock:
+                for name in names:
+                    self._creating.pop(name, None)
+                starting = len([name for name in self._creating if name.startswith("ctf-" + challenge_id + "-")])
+
+            maximum = max(challenge.warm_pool_max, challenge.warm_pool_min)
+            target = min(challenge.warm_pool_min + claimed.get(challenge_id, 0), maximum)
+            current = len(alive) + starting
+            if current < target:
+                resources = ast.literal_eval(challenge.resource_limits)["resources"]
+                for _ in range(target - current):
+                    self._create(v1, self._generate_pod(challenge, resources))
+                current = target
+            elif len(alive) > maximum:
+                # Not ready ones first, they are the least useful
+                for pod in sorted(alive, key=is_ready)[:len(alive) - maximum]:
+                    self._delete(v1, pod)
+            ready = len([pod for pod in alive if is_ready(pod)])
+            depth[challenge_id] = {"ready": ready, "starting": max(current - ready, 0)}
+
+        # Pools of challenges that were removed or had their pool disabled
+        for pod in self._informer.list():
+            labels = pod.metadata.labels or {}
+            if labels.get("warm") == "true" and labels.get("challenge_id") not in challenges and pod.metadata.deletion_timestamp is None:
+                self._delete(v1, pod)
+
+        with self._lock:
+            self._depth = depth
+
+    def _create(self, v1, pod_dict):
+        try:
+            v1.create_namespaced_pod(pod_dict["metadata"]["namespace"], pod_dict)
+        except kubernetes.client.exceptions.ApiException as e:
+            print(f"Could not create warm pod {pod_dict['metadata']['name']}: {e.status} {e.reason}")
+            return
+        with self._lock:
+            self._creating[pod_dict["metadata"]["name"]] = time.monotonic()
+            self._created += 1
+
+    def _delete(self, v1, pod):
+        name = pod.metadata.name
+        try:
+            v1.delete_namespaced_pod(name, pod.metadata.namespace)
+        except kubernetes.client.exceptions.ApiException as e:
+            if e.status != 404:
+                print(f"Could not delete warm pod {name}: {e.status} {e.reason}")
+                return
+        with self._lock:
+            self._deleted += 1
+
+
+def is_ready(pod) -> bool:
+    """Whether the pod's Ready condition is true"""
+    if pod.status is None or not pod.status.conditions:
+        return False
+    return any(condition.type == "Ready" and condition.status == "True" for condition in pod.status.conditions)
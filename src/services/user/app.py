@@ -12,8 +12,10 @@ from database import (
     get_user,
     remove_user,
     update_user as update_user_db,
-    read_users
+    read_users,
+    pool
 )
+from pool import WAITRESS_THREADS
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -216,6 +218,11 @@ def get_all_users():
         raise exceptions.NotFound("No users found")
     return users, 200
 
+@app.get("/metrics")
+def metrics():
+    """Internal counters of the service"""
+    return {"db_pool": pool.stats()}, 200
+
 # Method for testing
 @app.post("/insert-admin")
 def insert_admin():
@@ -224,4 +231,4 @@ def insert_admin():
     return f"admin has been added", 201
 
 if __name__ == "__main__":
-    serve(app, host='0.0.0.0', port=8082)
\ No newline at end of file
+    serve(app, host='0.0.0.0', port=8082, threads=WAITRESS_THREADS)
\ No newline at end of file
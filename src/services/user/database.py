@@ -3,6 +3,7 @@ import psycopg2.extras
 import os
 from werkzeug import exceptions
 from models import User
+from pool import ConnectionPool
 
 max_db_connect_retries = 10
 
@@ -36,82 +37,78 @@ def connect():
         )
     return conn
 
+pool = ConnectionPool(connect)
+
 def insert_user(user):
     """insert user into database"""
-    conn = connect()
-    cursor = conn.cursor()
-    try:
-        # proceed with insertion
-        cursor.execute(
-            "INSERT INTO users (username, password_hashed, email, role) VALUES (%s, %s, %s, %s);",
-            (
-                user.username,
-                user.password_hashed,
-                user.email,
-                user.role,
-            ),
-        )
-    except psycopg2.Error as e:
-        raise exceptions.BadRequest(description=f"Database error: {e}")
-    finally:
-        conn.commit()
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # proceed with insertion
+            cursor.execute(
+                "INSERT INTO users (username, password_hashed, email, role) VALUES (%s, %s, %s, %s);",
+                (
+                    user.username,
+                    user.password_hashed,
+                    user.email,
+                    user.role,
+                ),
+            )
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+        finally:
+            conn.commit()
 
 def get_user(username):
     """get user"""
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-    row = cursor.fetchone()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
+        row = cursor.fetchone()
     user = User(*row) if row is not None else None
-    conn.close()
     return user
 
 def remove_user(username):
     """delete user from username"""
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE username = %s;", (username,))
-    conn.commit()
-    conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM users WHERE username = %s;", (username,))
+        conn.commit()
 
 def update_user(username, password_hashed, email, role):
     """update values of user with given username"""
-    conn = connect()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute(
-            """UPDATE users SET
-                password_hashed = %s,
-                email = %s,
-                role = %s
-                WHERE username = %s;""",
-            (
-                password_hashed,
-                email,
-                role,
-                username,
-            ),
-        )
-    except psycopg2.Error as e:
-        raise exceptions.BadRequest(description=f"Database error: {e}")
-    finally:
-        conn.commit()
-        conn.close()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(
+                """UPDATE users SET
+                    password_hashed = %s,
+                    email = %s,
+                    role = %s
+                    WHERE username = %s;""",
+                (
+                    password_hashed,
+                    email,
+                    role,
+                    username,
+                ),
+            )
+        except psycopg2.Error as e:
+            raise exceptions.BadRequest(description=f"Database error: {e}")
+        finally:
+            conn.commit()
 
 def read_users() -> [User]:
     """Reads all users from the users table"""
-    conn = connect()
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM users;")
+        cursor.execute("SELECT * FROM users;")
 
-    rows = cursor.fetchall()
+        rows = cursor.fetchall()
 
     # Parse challenges
     users = [User(*row) for row in rows]
 
-    conn.close()
-
     return users
\ No newline at end of file
@@ -47,18 +47,58 @@ CREATE_TABLE_QUERIES = [
         ready BOOLEAN,
         image_url VARCHAR(255),
         competition_id UUID,
+        warm_pool_min INTEGER NOT NULL DEFAULT 0,
+        warm_pool_max INTEGER NOT NULL DEFAULT 0,
+        instance_mode VARCHAR(16) NOT NULL DEFAULT 'per-user',
+        shared_replicas INTEGER NOT NULL DEFAULT 2,
+        placement VARCHAR(255) NOT NULL DEFAULT 'default',
         CONSTRAINT fk_competition_id FOREIGN KEY (competition_id)
             REFERENCES competitions (id)
             ON DELETE SET NULL
     );
     """,
     """
+    ALTER TABLE challenges ADD COLUMN IF NOT EXISTS warm_pool_min INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE challenges ADD COLUMN IF NOT EXISTS warm_pool_max INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE challenges ADD COLUMN IF NOT EXISTS instance_mode VARCHAR(16) NOT NULL DEFAULT 'per-user';
+    """,
+    """
+    ALTER TABLE challenges ADD COLUMN IF NOT EXISTS shared_replicas INTEGER NOT NULL DEFAULT 2;
+    """,
+    """
+    ALTER TABLE challenges ADD COLUMN IF NOT EXISTS placement VARCHAR(255) NOT NULL DEFAULT 'default';
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS instances (
+        username VARCHAR(255) NOT NULL,
+        challenge_id UUID NOT NULL,
+        competition_id UUID,
+        mode VARCHAR(32) NOT NULL,
+        state VARCHAR(32) NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT now(),
+        ready_at TIMESTAMP,
+        expires_at TIMESTAMP,
+        PRIMARY KEY (username, challenge_id),
+        FOREIGN KEY (challenge_id)
+            REFERENCES challenges (id)
+            ON DELETE CASCADE
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS instances_challenge_id_idx
+        ON instances (challenge_id);
+    """,
+    """
     CREATE TABLE IF NOT EXISTS submissions (
         id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
         username VARCHAR(255) NOT NULL,
         competition_id UUID NOT NULL,
         challenge_id UUID NOT NULL,
-        timestamp TIMESTAMP DEFAULT now(),
+        timestamp TIMESTAMP DEFAULT clock_timestamp(),
         submission_flag VARCHAR(255),
         score INTEGER NOT NULL,
         admin BOOLEAN NOT NULL,
@@ -67,6 +107,42 @@ CREATE_TABLE_QUERIES = [
             REFERENCES participants (username, competition_id)
             ON DELETE CASCADE
     );
+    """,
+    """
+    ALTER TABLE submissions ALTER COLUMN timestamp SET DEFAULT clock_timestamp();
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS leaderboard_scores (
+        username VARCHAR(255) NOT NULL,
+        competition_id UUID NOT NULL,
+        challenge_id UUID NOT NULL,
+        score INTEGER NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        PRIMARY KEY (username, competition_id, challenge_id),
+        FOREIGN KEY (username, competition_id)
+            REFERENCES participants (username, competition_id)
+            ON DELETE CASCADE
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS leaderboard_scores_challenge_id_idx
+        ON leaderboard_scores (challenge_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS leaderboard_totals (
+        username VARCHAR(255) NOT NULL,
+        competition_id UUID NOT NULL,
+        score INTEGER NOT NULL,
+        updated_at TIMESTAMP NOT NULL,
+        PRIMARY KEY (username, competition_id),
+        FOREIGN KEY (username, competition_id)
+            REFERENCES participants (username, competition_id)
+            ON DELETE CASCADE
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS leaderboard_totals_competition_id_idx
+        ON leaderboard_totals (competition_id);
     """
 ]
 
@@ -4,8 +4,11 @@ from config import DB_CONFIG
 
 # Drop table queries (reverse order of dependencies)
 DROP_TABLE_QUERIES = [
+    "DROP TABLE IF EXISTS leaderboard_totals;",
+    "DROP TABLE IF EXISTS leaderboard_scores;",
     "DROP TABLE IF EXISTS submissions;",
     "DROP TABLE IF EXISTS participants;",
+    "DROP TABLE IF EXISTS instances;",
     "DROP TABLE IF EXISTS challenges;",
     "DROP TABLE IF EXISTS competitions;",
     "DROP TABLE IF EXISTS users;",
@@ -5,6 +5,7 @@ import uuid
 import random
 import bcrypt
 from config import DB_CONFIG
+from rebuild_leaderboard import rebuild_leaderboard
 
 def populate_fake_data(num_users=20, num_challenges=10, num_competitions=5, max_competitions_per_user=3):
     """Populate tables with fake data."""
@@ -156,5 +157,8 @@ def populate_fake_data(num_users=20, num_challenges=10, num_competitions=5, max_
         cursor.close()
         conn.close()
 
+    # Submissions were inserted directly, so the maintained leaderboard has to catch up
+    rebuild_leaderboard()
+
 if __name__ == "__main__":
     populate_fake_data()
@@ -0,0 +1,40 @@
+import psycopg2
+import psycopg2.extras
+from config import DB_CONFIG
+
+# Recompute the maintained leaderboard tables from the submissions log (dependencies respected)
+REBUILD_LEADERBOARD_QUERIES = [
+    "DELETE FROM leaderboard_totals;",
+    "DELETE FROM leaderboard_scores;",
+    """
+    INSERT INTO leaderboard_scores (username, competition_id, challenge_id, score, timestamp)
+    SELECT username, competition_id, challenge_id, score, timestamp FROM (
+        SELECT username, competition_id, challenge_id, score, timestamp,
+            ROW_NUMBER() OVER (PARTITION BY username, competition_id, challenge_id ORDER BY timestamp DESC) AS rn
+        FROM submissions
+    ) latest
+    WHERE rn = 1;
+    """,
+    """
+    INSERT INTO leaderboard_totals (username, competition_id, score, updated_at)
+    SELECT username, competition_id, SUM(score), MAX(timestamp)
+    FROM leaderboard_scores
+    GROUP BY username, competition_id;
+    """,
+]
+
+def rebuild_leaderboard():
+    """Rebuild the leaderboard tables from submissions."""
+    conn = psycopg2.connect(**DB_CONFIG)
+    cursor = conn.cursor()
+    try:
+        for query in REBUILD_LEADERBOARD_QUERIES:
+            cursor.execute(query)
+        conn.commit()
+        print("Leaderboard rebuilt from submissions.")
+    finally:
+        cursor.close()
+        conn.close()
+
+if __name__ == "__main__":
+    rebuild_leaderboard()